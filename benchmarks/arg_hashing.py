@@ -0,0 +1,116 @@
+"""
+Compare how long idempotent.cache takes to hash large arguments, with the old approach (turn everything into
+json-able values with an isinstance scan per value, then json.dumps and sha256) and the current streaming hasher.
+The old approach couldn't hash numpy arrays at all, so for arrays it's given what callers had to pass instead: the
+array converted with tolist().
+
+    python benchmarks/arg_hashing.py
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import hashlib
+import json
+import time
+import types
+
+import pyfra.idempotent
+import pyfra.remote
+
+
+class OldObjectEncoder(json.JSONEncoder):
+    # remote._ObjectEncoder as it was, which had no case for numpy arrays
+    def default(self, obj):
+        if isinstance(obj, pyfra.remote.RemotePath):
+            return obj.sha256sum()
+        if isinstance(obj, (asyncio.Lock, asyncio.Event, asyncio.Condition, asyncio.Semaphore, asyncio.BoundedSemaphore)):
+            return None
+        if hasattr(obj, "_to_json"):
+            return obj._to_json()
+
+        return super().default(obj)
+
+
+def old_hash_args(args, kwargs):
+    # idempotent._prepare_for_hash and remote._hash_obs as they were
+    special_hashing = {
+        pyfra.remote.RemotePath: lambda x: x.quick_hash(),
+        pyfra.remote.Remote: lambda x: x.hash,
+        list: lambda x: list(map(prepare, x)),
+        dict: lambda x: {prepare(k): prepare(v) for k, v in x.items()},
+        tuple: lambda x: tuple(map(prepare, x)),
+        types.FunctionType: lambda x: x.__name__,
+        type: lambda x: x.__name__,
+    }
+    try:
+        from pandas import DataFrame
+        special_hashing[DataFrame] = lambda x: x.to_json()
+    except ImportError:
+        pass
+
+    def prepare(x):
+        if dataclasses.is_dataclass(x):
+            return dataclasses.asdict(x)
+        for type_, fn in special_hashing.items():
+            if isinstance(x, type_):
+                return fn(x)
+        return x
+
+    ob = [[prepare(i) for i in args], [(prepare(k), prepare(v)) for k, v in sorted(kwargs.items())]]
+    return hashlib.sha256(json.dumps(ob, sort_keys=True, cls=OldObjectEncoder).encode()).hexdigest()
+
+
+def cases(scale):
+    # (name, args for the new hasher, args for the old one)
+    args = [list(range(scale))]
+    yield "list of ints", args, args
+    args = [[{"id": i, "tags": ["a", "b"], "meta": {"x": i / 7}} for i in range(scale // 10)]]
+    yield "nested records", args, args
+    args = [{str(i): i / 3 for i in range(scale // 10)}]
+    yield "dict of floats", args, args
+
+    try:
+        import numpy as np
+        arr = np.random.default_rng(0).random(scale * 10)
+        yield "float array", [arr], [arr.tolist()]
+    except ImportError:
+        pass
+
+    try:
+        import numpy as np
+        import pandas as pd
+        args = [pd.DataFrame({
+            "a": np.arange(scale),
+            "b": np.random.default_rng(0).random(scale),
+            "c": [f"row{i}" for i in range(scale)],
+        })]
+        yield "DataFrame", args, args
+    except ImportError:
+        pass
+
+
+def bench(fn, args, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.time()
+        fn(args, {})
+        best = min(best, time.time() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'argument':<20}{'old (s)':>10}{'new (s)':>10}")
+    for name, new_args, old_args in cases(args.scale):
+        old = bench(old_hash_args, old_args, args.repeat)
+        new = bench(pyfra.idempotent._hash_args, new_args, args.repeat)
+        print(f"{name:<20}{old:>10.3f}{new:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Compare how much each CompressedKVStore codec saves on typical cached results, and what it costs to
+store and load them.
+
+    python benchmarks/kvstore_compression.py
+"""
+
+import argparse
+import random
+import time
+
+import pyfra.idempotent
+import pyfra.state
+
+
+class DictKVStore(pyfra.idempotent.KVStoreProvider):
+    # in memory, so that only the cost of encoding and compressing is measured
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data[key]
+
+    def set(self, key, value):
+        self.data[key] = value
+
+
+def values(scale):
+    rng = random.Random(0)
+    words = [f"w{i}" for i in range(2000)]
+    # zipf-ish word frequencies, like natural text
+    weights = [1 / (i + 1) for i in range(len(words))]
+
+    yield "eval outputs", [
+        {"doc_id": i, "prompt": " ".join(rng.choices(words, weights, k=40)), "completion": " ".join(rng.choices(words, weights, k=20)), "acc": rng.random() < 0.5}
+        for i in range(scale // 10)
+    ]
+
+    try:
+        import numpy as np
+        yield "token ids", np.array(rng.choices(range(50000), [1 / (i + 1) for i in range(50000)], k=scale * 10), dtype=np.int32)
+        yield "float activations", np.random.default_rng(0).standard_normal(scale * 2).astype(np.float32)
+    except ImportError:
+        yield "token ids", rng.choices(range(50000), [1 / (i + 1) for i in range(50000)], k=scale * 10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'value':<20}{'codec':<8}{'MiB':>10}{'ratio':>8}{'set (s)':>10}{'get (s)':>10}")
+    for name, value in values(args.scale):
+        raw = None
+        for codec in ["none", "zlib", "lzma", "zstd"]:
+            if codec not in pyfra.state._codecs:
+                continue
+            kv = pyfra.idempotent.CompressedKVStore(DictKVStore(), codec=codec)
+
+            set_time = get_time = float("inf")
+            for _ in range(args.repeat):
+                start = time.time()
+                kv.set("key", value)
+                set_time = min(set_time, time.time() - start)
+                start = time.time()
+                kv.get("key")
+                get_time = min(get_time, time.time() - start)
+
+            size = len(kv.inner.data["key"])
+            raw = raw or size
+            print(f"{name:<20}{codec:<8}{size / 2**20:>10.2f}{raw / size:>8.1f}{set_time:>10.3f}{get_time:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Compare how big env state gets and how long it takes to load, for the old pickle + base64 json
+encoding and the binary encodings in pyfra.state.
+
+    python benchmarks/state_encoding.py --steps 20000
+"""
+
+import argparse
+import base64
+import json
+import os
+import pickle
+import tempfile
+import time
+
+import pyfra.state
+from pyfra.remote import Remote
+
+
+def history(steps, array_every):
+    """ A made up step history: mostly small return values, with the occasional array """
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    for i in range(steps):
+        key = "%064x" % i
+        if array_every and i % array_every == 0:
+            yield key, rng.integers(0, 1000, size=(256, 256)).astype(np.float32)
+        else:
+            yield key, {"step": i, "loss": float(rng.random()), "files": [f"out/{i}/part{j}" for j in range(4)]}
+
+
+def bench_legacy(items, tmpdir):
+    # the old format: a json object with a b64 string and a _format entry per key, rewritten in full
+    fname = os.path.join(tmpdir, "state.json")
+    ob = {}
+    for key, value in items:
+        ob[key] = base64.b64encode(pickle.dumps(value)).decode()
+        ob[key + "_format"] = "b64"
+    with open(fname, "w") as fh:
+        json.dump(ob, fh)
+
+    start = time.time()
+    with open(fname) as fh:
+        ob = json.load(fh)
+    values = {key: pickle.loads(base64.b64decode(value)) for key, value in ob.items() if not key.endswith("_format")}
+    return os.path.getsize(fname), time.time() - start, len(values)
+
+
+def bench_binary(items, tmpdir, compression):
+    os.environ["PYFRA_STATE_COMPRESSION"] = compression
+    rem = Remote(wd=tmpdir)
+    state = pyfra.state.JournalState(rem)
+    state.set_many({key: pyfra.state.encode_value(value) for key, value in items})
+
+    start = time.time()
+    state = pyfra.state.JournalState(rem)
+    values = {key: pyfra.state.decode_value(state.get(key)) for key in state.keys()}
+    return os.path.getsize(state.path.fname), time.time() - start, len(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--steps", type=int, default=20000)
+    parser.add_argument("--array-every", type=int, default=1000, help="Make every n-th value a 256x256 float32 array (0 for never)")
+    args = parser.parse_args()
+
+    items = list(history(args.steps, args.array_every))
+    print(f"{'encoding':<16}{'size (MiB)':>12}{'load (s)':>12}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        size, secs, n = bench_legacy(items, tmpdir)
+        print(f"{'json + b64':<16}{size / 2**20:>12.2f}{secs:>12.3f}")
+
+    for compression in ["none", "zlib", "lzma", "zstd"]:
+        if compression not in pyfra.state._codecs:
+            continue
+        with tempfile.TemporaryDirectory() as tmpdir:
+            size, secs, n = bench_binary(items, tmpdir, compression)
+            print(f"{'binary ' + compression:<16}{size / 2**20:>12.2f}{secs:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ init()
 from .remote import *
 from .shell import *
 from .delegation import *
+from .downloader import *
+from .state import *
 from .idempotent import set_kvstore, cache
 
 try:
@@ -0,0 +1,59 @@
+"""
+Maintenance commands, run as :code:`python -m pyfra <command>`.
+
+    python -m pyfra gc                          # the state in the current directory, e.g. stages
+    python -m pyfra gc --envs                   # and every env on this machine
+    python -m pyfra gc --host 12.34.56.78 --envs --max-age 7d --dry-run
+"""
+
+import argparse
+import os
+import re
+import sys
+
+from pyfra.remote import Remote
+
+
+def _parse_age(x):
+    """ Parse an age like 3600, 90m, 12h or 30d into seconds """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd]?)", x)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Can't parse age {x}, expected something like 12h or 30d")
+    return float(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+
+
+def gc(args):
+    rem = Remote(args.host)
+    wds = [os.path.abspath(wd) if args.host is None else wd for wd in args.dirs]
+    if args.envs:
+        wds += [path.fname for path in rem.path("~/pyfra_envs").glob("*") if path.is_dir()]
+    if not wds:
+        wds = [os.getcwd()] if args.host is None else ["~"]
+
+    for wd in wds:
+        stats = Remote(args.host, wd=wd, state_backend=args.state_backend).gc_state(max_age=args.max_age, max_entries=args.max_entries, max_kv_age=args.max_kv_age, dry_run=args.dry_run)
+        verb = "Would drop" if args.dry_run else "Dropped"
+        print(f"[{args.host or 'local'}:{wd}] {verb} {stats['dropped']} of {stats['entries']} entries and {stats['blobs']} blobs")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m pyfra", description="pyfra maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gc_parser = commands.add_parser("gc", help="Drop env state that won't be used again and compact it. See pyfra.state.collect_garbage.")
+    gc_parser.add_argument("dirs", nargs="*", help="Directories whose state to clean up. Defaults to the current directory.")
+    gc_parser.add_argument("--host", default=None, help="Host the directories are on, if not this machine.")
+    gc_parser.add_argument("--envs", action="store_true", help="Also clean up every env in ~/pyfra_envs.")
+    gc_parser.add_argument("--max-age", type=_parse_age, default=30 * 86400, help="Drop entries whose chains haven't been used for this long, e.g. 12h or 30d. Defaults to 30d.")
+    gc_parser.add_argument("--max-kv-age", type=_parse_age, default=None, help="Also drop entries that aren't steps of an env, like stage results and cached values, once they haven't been used for this long. By default they're kept.")
+    gc_parser.add_argument("--max-entries", type=int, default=None, help="Keep at most this many entries per directory.")
+    gc_parser.add_argument("--state-backend", default=None, help="The state backend the directories use, if not the default.")
+    gc_parser.add_argument("--dry-run", action="store_true", help="Only print what would be dropped.")
+    gc_parser.set_defaults(fn=gc)
+
+    args = parser.parse_args(argv)
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
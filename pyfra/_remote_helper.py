@@ -0,0 +1,532 @@
+"""
+Helper code that pyfra runs on remotes by sending this file's source to :code:`python3 -c`, so that
+remotes don't need pyfra or anything else installed. Because of that, this module must only use the
+standard library, must stay compatible with old python 3 versions, and must never import the rest of pyfra.
+pyfra also imports it locally, so that both ends of a comparison compute exactly the same thing.
+"""
+
+import base64
+import binascii
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import stat
+import struct
+import sys
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
+
+# same parameters pyfra has always passed to imohash
+QUICK_HASH_SAMPLE_SIZE = 4 * 1024**2
+QUICK_HASH_SAMPLE_THRESHOLD = 16 * 1024**2
+
+_M64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _rotl64(x, r):
+    return ((x << r) | (x >> (64 - r))) & _M64
+
+
+def _fmix64(k):
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & _M64
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & _M64
+    k ^= k >> 33
+    return k
+
+
+def _murmur3_x64_128(data):
+    """ Pure python MurmurHash3 x64 128 with seed 0, returning (h1, h2). Only used if mmh3 isn't installed. """
+    c1 = 0x87c37b91114253d5
+    c2 = 0x4cf5ad432745937f
+    h1 = h2 = 0
+    nblocks = len(data) // 16
+
+    for k1, k2 in struct.iter_unpack("<QQ", memoryview(data)[:nblocks * 16]):
+        k1 = (_rotl64((k1 * c1) & _M64, 31) * c2) & _M64
+        h1 = ((_rotl64(h1 ^ k1, 27) + h2) * 5 + 0x52dce729) & _M64
+        k2 = (_rotl64((k2 * c2) & _M64, 33) * c1) & _M64
+        h2 = ((_rotl64(h2 ^ k2, 31) + h1) * 5 + 0x38495ab5) & _M64
+
+    tail = data[nblocks * 16:]
+    if len(tail) > 8:
+        h2 ^= (_rotl64((int.from_bytes(tail[8:], "little") * c2) & _M64, 33) * c1) & _M64
+    if len(tail) > 0:
+        h1 ^= (_rotl64((int.from_bytes(tail[:8], "little") * c1) & _M64, 31) * c2) & _M64
+
+    h1 ^= len(data)
+    h2 ^= len(data)
+    h1 = (h1 + h2) & _M64
+    h2 = (h2 + h1) & _M64
+    h1 = _fmix64(h1)
+    h2 = _fmix64(h2)
+    h1 = (h1 + h2) & _M64
+    h2 = (h2 + h1) & _M64
+    return h1, h2
+
+
+def _varint(n):
+    buf = b""
+    while True:
+        towrite = n & 0x7f
+        n >>= 7
+        if n:
+            buf += bytes((towrite | 0x80,))
+        else:
+            return buf + bytes((towrite,))
+
+
+def quick_hash_file(fname):
+    """ Exactly what imohash.hashfile(fname, sample_threshhold=16MB, sample_size=4MB, hexdigest=True) returns """
+    size = os.path.getsize(fname)
+    ss = QUICK_HASH_SAMPLE_SIZE
+    with open(fname, "rb") as fh:
+        if size < QUICK_HASH_SAMPLE_THRESHOLD or size < 4 * ss:
+            data = fh.read()
+        else:
+            data = fh.read(ss)
+            fh.seek(size // 2)
+            data += fh.read(ss)
+            fh.seek(-ss, os.SEEK_END)
+            data += fh.read(ss)
+
+    if mmh3 is not None:
+        raw = mmh3.hash_bytes(data)
+        digest = raw[7::-1] + raw[16:7:-1]
+    else:
+        h1, h2 = _murmur3_x64_128(data)
+        digest = h1.to_bytes(8, "big") + h2.to_bytes(8, "big")
+
+    enc_size = _varint(size)
+    return binascii.hexlify(enc_size + digest[len(enc_size):]).decode()
+
+
+def _map(fn, items, max_workers, processes=None):
+    """
+    Map in parallel. Without mmh3, quick hashing is pure python and holds the GIL, so by default processes
+    are used in that case if possible.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return list(map(fn, items))
+    if processes is None:
+        processes = mmh3 is None
+    if processes:
+        try:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=min(max_workers, os.cpu_count() or 1), mp_context=multiprocessing.get_context("fork")) as executor:
+                return list(executor.map(fn, items, chunksize=8))
+        except (ImportError, ValueError, TypeError, OSError):
+            pass
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fn, items))
+
+
+def _walk_files(path):
+    """ Map of relative path to [size, mtime_ns, inode] for every regular file under path """
+    # like Path.glob('**/*'), this doesn't descend into symlinked dirs but does include symlinked files
+    files = {}
+    for root, _, fnames in os.walk(path):
+        for fname in fnames:
+            full = os.path.join(root, fname)
+            try:
+                st = os.stat(full)
+            except OSError: # broken symlink
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files[os.path.relpath(full, path)] = [st.st_size, st.st_mtime_ns, st.st_ino]
+    return files
+
+
+def _manifest_fname(manifest_dir, path, kind):
+    return os.path.join(manifest_dir, hashlib.sha256((kind + ":" + path).encode()).hexdigest()[:32] + ".json")
+
+
+def file_hashes(path, hash_fn, manifest_dir=None, kind="quick_hash", max_workers=16, processes=None):
+    """
+    Hash every file in a directory, returning a map of relative path to hash. If manifest_dir is given,
+    the hashes are remembered there along with each file's size, mtime and inode, so that only files
+    that changed since the last call have to be hashed again.
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    files = _walk_files(path)
+
+    manifest = {}
+    if manifest_dir is not None:
+        manifest_dir = os.path.expanduser(manifest_dir)
+        os.makedirs(manifest_dir, exist_ok=True)
+        try:
+            with open(_manifest_fname(manifest_dir, path, kind)) as fh:
+                manifest = json.load(fh)
+        except (OSError, ValueError):
+            pass
+
+    # manifest entries are [size, mtime_ns, inode, hash]
+    stale = [rel for rel, key in files.items() if manifest.get(rel, [None])[:3] != key]
+    for rel, h in zip(stale, _map(hash_fn, [os.path.join(path, rel) for rel in stale], max_workers, processes)):
+        manifest[rel] = files[rel] + [h]
+
+    if manifest_dir is not None and (stale or len(manifest) != len(files)):
+        manifest = {rel: manifest[rel] for rel in files}
+        tmpname = "{}.{}.tmp".format(_manifest_fname(manifest_dir, path, kind), uuid.uuid4().hex)
+        with open(tmpname, "w") as fh:
+            json.dump(manifest, fh)
+        os.replace(tmpname, _manifest_fname(manifest_dir, path, kind))
+
+    return {rel: manifest[rel][3] for rel in files}
+
+
+def _combine(hashes):
+    """ Same as pyfra.remote._hash_obs(*sorted pairs)[:32], sorted the way sorting Path objects would """
+    pairs = [[rel, hashes[rel]] for rel in sorted(hashes, key=lambda rel: rel.split(os.sep))]
+    return hashlib.sha256(json.dumps(pairs, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def quick_hash(path, manifest_dir=None, max_workers=16):
+    """ imohash of a file, or a combined hash of the imohashes of every file in a directory """
+    path = os.path.expanduser(path)
+    if os.path.isdir(path):
+        return _combine(file_hashes(path, quick_hash_file, manifest_dir, "quick_hash", max_workers))
+    return quick_hash_file(path)
+
+
+def _quick_hash_or_none(path, manifest_dir, max_workers):
+    try:
+        return quick_hash(path, manifest_dir, max_workers)
+    except OSError:
+        return None
+
+
+def quick_hash_many(paths, manifest_dir=None, max_workers=16):
+    """ quick_hash of each path, or None for paths that don't exist """
+    f = functools.partial(_quick_hash_or_none, manifest_dir=manifest_dir, max_workers=max_workers)
+
+    # files inside directories are already hashed in parallel, so only plain files are spread over workers here
+    files = [p for p in paths if not os.path.isdir(os.path.expanduser(p))]
+    results = dict(zip(files, _map(f, files, max_workers)))
+    results.update({p: f(p) for p in paths if p not in results})
+    return results
+
+
+def sha256_file(fname, bufsize=1024 * 1024):
+    h = hashlib.sha256()
+    with open(fname, "rb") as fh:
+        for block in iter(lambda: fh.read(bufsize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def sha256_many(paths, max_workers=16):
+    """
+    sha256 of each path: a hexdigest for files, a map of relative path to hexdigest for directories, or None
+    for paths that don't exist. Every file is read in full, so nothing is cached between calls.
+    """
+    def _f(path):
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            # hashlib releases the GIL while hashing, so threads are enough
+            return file_hashes(path, sha256_file, max_workers=max_workers, processes=False)
+        try:
+            return sha256_file(path)
+        except OSError:
+            return None
+
+    files = [p for p in paths if not os.path.isdir(os.path.expanduser(p))]
+    results = dict(zip(files, _map(_f, files, max_workers, processes=False)))
+    results.update({p: _f(p) for p in paths if p not in results})
+    return results
+
+
+def sha256_copy_dest(to, name, into, max_workers=16):
+    """ sha256_many of wherever copying something called name to the path to puts it, following rsync's rules """
+    to = os.path.expanduser(to)
+    inside = os.path.join(to, name)
+    if os.path.isdir(to) and (into or os.path.isfile(inside)):
+        to = inside
+    return sha256_many([to], max_workers)[to]
+
+
+def _fill_hashes(node):
+    """ Set the hash of node and of every directory below it, returning the sorted (path parts, hash) of all files under node """
+    entries = []
+    # concatenating in name order gives the same order as sorting all the paths by their parts
+    for name in sorted(set(node["files"]) | set(node["dirs"])):
+        if name in node["files"]:
+            entries.append(((name,), node["files"][name]))
+        else:
+            entries.extend(((name,) + parts, h) for parts, h in _fill_hashes(node["dirs"][name]))
+
+    pairs = [[os.sep.join(parts), h] for parts, h in entries]
+    node["hash"] = hashlib.sha256(json.dumps(pairs, sort_keys=True).encode()).hexdigest()[:32]
+    return entries
+
+
+def merkle_tree(path, manifest_dir=None, max_workers=16):
+    """
+    Hash tree of a directory, as nested dicts of the form {"hash": ..., "files": {name: hash}, "dirs": {name: subtree}}.
+    The hash of each directory in the tree is the same as its quick_hash, so the root hash is the quick_hash of path,
+    and subtrees can be compared with the quick_hash of directories elsewhere. Returns None if path isn't a directory.
+    """
+    path = os.path.expanduser(path)
+    if not os.path.isdir(path):
+        return None
+
+    root = {"files": {}, "dirs": {}}
+    for rel, h in file_hashes(path, quick_hash_file, manifest_dir, "quick_hash", max_workers).items():
+        parts = rel.split(os.sep)
+        node = root
+        for part in parts[:-1]:
+            node = node["dirs"].setdefault(part, {"files": {}, "dirs": {}})
+        node["files"][parts[-1]] = h
+
+    _fill_hashes(root)
+    return root
+
+
+def merkle_diff(src, dst, prefix=""):
+    """
+    Relative paths of the topmost files and directories in the tree src that are missing or different in the tree dst.
+    Copying just these paths makes dst contain everything in src. Things that only exist in dst aren't included.
+    """
+    if src["hash"] == dst["hash"]:
+        return []
+
+    diff = [prefix + name for name, h in sorted(src["files"].items()) if dst["files"].get(name) != h]
+    for name, subtree in sorted(src["dirs"].items()):
+        if name in dst["dirs"]:
+            diff += merkle_diff(subtree, dst["dirs"][name], prefix + name + "/")
+        else:
+            diff.append(prefix + name)
+    return diff
+
+
+# env state journals are a sequence of records, each a header followed by the key and the value
+JOURNAL_MAGIC = b"PFJ1"
+JOURNAL_HEADER = struct.Struct("<4sIII") # magic, key length, value length, crc32 of key and value
+
+
+def encode_record(key, value):
+    key = key.encode()
+    return JOURNAL_HEADER.pack(JOURNAL_MAGIC, len(key), len(value), zlib.crc32(value, zlib.crc32(key))) + key + value
+
+
+def decode_records(data):
+    """
+    Parse journal records out of data. A record that's cut off or doesn't match its checksum, which is what a writer
+    that died partway through leaves behind, is skipped by searching for the start of the next valid record.
+
+    Returns:
+        The (key, value) records, and the offset just past the last valid record.
+    """
+    view = memoryview(data)
+    records = []
+    pos = end = 0
+    while True:
+        pos = data.find(JOURNAL_MAGIC, pos)
+        if pos < 0 or pos + JOURNAL_HEADER.size > len(data):
+            break
+        _, klen, vlen, crc = JOURNAL_HEADER.unpack_from(data, pos)
+        start = pos + JOURNAL_HEADER.size
+        if start + klen + vlen <= len(data):
+            key, value = view[start:start + klen], view[start + klen:start + klen + vlen]
+            if zlib.crc32(value, zlib.crc32(key)) == crc:
+                try:
+                    records.append((bytes(key).decode(), bytes(value)))
+                    pos = end = start + klen + vlen
+                    continue
+                except UnicodeDecodeError:
+                    pass
+        pos += 1
+    return records, end
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """ Hold an exclusive lock on path + ".lock" for as long as the context is open """
+    fd = os.open(os.path.expanduser(path) + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def journal_append(path, data):
+    """ Append encoded records to a journal. Concurrent appends take turns, so records never interleave. """
+    path = os.path.expanduser(path)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _locked(path), open(path, "ab") as fh:
+        fh.write(data)
+
+
+def journal_read(path, offset=0, ino=None):
+    """
+    Read a journal from offset onwards, or from the start if it has been replaced since offset was
+    read (i.e. its inode isn't ino anymore). Returns (inode, where the data starts, data).
+    """
+    try:
+        with open(os.path.expanduser(path), "rb") as fh:
+            st = os.fstat(fh.fileno())
+            if st.st_ino != ino or st.st_size < offset:
+                offset = 0
+            fh.seek(offset)
+            return st.st_ino, offset, fh.read()
+    except FileNotFoundError:
+        return None, 0, b""
+
+
+def journal_compact(path, drop=()):
+    """
+    Rewrite a journal with only the latest record for each key, without losing anything appended concurrently.
+    Keys in drop are left out altogether.
+    """
+    path = os.path.expanduser(path)
+    with _locked(path):
+        try:
+            with open(path, "rb") as fh:
+                records, _ = decode_records(fh.read())
+        except FileNotFoundError:
+            return
+        latest = dict(records)
+        for key in drop:
+            latest.pop(key, None)
+
+        tmpname = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmpname, "wb") as fh:
+            for key, value in latest.items():
+                fh.write(encode_record(key, value))
+        os.replace(tmpname, path)
+
+
+def read_json(path):
+    """ The parsed contents of a json file, or None if it doesn't exist """
+    try:
+        with open(os.path.expanduser(path)) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def remove_file(path):
+    """ Remove a file, if it's still there """
+    try:
+        os.remove(os.path.expanduser(path))
+    except FileNotFoundError:
+        pass
+
+
+def _journal_append_op(path, data):
+    journal_append(path, base64.b64decode(data))
+
+
+def _journal_read_op(path, offset=0, ino=None):
+    ino, start, data = journal_read(path, offset, ino)
+    return {"ino": ino, "start": start, "data": base64.b64encode(data).decode()}
+
+
+def _sqlite_connect(db):
+    """ Open an env state database, creating it if needed """
+    db = os.path.expanduser(db)
+    if os.path.dirname(db):
+        os.makedirs(os.path.dirname(db), exist_ok=True)
+    conn = sqlite3.connect(db, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+    return conn
+
+
+def state_keys(db):
+    """ All keys in an env state database, or None if there's no database yet """
+    if not os.path.exists(os.path.expanduser(db)):
+        return None
+    conn = _sqlite_connect(db)
+    try:
+        return [key for key, in conn.execute("SELECT key FROM kv")]
+    finally:
+        conn.close()
+
+
+def state_get(db, keys):
+    """ Map of key to base64 value for the keys that are in an env state database """
+    conn = _sqlite_connect(db)
+    try:
+        ret = {}
+        for key in keys:
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                ret[key] = base64.b64encode(row[0]).decode()
+        return ret
+    finally:
+        conn.close()
+
+
+def state_set(db, items):
+    """ Insert or overwrite base64 values in an env state database, all in one transaction """
+    conn = _sqlite_connect(db)
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", [(key, base64.b64decode(value)) for key, value in items.items()])
+    finally:
+        conn.close()
+
+
+def state_delete(db, keys):
+    """ Delete keys from an env state database, all in one transaction """
+    conn = _sqlite_connect(db)
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("DELETE FROM kv WHERE key = ?", [(key,) for key in keys])
+    finally:
+        conn.close()
+
+
+def state_vacuum(db):
+    """ Give the space of deleted entries in an env state database back to the filesystem """
+    conn = _sqlite_connect(db)
+    try:
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def run(op, **kwargs):
+    ops = {
+        "quick_hash_many": quick_hash_many,
+        "merkle_tree": merkle_tree,
+        "sha256_many": sha256_many,
+        "sha256_copy_dest": sha256_copy_dest,
+        "journal_append": _journal_append_op,
+        "journal_read": _journal_read_op,
+        "journal_compact": journal_compact,
+        "read_json": read_json,
+        "remove_file": remove_file,
+        "state_keys": state_keys,
+        "state_get": state_get,
+        "state_set": state_set,
+        "state_delete": state_delete,
+        "state_vacuum": state_vacuum,
+    }
+    return ops[op](**kwargs)
+
+
+def main(request):
+    """ Entry point on remotes: runs the request and prints the result as json on the last line of output """
+    request = json.loads(request)
+    result = run(request.pop("op"), **request)
+    sys.stdout.write("\n" + json.dumps(result) + "\n")
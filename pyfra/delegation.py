@@ -60,10 +60,10 @@ def delegate(experiment_name, rem, artifacts=[]):
         _attach_tmux()
 
     if artifacts: print("Copying artifacts")
-    for pattern in artifacts:
-        for path in env.path(".").glob(pattern):
-            if path.fname.endswith(".pyfra_env_state.json"): continue
-            pyfra.shell.copy(path, pyfra.remote.local.path("."), exclude=ignore)
+    paths = [path for pattern in artifacts for path in env.path(".").glob(pattern) if not os.path.basename(path.fname).startswith((".pyfra_env_state", ".pyfra_blobs"))]
+    for entry in pyfra.shell.gather(paths, ".", namespace=False, exclude=ignore):
+        if entry["status"] == "failed":
+            print(f"WARNING: couldn't copy artifact {entry['src']}: {entry['error']}")
 
     sys.exit(0)
 
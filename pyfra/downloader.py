@@ -0,0 +1,330 @@
+"""
+Fast downloading of files over http(s). This module only uses the standard library and never imports
+the rest of pyfra, so that its source can also be shipped to and run on remotes as-is.
+"""
+
+import collections
+import errno
+import hashlib
+import http.client
+import json
+import os
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+__all__ = ["download", "curl_many", "ChecksumError"]
+
+
+class ChecksumError(Exception):
+    def __init__(self, url, expected, actual):
+        super().__init__(f"Checksum mismatch for {url}: expected sha256 {expected} but got {actual}")
+        self.expected = expected
+        self.actual = actual
+
+
+CurlResult = collections.namedtuple("CurlResult", ["url", "status", "path", "data", "error"])
+CurlResult.__doc__ = """
+The outcome of fetching one url with :func:`curl_many`. status is the http status code (None if no response
+was ever received), path is where the file was saved, data is the contents if it was kept in memory instead,
+and error is the exception that made the last attempt fail, or None if the download succeeded.
+"""
+
+
+class _ConnectionPool:
+    """
+    Keeps one open keep-alive connection per thread and host, so that many requests to the same
+    host don't each pay for a new tcp and tls handshake.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @contextmanager
+    def open(self, url, headers={}, max_redirects=5):
+        """
+        Send a GET request and yield the response, following redirects. Error statuses are raised as
+        urllib.error.HTTPError. The connection goes back into the pool if the response was read to the end.
+        """
+        for _ in range(max_redirects + 1):
+            conn, resp = self._request(url, headers)
+            location = resp.getheader("Location")
+            if resp.status not in (301, 302, 303, 307, 308) or not location:
+                break
+            self._release(conn, resp)
+            url = urllib.parse.urljoin(url, location)
+
+        try:
+            if resp.status >= 300:
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+            yield resp
+        finally:
+            self._release(conn, resp)
+
+    def _request(self, url, headers):
+        if not hasattr(self._local, "conns"): self._local.conns = {}
+        conns = self._local.conns
+
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+        # the server may have closed a pooled connection since it was last used, so retry once on a fresh one
+        for reused in [key in conns, False]:
+            if key not in conns:
+                conn_cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+                conns[key] = conn_cls(parts.netloc, timeout=self.timeout)
+            conn = conns[key]
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                del conns[key]
+                if not reused: raise
+
+    def _release(self, conn, resp):
+        # small leftover bodies (e.g. from redirects and errors) are drained so the connection stays usable
+        if not resp.isclosed() and resp.length is not None and resp.length <= 64 * 1024:
+            try:
+                resp.read()
+            except (http.client.HTTPException, OSError):
+                pass
+        if not resp.isclosed():
+            conn.close()
+
+
+# errnos of OSErrors that come from the network, rather than from e.g. the local filesystem
+_NETWORK_ERRNOS = {
+    errno.ECONNABORTED, errno.ECONNREFUSED, errno.ECONNRESET, errno.EHOSTDOWN, errno.EHOSTUNREACH,
+    errno.ENETDOWN, errno.ENETRESET, errno.ENETUNREACH, errno.EPIPE, errno.ETIMEDOUT,
+}
+
+
+def _retryable(e):
+    """
+    Rate limiting, server errors and connection problems are worth retrying; other http errors aren't, and
+    neither are local errors like a missing directory or a full disk.
+    """
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code == 429 or e.code >= 500
+    if isinstance(e, (http.client.HTTPException, urllib.error.URLError, ConnectionError, TimeoutError, socket.timeout, socket.gaierror, ssl.SSLError)):
+        return True
+    return isinstance(e, OSError) and e.errno in _NETWORK_ERRNOS
+
+
+def _with_retries(fn, max_tries):
+    """ Call fn, retrying with exponential backoff if it fails in a way that's worth retrying """
+    for i in range(max_tries):
+        try:
+            return fn()
+        except Exception as e:
+            if not _retryable(e) or i == max_tries - 1: raise
+
+            # respect the server's Retry-After if it sends one
+            retry_after = e.headers.get("Retry-After", "") if isinstance(e, urllib.error.HTTPError) and e.headers is not None else ""
+            time.sleep(float(retry_after) if retry_after.isdigit() else min(2 ** i, 60))
+
+
+def _probe(pool, url, max_tries):
+    """ Returns (size, validator) if the server supports range requests for url, otherwise (None, None) """
+    def _f():
+        try:
+            with pool.open(url, {"Range": "bytes=0-0"}) as resp:
+                content_range = resp.getheader("Content-Range", "")
+                if resp.status != 206 or "/" not in content_range or content_range.endswith("/*"):
+                    return None, None
+                resp.read()
+                return int(content_range.split("/")[-1]), resp.getheader("ETag") or resp.getheader("Last-Modified")
+        except urllib.error.HTTPError as e:
+            # empty files can't satisfy any range
+            if e.code == 416: return None, None
+            raise
+
+    return _with_retries(_f, max_tries)
+
+
+def _sha256_file(fname, bufsize=1024 * 1024):
+    h = hashlib.sha256()
+    with open(fname, "rb") as fh:
+        for block in iter(lambda: fh.read(bufsize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _download_single(pool, url, partname, max_tries, bufsize):
+    def _f():
+        with pool.open(url) as resp, open(partname, "wb") as fh:
+            for block in iter(lambda: resp.read(bufsize), b""):
+                fh.write(block)
+            return resp.status
+
+    return _with_retries(_f, max_tries)
+
+
+def _download_ranges(pool, url, partname, statename, size, validator, connections, chunk_size, max_tries, bufsize):
+    # each piece is [start, end) and gets fetched with its own range request
+    pieces = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+    done = set()
+    if os.path.exists(statename) and os.path.exists(partname):
+        with open(statename) as fh:
+            state = json.load(fh)
+        # only resume if the file on the server is still the same one
+        if state["url"] == url and state["size"] == size and state["validator"] == validator and state["chunk_size"] == chunk_size:
+            done = set(state["done"])
+
+    if not done:
+        with open(partname, "wb") as fh:
+            fh.truncate(size)
+
+    lock = threading.Lock()
+
+    def _save_state():
+        with open(statename + ".tmp", "w") as fh:
+            json.dump({"url": url, "size": size, "validator": validator, "chunk_size": chunk_size, "done": sorted(done)}, fh)
+        os.replace(statename + ".tmp", statename)
+
+    fd = os.open(partname, os.O_WRONLY)
+    try:
+        def _fetch(piece):
+            start, end = piece
+
+            def _f():
+                pos = start
+                with pool.open(url, {"Range": f"bytes={start}-{end - 1}"}) as resp:
+                    if resp.status != 206: raise IOError(f"Server ignored range request for {url}")
+                    for block in iter(lambda: resp.read(min(bufsize, end - pos)), b""):
+                        os.pwrite(fd, block, pos)
+                        pos += len(block)
+                if pos != end: raise IOError(f"Short read for bytes {start}-{end - 1} of {url}")
+
+            _with_retries(_f, max_tries)
+            with lock:
+                done.add(start)
+                _save_state()
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            # list() so that the first exception from a worker is raised here
+            list(executor.map(_fetch, [p for p in pieces if p[0] not in done]))
+    finally:
+        os.close(fd)
+
+
+def download(url, to, connections=8, checksum=None, chunk_size=8 * 1024**2, max_tries=5, timeout=30, bufsize=1024 * 1024):
+    """
+    Download a url to a local file, fetching pieces of the file over several connections in parallel
+    using http range requests. Interrupted downloads resume where they left off the next time this is
+    called with the same arguments; servers that don't support range requests are downloaded in one stream.
+
+    Args:
+        url (str): The http or https url to download.
+        to (str): The file to download to. If this is a directory, the file is put inside it.
+        connections (int): Max number of parallel connections to use.
+        checksum (str): If given, the sha256 hexdigest the downloaded file must match. A mismatch raises a ChecksumError and discards the download.
+        chunk_size (int): Max size in bytes of the pieces that the file is split into.
+        max_tries (int): How many times to try each request before giving up.
+        timeout (int): Connection timeout in seconds.
+    Returns:
+        The path that the file was downloaded to.
+    """
+    to = os.path.expanduser(to)
+    if os.path.isdir(to) or to.endswith("/"):
+        to = os.path.join(to, _url_basename(url))
+    if os.path.dirname(to): os.makedirs(os.path.dirname(to), exist_ok=True)
+
+    partname = to + ".pyfra_part"
+    statename = to + ".pyfra_part.json"
+    pool = _ConnectionPool(timeout)
+
+    size, validator = _probe(pool, url, max_tries)
+    if size is None or size == 0:
+        _download_single(pool, url, partname, max_tries, bufsize)
+    else:
+        # small files are split up further so that every connection gets a piece
+        chunk_size = max(min(chunk_size, -(-size // connections)), 256 * 1024)
+        _download_ranges(pool, url, partname, statename, size, validator, connections, chunk_size, max_tries, bufsize)
+
+    if checksum is not None:
+        actual = _sha256_file(partname)
+        if actual != checksum.lower():
+            os.remove(partname)
+            if os.path.exists(statename): os.remove(statename)
+            raise ChecksumError(url, checksum, actual)
+
+    os.replace(partname, to)
+    if os.path.exists(statename): os.remove(statename)
+    return to
+
+
+def _url_basename(url):
+    return os.path.basename(urllib.parse.urlsplit(url).path) or "index"
+
+
+def curl_many(urls, dest=None, concurrency=16, max_tries=10, timeout=30, bufsize=1024 * 1024):
+    """
+    Download many urls concurrently. Connections are kept alive and reused for further requests to the same
+    host, at most concurrency requests are in flight at once, and failed requests are retried with backoff.
+    Errors never raise; instead, every url gets a :class:`CurlResult` describing what happened to it. Only urls that
+    would be saved to the same file raise a ValueError, before anything is downloaded.
+
+    Example usage: ::
+
+        results = curl_many(urls, dest="pages")
+        failed = [r.url for r in results if r.error is not None]
+
+    Args:
+        urls (Iterable[str]): The urls to fetch.
+        dest (str or Callable[[str], str]): A directory to stream the files into, named after the last part of the url path (which must be different for every url), or a function mapping each url to the file to save it to. If None, the contents are kept in memory and returned in each result's data field.
+        concurrency (int): Max number of requests in flight at once.
+        max_tries (int): How many times to try each url before giving up.
+        timeout (int): Connection timeout in seconds.
+    Returns:
+        A list of :class:`CurlResult`, in the same order as urls.
+    """
+    pool = _ConnectionPool(timeout)
+
+    def _path(url):
+        if dest is None:
+            return None
+        if callable(dest):
+            return os.path.expanduser(dest(url))
+        return os.path.join(os.path.expanduser(dest), _url_basename(url))
+
+    # urls saved to the same file would overwrite each other, and write to the same temp file while doing so
+    urls = list(urls)
+    paths = [_path(url) for url in urls]
+    seen = {}
+    for url, path in zip(urls, paths):
+        if path is None: continue
+        if path in seen:
+            raise ValueError(f"{seen[path]} and {url} would both be saved to {path}; pass a function as dest to give them different names")
+        seen[path] = url
+
+    def _fetch(url, path):
+        if path is not None and os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def _f():
+            with pool.open(url) as resp:
+                if path is None:
+                    return resp.status, resp.read()
+                with open(path + ".pyfra_part", "wb") as fh:
+                    for block in iter(lambda: resp.read(bufsize), b""):
+                        fh.write(block)
+                os.replace(path + ".pyfra_part", path)
+                return resp.status, None
+
+        try:
+            status, data = _with_retries(_f, max_tries)
+            return CurlResult(url, status, path, data, None)
+        except Exception as e:
+            if path is not None and os.path.exists(path + ".pyfra_part"): os.remove(path + ".pyfra_part")
+            return CurlResult(url, getattr(e, "code", None), path, None, e)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(_fetch, urls, paths))
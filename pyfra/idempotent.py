@@ -3,13 +3,25 @@
 
 from functools import partial, wraps
 import types
-from typing import Any, Callable, Dict, Type
+from typing import Any, Callable, Dict, List, Type
 import pyfra.remote
+import pyfra.shell
+import pyfra.state
 import abc
+import asyncio
+import hashlib
+import json
 import os
 import re
+import struct
+import sys
+import threading
 import time
+import uuid
 import dataclasses
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import blobfile as bf
@@ -21,6 +33,10 @@ import inspect
 
 
 class KVStoreProvider(abc.ABC):
+    # whether get and set can be called from several threads at once. If not, the default get_many and set_many
+    # go through the keys one at a time, and the default aget and aset take turns on the loop's executor
+    thread_safe = False
+
     @abc.abstractmethod
     def get(self, key: str):
         """
@@ -35,11 +51,77 @@ class KVStoreProvider(abc.ABC):
         """
         pass
 
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """
+        Get the values for many keys, leaving out keys that aren't set. By default the keys are looked up
+        concurrently on a few threads if the provider is thread_safe, and one at a time otherwise; providers can
+        override this with something better.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        if not self.thread_safe:
+            return {key: value for key in keys for value in [_get_or_missing(self, key)] if value is not _missing}
+        with ThreadPoolExecutor(max_workers=min(8, len(keys))) as pool:
+            values = list(pool.map(partial(_get_or_missing, self), keys))
+        return {key: value for key, value in zip(keys, values) if value is not _missing}
+
+    def set_many(self, items: Dict[str, Any]) -> None:
+        """
+        Set the values for many keys. By default they're set concurrently on a few threads if the provider is
+        thread_safe, and one at a time otherwise.
+        """
+        if not items:
+            return
+        if not self.thread_safe:
+            for key, value in items.items():
+                self.set(key, value)
+            return
+        with ThreadPoolExecutor(max_workers=min(8, len(items))) as pool:
+            list(pool.map(lambda item: self.set(*item), items.items()))
+
+    async def aget(self, key: str):
+        """
+        Get the value for a key without blocking the event loop. By default, get runs on the loop's executor.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self._serialized, self.get, key)
+
+    async def aset(self, key: str, value):
+        """
+        Set the value for a key without blocking the event loop. By default, set runs on the loop's executor.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self._serialized, self.set, key, value)
+
+    def _serialized(self, fn, *args):
+        """
+        Call fn, making calls for the same provider take turns unless it's thread_safe.
+
+        :meta private:
+        """
+        if self.thread_safe:
+            return fn(*args)
+        # made on first use, since subclasses don't call __init__
+        with self.__dict__.setdefault("_serialized_lock", threading.Lock()):
+            return fn(*args)
+
     def cache(self, key=None):
         return cache(key, kvstore=self, _callstackoffset=3)
 
 
+_missing = object()
+
+
+def _get_or_missing(kvstore, key):
+    try:
+        return kvstore.get(key)
+    except KeyError:
+        return _missing
+
+
 class LocalKVStore(KVStoreProvider):
+    # the state backends can be used from several threads
+    thread_safe = True
+
     def __init__(self):
         self.rem = pyfra.remote.Remote(wd=os.path.expanduser("~"))
 
@@ -49,12 +131,40 @@ class LocalKVStore(KVStoreProvider):
     def set(self, key: str, value):
         self.rem.set_kv(key, value)
 
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        # the state is already in memory, so threads would only add overhead
+        return {key: value for key in keys for value in [_get_or_missing(self, key)] if value is not _missing}
+
+    def set_many(self, items: Dict[str, Any]) -> None:
+        for key, value in items.items():
+            self.set(key, value)
+
 
 class BlobfileKVStore(KVStoreProvider):
-    def __init__(self, prefix):
+    """
+    Keeps each value as a pickle file under prefix, which can be anything blobfile supports, e.g. a GCS or
+    Azure bucket. Since blobfile only has blocking IO, batched and async operations run on a thread pool of
+    this store's own, sized for network latency rather than CPU count.
+
+    Args:
+        prefix (str): The directory to keep values in.
+        max_workers (int): Max number of concurrent reads or writes.
+    """
+    thread_safe = True
+
+    def __init__(self, prefix, max_workers=32):
         if prefix[-1] == "/":
             prefix = prefix[:-1]
         self.prefix = prefix
+        self.max_workers = max_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
     
     def get(self, key: str):
         try:
@@ -66,39 +176,446 @@ class BlobfileKVStore(KVStoreProvider):
         with bf.BlobFile(self.prefix + "/" + key, "wb") as f:
             pickle.dump(value, f)
 
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        values = self._pool().map(partial(_get_or_missing, self), keys)
+        return {key: value for key, value in zip(keys, values) if value is not _missing}
+
+    def set_many(self, items: Dict[str, Any]) -> None:
+        list(self._pool().map(lambda item: self.set(*item), items.items()))
+
+    async def aget(self, key: str):
+        return await asyncio.get_running_loop().run_in_executor(self._pool(), self.get, key)
+
+    async def aset(self, key: str, value):
+        await asyncio.get_running_loop().run_in_executor(self._pool(), self.set, key, value)
+
+
+class DirectoryKVStore(KVStoreProvider):
+    """
+    Keeps each value in a file of its own, named by a hash of its key and spread over two levels of 256 shard
+    directories, so that lookups and writes cost the same no matter how many values are stored. Values are
+    serialized with :func:`pyfra.state.encode_value`.
+
+    Writes go to a temp file next to the value's file and are renamed over it, so readers (including other
+    processes) see either the old value or the new one, never part of one.
+
+    Args:
+        root (str): The directory to keep values in. Defaults to the kvstore directory in pyfra's local cache.
+        fsync (bool): Flush each value to disk before renaming it into place (and the rename itself after), so that it survives a power loss and not just a crash. Makes writes a lot slower.
+    """
+    thread_safe = True
+
+    def __init__(self, root=None, fsync=False):
+        self.root = os.path.expanduser(root) if root is not None else pyfra.remote._local_cache_dir("kvstore")
+        self.fsync = fsync
+
+    def _fname(self, key: str) -> str:
+        digest = hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def get(self, key: str):
+        try:
+            with open(self._fname(key), "rb") as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+        return pyfra.state.decode_value(data)
+
+    def set(self, key: str, value):
+        fname = self._fname(key)
+        data = pyfra.state.encode_value(value)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+        tmpname = f"{fname}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmpname, "wb") as fh:
+                fh.write(data)
+                if self.fsync:
+                    fh.flush()
+                    os.fsync(fh.fileno())
+            os.replace(tmpname, fname)
+        except BaseException:
+            pyfra.shell.rm(tmpname)
+            raise
+
+        if self.fsync:
+            fd = os.open(os.path.dirname(fname), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class CompressedKVStore(KVStoreProvider):
+    """
+    Compresses values before handing them to another KVStoreProvider, e.g. a :class:`BlobfileKVStore`, which
+    stores plain pickles. Values are stored as bytes made by :func:`pyfra.state.encode_value`, which records the
+    codec in a header, so values written with one codec can still be read after switching to another. Values that
+    were stored before the wrapper was added are returned as they are.
+
+    Example usage: ::
+
+        set_kvstore(CompressedKVStore(BlobfileKVStore("gs://bucket/cache"), codec="zstd"))
+
+    Args:
+        inner (KVStoreProvider): The store to keep the compressed values in.
+        codec (str): One of "zlib", "lzma", "zstd" (needs the zstandard package) or "none".
+        min_size (int): Values that pickle to fewer bytes than this aren't compressed, since it wouldn't save much.
+    """
+    @property
+    def thread_safe(self):
+        return self.inner.thread_safe
+
+    def __init__(self, inner, codec="zlib", min_size=4096):
+        if codec not in pyfra.state._codecs:
+            raise ValueError(f"Unknown codec {codec}, must be one of {sorted(pyfra.state._codecs)}")
+        self.inner = inner
+        self.codec = codec
+        self.min_size = min_size
+
+    def _encode(self, value) -> bytes:
+        return pyfra.state.encode_value(value, compression=self.codec, min_compress_size=self.min_size)
+
+    def _decode(self, data):
+        if isinstance(data, (bytes, bytearray)) and data[:len(pyfra.state._VALUE_MAGIC)] == pyfra.state._VALUE_MAGIC:
+            return pyfra.state.decode_value(data)
+        return data
+
+    def get(self, key: str):
+        return self._decode(self.inner.get(key))
+
+    def set(self, key: str, value):
+        self.inner.set(key, self._encode(value))
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        return {key: self._decode(data) for key, data in self.inner.get_many(keys).items()}
+
+    def set_many(self, items: Dict[str, Any]) -> None:
+        self.inner.set_many({key: self._encode(value) for key, value in items.items()})
+
+    async def aget(self, key: str):
+        return self._decode(await self.inner.aget(key))
+
+    async def aset(self, key: str, value):
+        await self.inner.aset(key, self._encode(value))
+
+
+class MemoKVStore(KVStoreProvider):
+    """
+    An in-memory LRU tier in front of another KVStoreProvider, so that repeated lookups of the same key in the same
+    process don't have to go to storage again. Values set or fetched through it are kept until max_entries or
+    max_bytes is exceeded, dropping the least recently used ones first.
+
+    By default, values are kept pickled and unpickled on every lookup, so that callers can't change the memoized value
+    by mutating what they got back, just like with the underlying store. If cached results are never mutated, set
+    by_reference to hand out the same object every time instead, which makes lookups as fast as a dict lookup.
+
+    Example usage: ::
+
+        set_kvstore(MemoKVStore(pyfra.idempotent.LocalKVStore(), max_bytes=2**30))
+
+    Args:
+        inner (KVStoreProvider): The store to put the memo in front of.
+        max_entries (int): Max number of values to keep in memory.
+        max_bytes (int): Max total size of the values kept in memory, as pickled. With by_reference, values are pickled once when they're added just to measure them, unless this is None.
+        by_reference (bool): Return the memoized objects themselves rather than copies.
+    """
+    @property
+    def thread_safe(self):
+        return self.inner.thread_safe
+
+    def __init__(self, inner, max_entries=1024, max_bytes=None, by_reference=False):
+        self.inner = inner
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.by_reference = by_reference
+
+        self._memo = OrderedDict() # key -> (value or pickled value, size)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def _remember(self, key, value) -> None:
+        if self.by_reference:
+            size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)) if self.max_bytes is not None else 0
+        else:
+            value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            size = len(value)
+        with self._lock:
+            if key in self._memo:
+                self._nbytes -= self._memo.pop(key)[1]
+            # too big to keep, but the old value is still forgotten so that it isn't handed out instead of the new one
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._memo[key] = (value, size)
+            self._nbytes += size
+            while len(self._memo) > self.max_entries or (self.max_bytes is not None and self._nbytes > self.max_bytes):
+                self._nbytes -= self._memo.popitem(last=False)[1][1]
+
+    def get(self, key: str):
+        value = self._lookup(key)
+        if value is not _missing:
+            return value
+
+        value = self.inner.get(key)
+        self._remember(key, value)
+        return value
+
+    def set(self, key: str, value):
+        self.inner.set(key, value)
+        self._remember(key, value)
+
+    def _lookup(self, key: str):
+        with self._lock:
+            entry = self._memo.get(key)
+            if entry is None:
+                return _missing
+            self._memo.move_to_end(key)
+        return entry[0] if self.by_reference else pickle.loads(entry[0])
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        ret = {key: value for key in keys for value in [self._lookup(key)] if value is not _missing}
+        fetched = self.inner.get_many([key for key in keys if key not in ret])
+        for key, value in fetched.items():
+            self._remember(key, value)
+        ret.update(fetched)
+        return ret
+
+    def set_many(self, items: Dict[str, Any]) -> None:
+        self.inner.set_many(items)
+        for key, value in items.items():
+            self._remember(key, value)
+
+    async def aget(self, key: str):
+        value = self._lookup(key)
+        if value is not _missing:
+            return value
+        value = await self.inner.aget(key)
+        self._remember(key, value)
+        return value
+
+    async def aset(self, key: str, value):
+        await self.inner.aset(key, value)
+        self._remember(key, value)
+
+    def clear(self) -> None:
+        """ Forget everything held in memory """
+        with self._lock:
+            self._memo.clear()
+            self._nbytes = 0
+
 
 default_kvstore = LocalKVStore()
-special_hashing: Dict[Type, Callable[[Any], str]] = {}
+
+
+class _DispatchTable(MutableMapping):
+    """
+    A mapping of type -> hashing function that forgets which function each type resolved to whenever it's changed.
+    Every way of changing it goes through __setitem__ or __delitem__, so none of them can leave stale resolutions behind.
+    """
+    def __init__(self):
+        self._fns = {}
+
+    def __getitem__(self, key):
+        return self._fns[key]
+
+    def __setitem__(self, key, value):
+        self._fns[key] = value
+        _dispatch_cache.clear()
+
+    def __delitem__(self, key):
+        del self._fns[key]
+        _dispatch_cache.clear()
+
+    def __iter__(self):
+        return iter(self._fns)
+
+    def __len__(self):
+        return len(self._fns)
+
+    def __contains__(self, key):
+        return key in self._fns
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __repr__(self):
+        return repr(self._fns)
+
+
+# types mapped to a function that turns values of that type into something that is hashed in their place.
+# entries are found by walking the type's MRO, so they also apply to subclasses
+special_hashing: MutableMapping[Type, Callable[[Any], Any]] = _DispatchTable()
+_dispatch_cache: Dict[Type, Callable[[Any, Any], None]] = {}
 
 # some pyfra special hashing stuff
 special_hashing[pyfra.remote.RemotePath] = lambda x: x.quick_hash()
 special_hashing[pyfra.remote.Remote] = lambda x: x.hash
-special_hashing[list] = lambda x: list(map(_prepare_for_hash, x))
-special_hashing[dict] = lambda x: {_prepare_for_hash(k): _prepare_for_hash(v) for k, v in x.items()}
-special_hashing[tuple] = lambda x: tuple(map(_prepare_for_hash, x))
 special_hashing[types.FunctionType] = lambda x: x.__name__
 special_hashing[type] = lambda x: x.__name__
 
-try:
-    from pandas import DataFrame
-    special_hashing[DataFrame] = lambda x: x.to_json()
-except ImportError:
-    pass
 
 def set_kvstore(provider):
     global default_kvstore
     default_kvstore = provider
 
 
-def _prepare_for_hash(x):
-    if dataclasses.is_dataclass(x):
-        return dataclasses.asdict(x)
+def _feed_sized(h, tag, data):
+    h.update(tag + struct.pack("<Q", len(data)))
+    h.update(data)
+
 
-    for type_, fn in special_hashing.items():
-        if isinstance(x, type_):
-            return fn(x)
+# the repr of these is exact and can't be confused between them, so containers of nothing else are hashed by their repr
+_scalar_types = {type(None), bool, int, float, str}
 
-    return x
+
+def _feed_sequence(h, tag, x):
+    if set(map(type, x)) <= _scalar_types:
+        _feed_sized(h, tag + b"r", repr(x).encode("utf-8", "surrogatepass"))
+        return
+
+    h.update(tag + struct.pack("<Q", len(x)))
+    for item in x:
+        _feed(h, item)
+
+
+def _feed_dict(h, x):
+    if not set(map(type, x)) <= {str}:
+        # keys of mixed types can't be sorted
+        _feed_unordered(h, b"d", x.items())
+    elif set(map(type, x.values())) <= _scalar_types:
+        _feed_sized(h, b"dr", repr(sorted(x.items())).encode("utf-8", "surrogatepass"))
+    else:
+        h.update(b"ds" + struct.pack("<Q", len(x)))
+        for key in sorted(x):
+            _feed_sized(h, b"", key.encode("utf-8", "surrogatepass"))
+            _feed(h, x[key])
+
+
+def _feed_unordered(h, tag, items):
+    # each item is hashed by itself and the digests are sorted, so that the order doesn't matter
+    digests = sorted(_digest(item) for item in items)
+    h.update(tag + struct.pack("<Q", len(digests)))
+    h.update(b"".join(digests))
+
+
+def _feed_array(h, x):
+    import numpy as np
+
+    _feed_sized(h, b"a", f"{x.dtype.str} {x.dtype}".encode())
+    h.update(struct.pack(f"<Q{x.ndim}Q", x.ndim, *x.shape))
+    if x.dtype.hasobject:
+        _feed_sized(h, b"p", pickle.dumps(x))
+    else:
+        # viewed as bytes rather than through memoryview, which doesn't support e.g. datetime64
+        data = np.ascontiguousarray(x).view(np.uint8)
+        h.update(struct.pack("<Q", data.nbytes))
+        h.update(data)
+
+
+def _feed_numpy_scalar(h, x):
+    h.update(b"g" + x.dtype.str.encode() + b";")
+    _feed_sized(h, b"", x.tobytes())
+
+
+def _feed_dataclass(h, x):
+    h.update(b"D" + type(x).__qualname__.encode() + b";")
+    _feed_unordered(h, b"", ((field.name, getattr(x, field.name)) for field in dataclasses.fields(x)))
+
+
+def _feed_pandas(h, x):
+    import numpy as np
+    import pandas as pd
+
+    def values(arr):
+        # object columns go through pandas' vectorized hashing, everything else is hashed from its buffer
+        arr = np.asarray(arr)
+        return pd.util.hash_array(arr) if arr.dtype.hasobject else arr
+
+    h.update(b"P" + type(x).__name__.encode() + b";")
+    if isinstance(x, pd.DataFrame):
+        _feed(h, list(x.columns))
+        _feed_array(h, values(x.index))
+        for i in range(x.shape[1]):
+            _feed(h, str(x.dtypes.iloc[i]))
+            _feed_array(h, values(x.iloc[:, i]))
+    elif isinstance(x, pd.Series):
+        _feed(h, [x.name, str(x.dtype)])
+        _feed_array(h, values(x.index))
+        _feed_array(h, values(x))
+    else:
+        _feed(h, str(x.dtype))
+        _feed_array(h, values(x))
+
+
+def _feed_json(h, x):
+    # anything else is hashed by its json, the way it always has been
+    _feed_sized(h, b"j", json.dumps(x, sort_keys=True, cls=pyfra.remote._ObjectEncoder).encode())
+
+
+_feeders: Dict[Type, Callable[[Any, Any], None]] = {
+    type(None): lambda h, x: h.update(b"N"),
+    bool: lambda h, x: h.update(b"T" if x else b"F"),
+    int: lambda h, x: _feed_sized(h, b"i", str(x).encode()),
+    float: lambda h, x: h.update(b"f" + struct.pack("<d", x)),
+    str: lambda h, x: _feed_sized(h, b"s", x.encode("utf-8", "surrogatepass")),
+    bytes: lambda h, x: _feed_sized(h, b"b", x),
+    bytearray: lambda h, x: _feed_sized(h, b"b", x),
+    list: lambda h, x: _feed_sequence(h, b"l", x),
+    tuple: lambda h, x: _feed_sequence(h, b"t", x),
+    dict: _feed_dict,
+    set: lambda h, x: _feed_unordered(h, b"S", x),
+    frozenset: lambda h, x: _feed_unordered(h, b"S", x),
+}
+
+
+def _resolve(type_):
+    """ Find how to hash values of a type, going by the first class in its MRO that something is registered for """
+    for cls in type_.__mro__:
+        if cls in special_hashing:
+            fn = special_hashing[cls]
+            return lambda h, x: _feed(h, fn(x))
+        if cls in _feeders:
+            return _feeders[cls]
+
+    np = sys.modules.get("numpy")
+    if np is not None and issubclass(type_, np.ndarray):
+        return _feed_array
+    if np is not None and issubclass(type_, np.generic):
+        return _feed_numpy_scalar
+    if type_.__module__.split(".")[0] == "pandas" and any(cls.__name__ in ("DataFrame", "Series", "Index") for cls in type_.__mro__):
+        return _feed_pandas
+    if dataclasses.is_dataclass(type_):
+        return _feed_dataclass
+    return _feed_json
+
+
+def _feed(h, x):
+    type_ = type(x)
+    try:
+        fn = _dispatch_cache[type_]
+    except KeyError:
+        fn = _dispatch_cache[type_] = _resolve(type_)
+    fn(h, x)
+
+
+def _digest(x) -> bytes:
+    h = hashlib.blake2b(digest_size=32)
+    _feed(h, x)
+    return h.digest()
+
+
+def _hash_args(args, kwargs) -> str:
+    """
+    Hash the arguments of a cached function call. Values are streamed into a blake2b hash without building an
+    intermediate representation; arrays and DataFrames are hashed straight from their buffers. How each type is hashed
+    is looked up once per type, in :data:`special_hashing` and then the built in types, and cached.
+    """
+    h = hashlib.blake2b(digest_size=32)
+    _feed(h, list(args))
+    _feed(h, sorted(kwargs.items()))
+    return h.hexdigest()
 
 
 def update_source_cache(fname, lineno, new_key):
@@ -132,55 +649,79 @@ def cache(key=None, kvstore=None, *, _callstackoffset=2):
             global default_kvstore
             kvstore = default_kvstore
 
+        def _from_cache(ob):
+            ret = ob['ret']
+            original_awaitable = ob['awaitable']
+            original_was_coroutine = ob['iscoroutine']
+            current_is_coroutine = inspect.iscoroutinefunction(fn)
+
+            ## ASYNC HANDLING, resume from file
+
+            if original_was_coroutine and current_is_coroutine:
+                return_awaitable = True # coroutine -> coroutine
+            elif original_was_coroutine and not current_is_coroutine:
+                return_awaitable = False # coroutine -> normal
+            elif not original_was_coroutine and not original_awaitable and current_is_coroutine:
+                return_awaitable = True # normal -> coroutine
+            elif not original_was_coroutine and not original_awaitable and not current_is_coroutine:
+                return_awaitable = False # normal -> normal
+            elif not original_was_coroutine and original_awaitable and current_is_coroutine:
+                return_awaitable = True # normal_returning_awaitable -> coroutine
+            elif not original_was_coroutine and original_awaitable and not current_is_coroutine:
+                # this case is ambiguous! we can't know if the modifier function returns an awaitable or not
+                # without actually running the function, so we just assume it's an awaitable,
+                # since probably nothing changed.
+                return_awaitable = True # normal_returning_awaitable -> normal/normal_returning_awaitable
+            else:
+                return_awaitable = False # fallback - most likely this is a bug
+                print(f"WARNING: unknown change in async situation for {fn._name__}")
+
+            if return_awaitable:
+                async def _wrapper(ret):
+                    # wrap ret in a dummy async function
+                    return ret
+                
+                return _wrapper(ret)
+            else:
+                return ret
+
+        def _record(ret, awaitable, start_time, end_time):
+            return {
+                "ret": ret,
+                "awaitable": awaitable,
+                "iscoroutine": inspect.iscoroutinefunction(fn),
+                "start_time": start_time,
+                "end_time": end_time,
+            }
+
+        async def _fn_async(overall_input_hash, args, kwargs):
+            # coroutines look up and store their results without blocking the event loop
+            try:
+                ob = await kvstore.aget(overall_input_hash)
+            except KeyError:
+                start_time = time.time()
+                ret = await fn(*args, **kwargs)
+                await kvstore.aset(overall_input_hash, _record(ret, True, start_time, time.time()))
+                return ret
+
+            ret = _from_cache(ob)
+            return await ret if inspect.isawaitable(ret) else ret
+
         @wraps(fn)
         def _fn(*args, **kwargs):
             # execution gets here only after the function is called
 
-            arg_hash = pyfra.remote._hash_obs(
-                [_prepare_for_hash(i) for i in args],
-                [(_prepare_for_hash(k), _prepare_for_hash(v)) for k, v in list(sorted(kwargs.items()))],
-            )
+            arg_hash = _hash_args(args, kwargs)
 
             kwargs.pop(kwargs.pop("_pyfra_nonce_kwarg", "v"), None)
 
             overall_input_hash = key + "_" + arg_hash
 
+            if inspect.iscoroutinefunction(fn):
+                return _fn_async(overall_input_hash, args, kwargs)
+
             try:
                 ob = kvstore.get(overall_input_hash)
-                ret = ob['ret']
-                original_awaitable = ob['awaitable']
-                original_was_coroutine = ob['iscoroutine']
-                current_is_coroutine = inspect.iscoroutinefunction(fn)
-
-                ## ASYNC HANDLING, resume from file
-
-                if original_was_coroutine and current_is_coroutine:
-                    return_awaitable = True # coroutine -> coroutine
-                elif original_was_coroutine and not current_is_coroutine:
-                    return_awaitable = False # coroutine -> normal
-                elif not original_was_coroutine and not original_awaitable and current_is_coroutine:
-                    return_awaitable = True # normal -> coroutine
-                elif not original_was_coroutine and not original_awaitable and not current_is_coroutine:
-                    return_awaitable = False # normal -> normal
-                elif not original_was_coroutine and original_awaitable and current_is_coroutine:
-                    return_awaitable = True # normal_returning_awaitable -> coroutine
-                elif not original_was_coroutine and original_awaitable and not current_is_coroutine:
-                    # this case is ambiguous! we can't know if the modifier function returns an awaitable or not
-                    # without actually running the function, so we just assume it's an awaitable,
-                    # since probably nothing changed.
-                    return_awaitable = True # normal_returning_awaitable -> normal/normal_returning_awaitable
-                else:
-                    return_awaitable = False # fallback - most likely this is a bug
-                    print(f"WARNING: unknown change in async situation for {fn._name__}")
-
-                if return_awaitable:
-                    async def _wrapper(ret):
-                        # wrap ret in a dummy async function
-                        return ret
-                    
-                    return _wrapper(ret)
-                else:
-                    return ret
             except KeyError:
                 start_time = time.time()
                 ret = fn(*args, **kwargs)
@@ -194,25 +735,42 @@ def cache(key=None, kvstore=None, *, _callstackoffset=2):
                     async def _wrapper(ret):
                         # turn the original async function into a synchronous one and return a new async function
                         ret = await ret
-                        kvstore.set(overall_input_hash, {
-                            "ret": ret,
-                            "awaitable": True,
-                            "iscoroutine": inspect.iscoroutinefunction(fn),
-                            "start_time": start_time,
-                            "end_time": end_time,
-                        })
+                        await kvstore.aset(overall_input_hash, _record(ret, True, start_time, end_time))
                         return ret
                     
                     return _wrapper(ret)
                 else:
-                    kvstore.set(overall_input_hash, {
-                        "ret": ret,
-                        "awaitable": False,
-                        "iscoroutine": inspect.iscoroutinefunction(fn),
-                        "start_time": start_time,
-                        "end_time": end_time,
-                    })
+                    kvstore.set(overall_input_hash, _record(ret, False, start_time, end_time))
                     return ret
+
+            return _from_cache(ob)
+
+        def _map(inputs) -> list:
+            """
+            Call the function on each of inputs, like the builtin :code:`map`, but look up the cached results
+            for all of them in one batch with :meth:`KVStoreProvider.get_many`, and store the new ones with
+            :meth:`KVStoreProvider.set_many`.
+            """
+            assert not inspect.iscoroutinefunction(fn), "map isn't supported for coroutines, gather the calls instead"
+            inputs = list(inputs)
+            keys = [key + "_" + _hash_args((x,), {}) for x in inputs]
+            found = kvstore.get_many(list(dict.fromkeys(keys)))
+
+            ret, new = [], {}
+            for x, overall_input_hash in zip(inputs, keys):
+                if overall_input_hash in found:
+                    ret.append(_from_cache(found[overall_input_hash]))
+                elif overall_input_hash in new:
+                    ret.append(new[overall_input_hash]["ret"])
+                else:
+                    start_time = time.time()
+                    value = fn(x)
+                    new[overall_input_hash] = _record(value, False, start_time, time.time())
+                    ret.append(value)
+            kvstore.set_many(new)
+            return ret
+
+        _fn.map = _map
         return _fn
 
     if callable(key):
@@ -1,27 +1,40 @@
 from __future__ import annotations
 
-import base64
+import atexit
+import bz2
 import csv
+import gzip
 import hashlib
 import io
+import itertools
 import json
+import lzma
 import os
 import pathlib
 import pickle
 import random
+import shutil
+import sqlite3
+import stat
+import subprocess
+import sys
+import threading
+import time
 import uuid
 import inspect
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from functools import wraps
 from typing import *
 
-import imohash
 from colorama import Style
 from natsort import natsorted
 from yaspin import yaspin
 
+import pyfra._remote_helper
 import pyfra.shell
+import pyfra.state
 from pyfra.setup import install_pyenv
 
 from deprecation import deprecated
@@ -66,6 +79,28 @@ def _normalize_homedir(x):
     return x
 
 
+def _quote_path(x):
+    """ Shell-quote a path, but leave a leading ~ unquoted so that the shell still expands it """
+    if x == '~': return x
+    if x[:2] == '~/': return '~/' + pyfra.shell.quote(x[2:])
+    return pyfra.shell.quote(x)
+
+
+# buffer size used when streaming files to and from remotes
+_STREAM_BUFSIZE = 1024 * 1024
+
+
+class _HashingWriter:
+    """ Wraps a file handle so that everything written through it is also fed into a hash. """
+    def __init__(self, fh, h):
+        self.fh = fh
+        self.h = h
+
+    def write(self, s):
+        self.h.update(s.encode() if isinstance(s, str) else s)
+        return self.fh.write(s)
+
+
 class _ObjectEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, pyfra.remote.RemotePath):
@@ -75,6 +110,9 @@ class _ObjectEncoder(json.JSONEncoder):
             return None
         if hasattr(obj, "_to_json"):
             return obj._to_json()
+        np = sys.modules.get("numpy")
+        if np is not None and isinstance(obj, np.ndarray):
+            return _hash_array(obj)
         
         return super().default(obj)
 
@@ -85,6 +123,49 @@ def _hash_obs(*args):
     return arghash
 
 
+def _hash_array(arr) -> str:
+    """ Hash a numpy array straight from its raw buffer, without serializing it """
+    import numpy as np
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([str(arr.dtype), arr.shape]).encode())
+    if arr.dtype.hasobject:
+        h.update(pickle.dumps(arr))
+    else:
+        # viewed as bytes rather than through memoryview, which doesn't support e.g. datetime64
+        h.update(np.ascontiguousarray(arr).view(np.uint8))
+    return h.hexdigest()
+
+
+def _local_cache_dir(*parts) -> str:
+    """ A directory for pyfra's local caches. Can be moved by setting PYFRA_CACHE_DIR. """
+    path = os.path.join(os.path.expanduser(os.environ.get("PYFRA_CACHE_DIR", "~/.pyfra_cache")), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _array_cache_size() -> int:
+    """ Max total size of the local array cache used by np_load. Can be set with the PYFRA_ARRAY_CACHE_SIZE env var, in bytes; defaults to 10 GiB. """
+    return int(os.environ.get("PYFRA_ARRAY_CACHE_SIZE", 10 << 30))
+
+
+def _trim_cache(path, max_bytes, keep=()) -> None:
+    """ Delete the least recently used files in a local cache directory until they add up to at most max_bytes """
+    entries = []
+    for entry in os.scandir(path):
+        if entry.is_file() and not entry.name.startswith(".tmp."):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, fname in sorted(entries):
+        if total <= max_bytes: break
+        if fname in keep: continue
+        # arrays that are still memory-mapped stay readable after their file is removed
+        pyfra.shell.rm(fname)
+        total -= size
+
+
 def _print_skip_msg(envname, fn, hash):
     print(f"{Style.BRIGHT}[{envname.ljust(15)} {Style.DIM}§{Style.RESET_ALL}{Style.BRIGHT}{fn.rjust(10)}]{Style.RESET_ALL} Skipping {hash}")
 
@@ -128,6 +209,8 @@ def _mutates_state(hash_key=None):
                     self.set_kv(new_hash, ret)
                     return ret
                 except Exception as e: # this prevents the KeyError ending up in the stacktrace
+                    # make sure the steps before this one are saved, in case the process doesn't get to exit cleanly
+                    self._flush_state()
                     raise e from None
         return wrapper
     return _f
@@ -148,27 +231,139 @@ def always_rerun():
         finally:
             global_env_registry.always_rerun = False
 
+# state backends shared between Remotes, by (ip, wd, backend, durability)
+_state_registry = {}
+_state_registry_lock = threading.Lock()
+
 # remote stuff
 
-# global cache
-_remotepath_cache = {}
-_remotepath_modified_time = {}
+_COMPRESSION_EXTENSIONS = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+}
+
+
+def _infer_compression(fname):
+    for ext, compression in _COMPRESSION_EXTENSIONS.items():
+        if fname.endswith(ext): return compression
+    return None
+
+
+def _compressed_stream(fh, compression, mode):
+    """ Wrap a binary file object so that data is transparently (de)compressed """
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fh, mode=mode)
+    if compression == "bz2":
+        return bz2.BZ2File(fh, mode)
+    if compression == "xz":
+        return lzma.LZMAFile(fh, mode)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def _infer_column(values, numpy=False):
+    """ Convert a column of csv strings to ints or floats if every non-missing value parses as one """
+    missing = any(v is None or v == "" for v in values)
+
+    for type_ in [int, float]:
+        try:
+            converted = [type_(v) if v is not None and v != "" else None for v in values]
+            break
+        except ValueError:
+            pass
+    else:
+        type_ = str
+        converted = values
+
+    if not numpy:
+        return converted
+
+    import numpy as np
+    if type_ is str:
+        return np.array(converted, dtype=object if None in converted else str)
+    if type_ is int and not missing:
+        return np.array(converted, dtype=np.int64)
+    return np.array([np.nan if v is None else v for v in converted], dtype=np.float64)
+
+
+class _MetadataCache:
+    """
+    Remembers the results of expensive RemotePath functions like quick_hash and sha256sum in a sqlite
+    database under ~/.pyfra_cache, which is shared by all pyfra processes on this machine and survives between runs.
+
+    Entries are keyed by host, path and function, and are only used while the file's size and mtime still
+    match. An entry that was checked against the file less than ttl seconds ago is trusted without stat-ing
+    the file again, which saves a round trip for remote files; the default ttl of 0 always checks. Once there
+    are more than max_entries, the least recently used ones are evicted.
+    """
+    def __init__(self, ttl=0, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._sets_since_evict = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        if not hasattr(self._local, "conn"):
+            conn = sqlite3.connect(os.path.join(_local_cache_dir(), "metadata.sqlite"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (host TEXT, path TEXT, fn TEXT, size INTEGER, mtime_ns INTEGER, value TEXT, checked REAL, used REAL, PRIMARY KEY (host, path, fn))")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+            self._local.conn = conn
+        return self._local.conn
+
+    def get(self, host, path, fn, stat_fn):
+        """ Returns the cached value, or sentinel if there isn't a valid one. stat_fn is only called if needed. """
+        row = self._conn().execute("SELECT size, mtime_ns, value, checked FROM entries WHERE host = ? AND path = ? AND fn = ?", (host, path, fn)).fetchone()
+        if row is None: return sentinel
+
+        size, mtime_ns, value, checked = row
+        now = time.time()
+        if now - checked >= self.ttl:
+            st = stat_fn()
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns): return sentinel
+            checked = now
+
+        self._conn().execute("UPDATE entries SET checked = ?, used = ? WHERE host = ? AND path = ? AND fn = ?", (checked, now, host, path, fn))
+        return json.loads(value)
+
+    def set(self, host, path, fn, st, value) -> None:
+        now = time.time()
+        self._conn().execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (host, path, fn, st.st_size, st.st_mtime_ns, json.dumps(value), now, now))
+
+        self._sets_since_evict += 1
+        if self._sets_since_evict >= 1000:
+            self._sets_since_evict = 0
+            self._conn().execute("DELETE FROM entries WHERE used <= (SELECT used FROM entries ORDER BY used DESC LIMIT 1 OFFSET ?)", (self.max_entries,))
+
+
+_metadata_cache = _MetadataCache(ttl=float(os.environ.get("PYFRA_METADATA_TTL", 0)))
+
+
 def _cache(fn):
     """
-    Use as an annotation. Caches the response of the function and
-    check modification time on the file on every call.
+    Use as an annotation. Caches the response of the function in the persistent metadata cache,
+    which checks the size and modification time of the file before reusing a result.
+    Results for directories aren't cached, since their mtime doesn't change when a file inside them does.
     """
     @wraps(fn)
     def wrapper(self, *args, **kwargs):
-        modified_time = self.stat().st_mtime
-        hash = _hash_obs(fn.__name__, args, kwargs)
-        if hash not in _remotepath_cache or modified_time != _remotepath_modified_time[hash]:
-            ret = fn(self, *args, **kwargs)
-            _remotepath_cache[(self.remote.ip, self.fname, hash)] = ret
-            _remotepath_modified_time[(self.remote.ip, self.fname, hash)] = modified_time
+        key = _hash_obs(fn.__name__, args, kwargs)
+        host = self.remote.ip if self.remote.ip is not None else "localhost"
+
+        stats = []
+        def _stat():
+            if not stats: stats.append(self.stat())
+            return stats[0]
+
+        ret = _metadata_cache.get(host, self.fname, key, _stat)
+        if ret is not sentinel:
             return ret
-        else:
-            return _remotepath_cache[hash]
+
+        ret = fn(self, *args, **kwargs)
+        if not stat.S_ISDIR(_stat().st_mode):
+            _metadata_cache.set(host, self.fname, key, _stat(), ret)
+        return ret
     return wrapper
 
 
@@ -196,6 +391,15 @@ class RemotePath:
         # read csv
         print(rem.path("goose.csv").csvread())
 
+        # write and lazily read json lines, optionally compressed
+        rem.path("goose.jsonl.gz").jlwrite({"honk": i} for i in range(1000))
+        for ob in rem.path("goose.jsonl.gz").jlread():
+            print(ob)
+
+        # save and memory-map numpy arrays
+        rem.path("goose.npy").np_save(arr)
+        arr = rem.path("goose.npy").np_load()
+
         # copy stuff to/from remotes
         copy(rem1.path('goose.txt'), 'test1.txt')
         copy('test1.txt', rem2.path('goose.txt'))
@@ -220,10 +424,9 @@ class RemotePath:
         return f"RemotePath({json.dumps(self._to_json())})"
     
     def _set_cache(self, fn_name, value, *args, **kwargs):
-        modified_time = self.stat().st_mtime
-        hash = _hash_obs(fn_name, args, kwargs)
-        _remotepath_modified_time[(self.remote.ip, self.fname, hash)] = modified_time
-        _remotepath_cache[(self.remote.ip, self.fname, hash)] = value
+        st = self.stat()
+        if stat.S_ISDIR(st.st_mode): return
+        _metadata_cache.set(self.remote.ip if self.remote.ip is not None else "localhost", self.fname, _hash_obs(fn_name, args, kwargs), st, value)
 
     def read(self) -> str:
         """
@@ -251,7 +454,73 @@ class RemotePath:
 
         """
         self.remote.fwrite(self.fname, content, append)
-    
+
+    @contextmanager
+    def open(self, mode="r", encoding=None, newline=None, compression=None):
+        """
+        Open this file as a stream, like the builtin :code:`open`. For remote files the data is streamed
+        through ssh as it is read or written, so the file never has to fit in memory or go through a temp file.
+        Writes made this way are not tracked by Env state hashing.
+
+        Example usage: ::
+
+            with rem.path("goose.txt").open("w") as fh:
+                for i in range(1000000):
+                    fh.write(f"honk {i}\\n")
+
+        Args:
+            mode (str): One of "r", "w", "a", optionally followed by "b" for binary mode.
+            encoding (str): Text encoding for text mode. Defaults to utf-8.
+            newline (str): Same as the newline argument of the builtin :code:`open`.
+            compression (str): One of "gzip", "bz2", "xz", or "infer" to pick based on the file extension. Data is (de)compressed on this machine while streaming. Defaults to no compression.
+        """
+        binary = "b" in mode
+        kind = mode.replace("b", "").replace("t", "")
+        assert kind in ["r", "w", "a"], f"Unsupported mode {mode}"
+        if encoding is None and not binary: encoding = "utf-8"
+        if compression == "infer": compression = _infer_compression(self.fname)
+
+        proc = None
+        if self.remote.is_local():
+            if compression is None:
+                with open(os.path.expanduser(self.fname), mode, buffering=_STREAM_BUFSIZE, encoding=encoding, newline=newline) as fh:
+                    yield fh
+                return
+            raw = open(os.path.expanduser(self.fname), kind + "b", buffering=_STREAM_BUFSIZE)
+        elif kind == "r":
+            proc = pyfra.shell._popen(self.remote.ip, f"cat {_quote_path(self.fname)}", stdout=subprocess.PIPE, bufsize=_STREAM_BUFSIZE, additional_ssh_config=self.remote.additional_ssh_config)
+            raw = proc.stdout
+        else:
+            redirect = ">" if kind == "w" else ">>"
+            proc = pyfra.shell._popen(self.remote.ip, f"cat {redirect} {_quote_path(self.fname)}", stdin=subprocess.PIPE, bufsize=_STREAM_BUFSIZE, additional_ssh_config=self.remote.additional_ssh_config)
+            raw = proc.stdin
+
+        stream = _compressed_stream(raw, compression, kind + "b") if compression is not None else raw
+        fh = stream if binary else io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+        try:
+            yield fh
+
+            # a reader that stopped early leaves cat blocked on a full pipe, so it's killed rather than waited on
+            stopped_early = proc is not None and kind == "r" and raw.read(1) != b''
+
+            # closing the compressed stream writes its trailer, but leaves the underlying file open
+            fh.close()
+            raw.close()
+
+            if proc is not None:
+                if stopped_early:
+                    proc.kill()
+                proc.wait()
+                if not stopped_early and proc.returncode != 0:
+                    raise pyfra.shell.ShellException(proc.returncode, rem=True)
+        except BaseException:
+            if proc is not None:
+                proc.kill()
+                proc.wait()
+            else:
+                raw.close()
+            raise
+
     def jread(self) -> Dict[str, Any]:
         """
         Read the contents of this json file and parses it. Equivalent to :code:`json.loads(self.read())`
@@ -268,52 +537,229 @@ class RemotePath:
         """
         self.write(json.dumps(content))
 
-    def csvread(self, colnames=None) -> List[dict]:
+    def jlread(self, compression="infer") -> Iterator[Any]:
         """
-        Read the contents of this csv file and parses it into an array of dictionaries where the keys are column names.
+        Lazily read the records of this json lines file, one json object per line. The file is decoded
+        from a stream as it is iterated over, so it never has to fit in memory.
+
+        Args:
+            compression (str): Compression of the file; see :meth:`open`. By default inferred from the extension, e.g. :code:`.jsonl.gz`.
+        """
+        with self.open("r", compression=compression) as fh:
+            for line in fh:
+                if line.strip():
+                    yield json.loads(line)
+
+    def jlwrite(self, data, append=False, compression="infer", batch_size=1024):
+        """
+        Write an iterable of json objects to this file, one per line. Records are encoded and written out in
+        batches as they are produced, so data can be a generator that is far too large to fit in memory.
+
+        Args:
+            data (Iterable[json]): The json objects to write.
+            append (bool): Whether to append to or overwrite the file.
+            compression (str): Compression of the file; see :meth:`open`. By default inferred from the extension, e.g. :code:`.jsonl.gz`.
+            batch_size (int): Number of records to encode per write.
+        """
+        data = iter(data)
+
+        def _write(fh):
+            while True:
+                batch = "".join(json.dumps(ob) + "\n" for ob in itertools.islice(data, batch_size))
+                if not batch: break
+                fh.write(batch)
+
+        # goes through the remote so that writes to an Env are tracked in its state like fwrite
+        self.remote._fwrite_stream(self.fname, _write, append=append, name="jlwrite", compression=compression)
+
+    def csvread(self, colnames=None, usecols=None, columns=None) -> Union[Iterator[dict], Dict[str, Any]]:
+        """
+        Read the contents of this csv file and parses it into an iterator of dictionaries where the keys are column names.
+        The file is streamed and parsed incrementally, so it never has to fit in memory.
+
+        Example usage: ::
+
+            # stream rows
+            for row in rem.path("goose.tsv").csvread(usecols=["id", "score"]):
+                print(row["score"])
+
+            # load two columns as numpy arrays
+            cols = rem.path("goose.tsv").csvread(usecols=["id", "score"], columns="numpy")
+            print(cols["score"].mean())
 
         Args:
             colnames (list): Optionally specify the names of the columns for csvs without a header row.
+            usecols (list): Only keep these columns, given as column names or integer indices. Other columns are skipped while parsing.
+            columns (str): If "list" or "numpy", return a dict mapping each column name to a list or numpy array of all the values in that column instead of an iterator of rows. Columns where every value parses as an int or float are converted to that type; missing values become None in lists and nan in numpy arrays.
         """
-        fh = io.StringIO(self.read())
-        if self.fname[-4:] == ".tsv":
-            rdr = csv.reader(fh, delimiter="\t")
-        else:
-            rdr = csv.reader(fh)
+        assert columns in [None, "list", "numpy"], f"Unknown columns mode {columns}"
 
-        if colnames:
-            cols = colnames
-        else:
-            cols = list(next(rdr))
-        
-        for ob in rdr:
-            yield {
-                k: v for k, v in zip(cols, [*ob, *[None for _ in range(len(cols) - len(ob))]])
-            }
-    
-    def csvwrite(self, data, colnames=None):
+        if columns is None:
+            return self._csvrows(colnames, usecols)
+
+        cols = None
+        values = None
+        for cols, row in self._csvrows(colnames, usecols, as_lists=True):
+            if values is None: values = [[] for _ in cols]
+            for vals, v in zip(values, row):
+                vals.append(v)
+
+        if cols is None:
+            return {}
+
+        return {
+            k: _infer_column(vals, numpy=columns == "numpy") for k, vals in zip(cols, values)
+        }
+
+    def _csvrows(self, colnames=None, usecols=None, as_lists=False):
+        with self.open("r", newline="") as fh:
+            if self.fname[-4:] == ".tsv":
+                rdr = csv.reader(fh, delimiter="\t")
+            else:
+                rdr = csv.reader(fh)
+
+            if colnames:
+                cols = list(colnames)
+            else:
+                cols = list(next(rdr, []))
+
+            inds = list(range(len(cols)))
+            if usecols is not None:
+                inds = [c if isinstance(c, int) else cols.index(c) for c in usecols]
+                cols = [cols[i] for i in inds]
+
+            for ob in rdr:
+                # missing trailing values are filled with None
+                row = [ob[i] if i < len(ob) else None for i in inds]
+                if as_lists:
+                    yield cols, row
+                else:
+                    yield dict(zip(cols, row))
+
+    def csvwrite(self, data, colnames=None, append=False):
         """
-        Write a list of dicts object to this csv file.
+        Write an iterable of dicts to this csv file. Rows are streamed out in buffered chunks as they are produced, so
+        data can be a generator that is far too large to fit in memory.
 
         Args:
-            content (List[dict]): A list of dicts where the keys are column names. Every dicts should have the exact same keys.
+            data (Iterable[dict]): Dicts where the keys are column names. Every dict should have the same keys.
+            colnames (list): The columns to write, in order. Defaults to the keys of the first row.
+            append (bool): Whether to append to or overwrite the file. When appending, the header row is only written if the file is empty or doesn't exist yet.
 
         """
-        fh = io.StringIO()
+        rows = iter(data)
         if colnames is None:
-            colnames = data[0].keys()
+            first = next(rows, None)
+            colnames = list(first.keys()) if first is not None else []
+            if first is not None: rows = itertools.chain([first], rows)
+        colnames = list(colnames)
 
-        wtr = csv.writer(fh)
-        wtr.writerow(colnames)
+        keys = set(colnames)
 
-        for dat in data:
-            assert dat.keys() == colnames
+        def _row(dat):
+            assert dat.keys() == keys, f"Row has keys {list(dat.keys())}, expected {colnames}"
+            return [dat[k] for k in colnames]
 
-            wtr.writerow([dat[k] for k in colnames])
-        
-        fh.seek(0)
-        self.write(fh.read())
+        write_header = not append or not self.exists() or self.stat().st_size == 0
+
+        def _write(fh):
+            if self.fname[-4:] == ".tsv":
+                wtr = csv.writer(fh, delimiter="\t")
+            else:
+                wtr = csv.writer(fh)
+
+            if write_header: wtr.writerow(colnames)
+            wtr.writerows(_row(dat) for dat in rows)
+
+        # goes through the remote so that writes to an Env are tracked in its state like fwrite
+        self.remote._fwrite_stream(self.fname, _write, append=append, name="csvwrite", newline="")
     
+    def np_save(self, arr) -> str:
+        """
+        Save a numpy array to this file. If the file name ends with :code:`.npz`, arr can also be a dict
+        of arrays, which are saved with :code:`numpy.savez`. Remote files are written to a local temp file
+        first, which is removed again once it has been copied over.
+
+        Args:
+            arr (numpy.ndarray or Dict[str, numpy.ndarray]): The array(s) to save
+
+        Returns:
+            A hash of the array contents, computed from the raw array buffers.
+        """
+        import numpy as np
+
+        if isinstance(arr, dict):
+            assert self.fname.endswith(".npz"), "Dicts of arrays can only be saved to .npz files"
+            arrhash = _hash_obs(sorted((k, _hash_array(v)) for k, v in arr.items()))[:32]
+            save = lambda fh: np.savez(fh, **arr)
+        elif self.fname.endswith(".npz"):
+            arrhash = _hash_obs([("arr_0", _hash_array(arr))])[:32]
+            save = lambda fh: np.savez(fh, arr)
+        else:
+            arrhash = _hash_array(arr)
+            save = lambda fh: np.save(fh, arr)
+
+        # state tracking, keyed by the array hash so that writes to an Env are skipped on resume like fwrite
+        needs_set_kv = False
+        if not self.remote._no_hash:
+            assert self.fname.startswith(self.remote.wd)
+            new_hash = self.remote.update_hash("np_save", self.fname[len(self.remote.wd):], arrhash)
+            try:
+                self.remote.get_kv(new_hash)
+                _print_skip_msg(self.remote.envname, "np_save", new_hash)
+                return arrhash
+            except KeyError:
+                needs_set_kv = True
+
+        with self.remote.no_hash():
+            if self.remote.is_local():
+                with open(os.path.expanduser(self.fname), "wb") as fh:
+                    save(fh)
+            else:
+                tmpname = os.path.join(_local_cache_dir("arrays"), f".tmp.{uuid.uuid4().hex}")
+                try:
+                    with open(tmpname, "wb") as fh:
+                        save(fh)
+                    pyfra.shell.copy(tmpname, self, quiet=True)
+                finally:
+                    pyfra.shell.rm(tmpname)
+
+        if needs_set_kv:
+            self.remote.set_kv(new_hash, None)
+        return arrhash
+
+    def np_load(self, mmap_mode="r"):
+        """
+        Load a numpy array saved with :meth:`np_save` or :code:`numpy.save`. Local files are memory-mapped
+        in place. Remote files are streamed into the local array cache once, keyed by their :meth:`quick_hash`,
+        and then memory-mapped from there. The least recently loaded arrays are dropped from the cache once it
+        grows past PYFRA_ARRAY_CACHE_SIZE bytes (10 GiB by default). :code:`.npz` files are returned as a lazily
+        loaded :code:`NpzFile`.
+
+        Args:
+            mmap_mode (str): Passed to :code:`numpy.load`. Set to None to read the whole array into memory.
+        """
+        import numpy as np
+
+        if self.remote.is_local():
+            return np.load(os.path.expanduser(self.fname), mmap_mode=mmap_mode)
+
+        cached = os.path.join(_local_cache_dir("arrays"), self.quick_hash() + os.path.splitext(self.fname)[1])
+        if os.path.exists(cached):
+            # the mtime is when it was last used, which is what the cache is trimmed by
+            os.utime(cached)
+        else:
+            tmpname = os.path.join(_local_cache_dir("arrays"), f".tmp.{uuid.uuid4().hex}")
+            try:
+                with self.open("rb") as src, open(tmpname, "wb") as dst:
+                    shutil.copyfileobj(src, dst, _STREAM_BUFSIZE)
+                os.replace(tmpname, cached)
+            finally:
+                pyfra.shell.rm(tmpname)
+            _trim_cache(_local_cache_dir("arrays"), _array_cache_size(), keep=[cached])
+
+        return np.load(cached, mmap_mode=mmap_mode)
+
     def _remote_payload(self, name, *args, **kwargs):
         """
         Run an arbitrary Path.* function remotely and return the result.
@@ -335,8 +781,14 @@ class RemotePath:
         """
         Stat a remote file
         """
+        if self.remote.is_local():
+            return os.stat(os.path.expanduser(self.fname))
+
+        # the plain stat tuple only has whole seconds, so the float and ns times are sent along too
+        payload = f"import os,json; s = os.stat(os.path.expanduser({repr(self.fname)})); print(json.dumps([*s, s.st_atime, s.st_mtime, s.st_ctime, s.st_atime_ns, s.st_mtime_ns, s.st_ctime_ns]))"
         with self.remote.no_hash():
-            return os.stat_result(self._remote_payload("stat"))
+            ret = self.remote.sh(f"python -c {payload | pyfra.shell.quote}", quiet=True, no_venv=True, pyenv_version=None)
+        return os.stat_result(json.loads(ret))
     
     def exists(self) -> bool:
         """
@@ -401,10 +853,12 @@ class RemotePath:
     @_cache
     def sha256sum(self) -> str:
         """
-        Return the sha256sum of this file.
+        Return the sha256sum of this file. To hash many files on the same remote, :meth:`Remote.sha256sum_many` is much faster.
         """
-        with self.remote.no_hash():
-            return self.remote.sh(f"sha256sum {self.fname}", quiet=True).split(" ")[0]
+        ret, = self.remote.sha256sum_many([self])
+        if ret is None:
+            raise FileNotFoundError(f"{self} does not exist")
+        return ret
 
     @_cache
     def quick_hash(self) -> str:
@@ -414,35 +868,57 @@ class RemotePath:
         Really useful for getting a quick hash of a really big file, but obviously
         unsuitable for guaranteeing file integrity.
 
-        Uses imohash under the hood.
+        Compatible with imohash. Remotes only need python 3 for this; nothing gets installed on them.
+        To hash many paths on the same remote, :meth:`Remote.quick_hash_many` is much faster.
         """
         if self.remote.is_local():
             return pyfra.shell.quick_hash(self.fname)
-        else:
-            # TODO: use paramiko
-            # TODO: make faster by not trying to install every time
-            payload = f"""
-import json,os,pathlib
-import pyfra.shell
+        
+        ret, = self.remote.quick_hash_many([self])
+        if ret is None:
+            raise FileNotFoundError(f"{self} does not exist")
+        return ret
 
-print(pyfra.shell.quick_hash(pathlib.Path(os.path.expanduser({repr(self.fname)}))))
-            """.strip()
+    def merkle_tree(self) -> Optional[dict]:
+        """
+        Get a hash tree of this directory, as nested dicts of the form :code:`{"hash": ..., "files": {name: hash}, "dirs": {name: subtree}}`.
+        The hash of every directory in the tree is the same as its :meth:`quick_hash`, and is computed on the
+        machine the directory is on, reusing the same per-file manifest as quick_hash. Returns None if this isn't a directory.
+        """
+        manifest_dir = _local_cache_dir("quick_hash") if self.remote.is_local() else "~/.pyfra_cache/quick_hash"
+        return self.remote._helper("merkle_tree", path=self.fname, manifest_dir=manifest_dir)
 
-            with self.remote.no_hash():
-                ret = self.remote.sh(f"[ -f ~/.pyfra_imohash ] || ( python -m pip --help > /dev/null 2>&1 || sudo apt-get install python3-pip -y > /dev/null 2>&1; python -m pip install imohash 'pyfra>=0.3.0rc5' > /dev/null 2>&1; touch ~/.pyfra_imohash ); python -c {payload | pyfra.shell.quote}", no_venv=True, pyenv_version=None, quiet=True).strip()
+    def diff(self, other: RemotePath) -> Optional[List[str]]:
+        """
+        Compare this directory against another one, which may be on a different machine. Both sides are hashed
+        concurrently, and only the hashes are sent around, not the files.
+
+        Example usage: ::
 
-            assert all(x in "0123456789abcdef" for x in ret[:32])
-            return ret[:32]
+            rem1.path("dataset").diff(rem2.path("dataset"))
+            # ['shards/00017.jsonl', 'tokenizer']
+
+        Returns:
+            Relative paths of the topmost files and subdirectories in this directory that are missing or different in other,
+            [] if other already has everything in this directory, or None if either one isn't a directory.
+        """
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            src_tree, dst_tree = executor.map(lambda p: p.merkle_tree(), [self, other])
+        if src_tree is None or dst_tree is None:
+            return None
+        return pyfra._remote_helper.merkle_diff(src_tree, dst_tree)
             
 
 class Remote:
-    def __init__(self, ip=None, wd=None, experiment=None, resumable=False, additional_ssh_config=""):
+    def __init__(self, ip=None, wd=None, experiment=None, resumable=False, additional_ssh_config="", state_backend=None, state_durability=None):
         """
         Args:
             ip (str): The host to ssh to. This looks something like :code:`12.34.56.78` or :code:`goose.com` or :code:`someuser@12.34.56.78` or :code:`someuser@goose.com`. You must enable passwordless ssh and have your ssh key added to the server first. If None, the Remote represents localhost.
             wd (str): The working directory on the server to start out on.
             python_version (str): The version of python to use (i.e running :code:`Remote("goose.com", python_version="3.8.10").sh("python --version")` will use python 3.8.10). If this version is not already installed, pyfra will install it.
             resumable (bool): If True, this Remote will resume where it left off, with the same semantics as Env.
+            state_backend (str or Type[StateBackend]): Where to keep the state used for resuming: "journal" for an append-only file, "sqlite" for an SQLite database, or a :class:`pyfra.state.StateBackend` subclass. Defaults to the PYFRA_STATE_BACKEND environment variable, or "journal" if that isn't set.
+            state_durability (str): "batch" to write state out in the background every few steps or seconds (see :class:`pyfra.state.WriteBehindState`), so that steps don't wait on it, or "step" to write it before each step returns. Defaults to the PYFRA_STATE_DURABILITY environment variable, or "batch" if that isn't set.
         """
         if ip in ["127.0.0.1", "localhost"]: ip = None
 
@@ -455,22 +931,25 @@ class Remote:
 
         self._home = None
         self._no_hash = not resumable
-        self._kv_cache = None
+        self.state_backend = state_backend
+        self.state_durability = state_durability
 
         self.hash = self._hash(None)
         self.envname = ""
+        # the hash each hash came from, which is stored along with the step's result for collect_garbage
+        self._hash_parents = {}
 
         self.additional_ssh_config = additional_ssh_config
         
         if resumable:
             global_env_registry.register(self)
 
-    def env(self, envname, git=None, branch=None, force_rerun=False, python_version="3.9.4") -> Remote:
+    def env(self, envname, git=None, branch=None, force_rerun=False, python_version="3.9.4", state_backend=None, state_durability=None) -> Remote:
         """
         Arguments are the same as the :class:`pyfra.experiment.Experiment` constructor.
         """
 
-        return Env(ip=self.ip, envname=envname, git=git, branch=branch, force_rerun=force_rerun, python_version=python_version, additional_ssh_config=self.additional_ssh_config)
+        return Env(ip=self.ip, envname=envname, git=git, branch=branch, force_rerun=force_rerun, python_version=python_version, additional_ssh_config=self.additional_ssh_config, state_backend=state_backend, state_durability=state_durability)
 
     @_mutates_state()
     def sh(self, x, quiet=False, wrap=True, maxbuflen=1000000000, ignore_errors=False, no_venv=False, pyenv_version=None, forward_keys=False):
@@ -485,6 +964,63 @@ class Remote:
         except pyfra.shell.ShellException as e:  # this makes the stacktrace easier to read
             raise pyfra.shell.ShellException(e.returncode, rem=not self.is_local()) from e.__cause__
     
+    def _helper(self, op, **kwargs):
+        """
+        Run one of the operations in :mod:`pyfra._remote_helper` on this remote and return its result.
+        The helper's source is sent along with the command, so the remote only needs python 3. The
+        arguments go through stdin, so they can be much larger than what fits on a command line.
+
+        :meta private:
+        """
+        if self.is_local():
+            return pyfra._remote_helper.run(op, **kwargs)
+
+        payload = inspect.getsource(pyfra._remote_helper) + "\nmain(sys.stdin.read())\n"
+        proc = pyfra.shell._popen(self.ip, f"python3 -c {payload | pyfra.shell.quote}", stdin=subprocess.PIPE, stdout=subprocess.PIPE, additional_ssh_config=self.additional_ssh_config)
+        out, _ = proc.communicate(json.dumps(dict(op=op, **kwargs)).encode())
+        if proc.returncode != 0:
+            raise pyfra.shell.ShellException(proc.returncode, rem=True)
+
+        return json.loads(out.decode().strip().split("\n")[-1])
+
+    def quick_hash_many(self, paths, max_workers=16) -> List[Optional[str]]:
+        """
+        Get the :meth:`RemotePath.quick_hash` of many files or directories on this remote at once. All of them
+        are hashed in parallel by a single process on the remote, rather than paying for an ssh connection per path.
+
+        Args:
+            paths (List[str or RemotePath]): The files or directories to hash.
+            max_workers (int): Max number of files to hash at once.
+        Returns:
+            A list of hashes in the same order as paths, with None for paths that don't exist.
+        """
+        manifest_dir = _local_cache_dir("quick_hash") if self.is_local() else "~/.pyfra_cache/quick_hash"
+        return self._helper_many("quick_hash_many", paths, manifest_dir=manifest_dir, max_workers=max_workers)
+
+    def sha256sum_many(self, paths, max_workers=16) -> List[Union[str, Dict[str, str], None]]:
+        """
+        Get the sha256sum of many files or directories on this remote at once. Everything is read and hashed
+        in parallel by a single process on the remote, with one ssh round trip in total.
+
+        Args:
+            paths (List[str or RemotePath]): The files or directories to hash.
+            max_workers (int): Max number of files to hash at once.
+        Returns:
+            A list in the same order as paths, with the hexdigest for files, a dict mapping relative path to
+            hexdigest for every file inside directories, or None for paths that don't exist.
+        """
+        return self._helper_many("sha256_many", paths, max_workers=max_workers)
+
+    def _helper_many(self, op, paths, **kwargs):
+        """
+        Run a helper operation that takes a list of paths, returning its results in the same order.
+
+        :meta private:
+        """
+        fnames = [p.fname if isinstance(p, RemotePath) else self.path(p).fname for p in paths]
+        results = self._helper(op, paths=fnames, **kwargs)
+        return [results[fname] for fname in fnames]
+
     def path(self, fname=None) -> RemotePath:
         """
         This is the main way to make a :class:`RemotePath` object; see RemotePath docs for more info on what they're used for.
@@ -595,33 +1131,75 @@ class Remote:
         if needs_set_kv:
             self.set_kv(new_hash, None)
 
+    def _fwrite_stream(self, fname, write, append=False, name="fwrite", **kwargs) -> None:
+        """
+        Like :meth:`fwrite`, but the content is streamed by calling write with a file handle rather than passed in
+        as one string. Since the content isn't known until it has been written, it goes to a temp file next to fname
+        first, and is only moved into place if the Env hash of its contents isn't in the state yet. kwargs are
+        passed to :meth:`RemotePath.open`.
+
+        :meta private:
+        """
+        mode = "a" if append else "w"
+        # inferred from fname, since the temp file's name doesn't end with the extension
+        if kwargs.get("compression") == "infer": kwargs["compression"] = _infer_compression(fname)
+        if self._no_hash:
+            with self.path(fname).open(mode, **kwargs) as fh:
+                write(fh)
+            return
+
+        assert fname.startswith(self.wd)
+        fname_suffix = fname[len(self.wd):]
+        tmp = f"{fname}.pyfra_part.{uuid.uuid4().hex}"
+        h = hashlib.sha256()
+        with self.no_hash():
+            try:
+                with self.path(tmp).open("w", **kwargs) as fh:
+                    write(_HashingWriter(fh, h))
+            except BaseException:
+                self.rm(tmp)
+                raise
+
+        new_hash = self.update_hash(name, fname_suffix, h.hexdigest(), append)
+        try:
+            self.get_kv(new_hash)
+            _print_skip_msg(self.envname, name, new_hash)
+            with self.no_hash():
+                self.rm(tmp)
+            return
+        except KeyError:
+            pass
+
+        with self.no_hash():
+            if self.is_local():
+                if append:
+                    with open(os.path.expanduser(tmp), "rb") as src, open(os.path.expanduser(fname), "ab") as dst:
+                        shutil.copyfileobj(src, dst, _STREAM_BUFSIZE)
+                    os.remove(os.path.expanduser(tmp))
+                else:
+                    os.replace(os.path.expanduser(tmp), os.path.expanduser(fname))
+            else:
+                move = f"cat {_quote_path(tmp)} >> {_quote_path(fname)} && rm {_quote_path(tmp)}" if append else f"mv {_quote_path(tmp)} {_quote_path(fname)}"
+                self.sh(move, quiet=True)
+
+        self.set_kv(new_hash, None)
+
     # key-value store for convienence
 
     def set_kv(self, key: str, value: Any) -> None:
         """
         A key value store to keep track of stuff in this env. The data is stored in the env
-        on the remote. Current implementation is inefficient (linear time, and the entire json 
-        file is moved each time) but there shouldn't be a lot of data stored in it anyways
-        (premature optimization is bad), and if we need to store a lot of data in the future 
-        we can always make this more efficient without changing the interface.
+        on the remote, using the state_backend this Remote was created with (see :mod:`pyfra.state`).
+        Each call only writes the new value rather than the whole store. Values are serialized
+        with :func:`pyfra.state.encode_value`, and big ones are kept in a :class:`pyfra.state.BlobStore`.
         
         :meta private:
         """
         with self.no_hash():
-            # TODO: make more efficient
-            statefile = self.path(".pyfra_env_state.json")
-            if self._kv_cache is None:
-                if statefile.exists():
-                    ob = statefile.jread()
-                else:
-                    ob = {}
-                self._kv_cache = ob
-            pickled_value = base64.b64encode(pickle.dumps(value)).decode()
-            self._kv_cache[key] = pickled_value
-
-            # for backwards compat if we ever change the encoding format
-            self._kv_cache[key + "_format"] = "b64"
-            statefile.jwrite(self._kv_cache)
+            data = pyfra.state.encode_value(value)
+            if len(data) >= pyfra.state.BlobStore.threshold():
+                data = pyfra.state.BlobStore(self).put(data)
+            self._state().set(key, pyfra.state.pack_entry(data, parent=self._hash_parents.get(key)))
 
     def get_kv(self, key: str) -> Any:
         """
@@ -630,26 +1208,94 @@ class Remote:
         :meta private:
         """
         with self.no_hash():
-            # TODO: make more efficient
-            if self._kv_cache is None:
-                statefile = self.path(".pyfra_env_state.json")
-                if statefile.exists():
-                    ob = statefile.jread()
-                else:
-                    ob = {}
-                self._kv_cache = ob
+            data, ts, parent = pyfra.state.unpack_entry(self._state().get(key))
+            # so that collect_garbage sees that the entry is still being used
+            if pyfra.state.needs_refresh(ts):
+                self._state().set(key, pyfra.state.pack_entry(data, parent=parent))
+            if pyfra.state.BlobStore.is_ref(data):
+                data = pyfra.state.BlobStore(self).get(data)
+            return pyfra.state.decode_value(data)
+
+    def _state(self) -> pyfra.state.StateBackend:
+        """
+        :meta private:
+        """
+        backend = self.state_backend or os.environ.get("PYFRA_STATE_BACKEND", "journal")
+        if isinstance(backend, str): backend = pyfra.state.state_backends[backend]
+        durability = self.state_durability or os.environ.get("PYFRA_STATE_DURABILITY", "batch")
+        assert durability in ["batch", "step"], f"Unknown state durability {durability}"
+
+        # Remotes pointing at the same place share their state, so that none of them miss what the others wrote
+        key = (self.ip, self.wd, backend, durability)
+        with _state_registry_lock:
+            if key not in _state_registry:
+                state = backend(self)
+                _state_registry[key] = pyfra.state.WriteBehindState(state) if durability == "batch" else state
+            return _state_registry[key]
+
+    def _open_states(self) -> List[pyfra.state.StateBackend]:
+        """
+        :meta private:
+        """
+        with _state_registry_lock:
+            return [state for key, state in _state_registry.items() if key[:2] == (self.ip, self.wd)]
+
+    def _flush_state(self) -> None:
+        """
+        :meta private:
+        """
+        for state in self._open_states():
+            try:
+                state.flush()
+            except Exception as e:
+                print(f"WARNING: couldn't save env state: {e}")
+
+    def close(self) -> None:
+        """
+        Write out any state that's still waiting to be written. State is also written out automatically
+        at exit, so this is only needed to be sure it's saved at a particular point. The state is read
+        again the next time it's needed.
+        """
+        with _state_registry_lock:
+            states = [_state_registry.pop(key) for key in list(_state_registry) if key[:2] == (self.ip, self.wd)]
+        for state in states:
+            state.close()
+
+    def gc_state(self, max_age=30 * 86400, max_entries=None, max_kv_age=None, dry_run=False) -> Dict[str, int]:
+        """
+        Drop the state entries of steps that won't be reached anymore, e.g. because the script was edited, and compact
+        the state. The chains of all envs at this location in this process are kept. See :func:`pyfra.state.collect_garbage`
+        for what the arguments mean.
+        """
+        heads = [env.hash for env in global_env_registry.envs if (env.ip, env.wd) == (self.ip, self.wd)]
+        return pyfra.state.collect_garbage(self, heads=heads, max_age=max_age, max_entries=max_entries, max_kv_age=max_kv_age, dry_run=dry_run)
+
+    def _record_head(self) -> None:
+        """
+        Store this env's hash, so that collect_garbage knows its chain is still in use even if no step
+        on it had to run this time.
 
-            # check storage format for backwards compat
-            if key + "_format" not in self._kv_cache:
-                return pickle.loads(self._kv_cache[key].encode())
-            elif self._kv_cache[key + "_format"] == "b64":
-                return pickle.loads(base64.b64decode(self._kv_cache[key].encode()))
+        :meta private:
+        """
+        if self.hash == self._hash(None):
+            return
+
+        # a head that was already recorded only needs to be written again once in a while, to show it's still in use
+        key = "head:" + self.hash
+        try:
+            _, ts, _ = pyfra.state.unpack_entry(self._state().get(key))
+            if not pyfra.state.needs_refresh(ts): return
+        except KeyError:
+            pass
+        self._state().set(key, pyfra.state.pack_entry(pyfra.state.encode_value(None), parent=self.hash))
 
     def update_hash(self, *args, **kwargs) -> str:
         """
         :meta private:
         """
+        parent = self.hash
         self.hash = self._hash(self.hash, *args, **kwargs)
+        self._hash_parents[self.hash] = parent
         return self.hash
     
     @contextmanager
@@ -718,16 +1364,22 @@ class Env(Remote):
         branch (str): The git branch to clone. If None, the default branch is used.
         force_rerun (bool): If True, all hashing will be disabled and everything will be run every time. Deprecated in favor of `with pyfra.always_rerun()`
         python_version (str): The python version to use.
+        state_backend (str or Type[StateBackend]): Where to keep the env's state; see :class:`Remote`.
+        state_durability (str): When to write the env's state out; see :class:`Remote`.
     """
-    def __init__(self, ip=None, envname=None, git=None, branch=None, force_rerun=False, python_version="3.9.4", additional_ssh_config=""):
+    def __init__(self, ip=None, envname=None, git=None, branch=None, force_rerun=False, python_version="3.9.4", additional_ssh_config="", state_backend=None, state_durability=None):
         self.wd = f"~/pyfra_envs/{envname}"
-        super().__init__(ip, self.wd, resumable=True, additional_ssh_config=additional_ssh_config)
+        super().__init__(ip, self.wd, resumable=True, additional_ssh_config=additional_ssh_config, state_backend=state_backend, state_durability=state_durability)
         self.pyenv_version = python_version
 
         self.envname = envname
 
         if force_rerun: # deprecated
-            self.path(".pyfra_env_state.json").unlink()
+            self.close()
+            for fname in [".pyfra_env_state.json", ".pyfra_env_state.journal", ".pyfra_env_state.sqlite"]:
+                if self.path(fname).exists(): self.path(fname).unlink()
+            with self.no_hash():
+                self.sh(f"rm -rf {_quote_path(self.path('.pyfra_blobs').fname)}", no_venv=True, quiet=True, ignore_errors=True)
 
         self._init_env(git, branch, python_version)
 
@@ -989,4 +1641,14 @@ class _EnvRegistry:
 local = Remote(wd=os.getcwd())
 global_env_registry = _EnvRegistry()
 
+
+@atexit.register
+def _record_env_heads():
+    # runs before pyfra.state writes out pending state at exit, since it was registered later
+    for env in getattr(global_env_registry, "envs", []):
+        try:
+            env._record_head()
+        except Exception as e:
+            print(f"WARNING: couldn't save env state: {e}")
+
 if "PYFRA_ALWAYS_RERUN" in os.environ: global_env_registry = True
\ No newline at end of file
@@ -1,3 +1,6 @@
+import fnmatch
+import inspect
+import itertools
 import json
 import pathlib
 import os
@@ -6,15 +9,20 @@ import shlex
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import urllib
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List
 
 from best_download import download_file
 from colorama import Fore, Style
 from natsort import natsorted
 from deprecation import deprecated
 
-import imohash
+import pyfra._remote_helper
+import pyfra.downloader
 import pyfra.remote
 
 class ShellException(Exception):
@@ -24,7 +32,7 @@ class ShellException(Exception):
         self.returncode = code
 
 
-__all__ = ['sh', 'copy', 'ls', 'curl', 'quote', 'ShellException']
+__all__ = ['sh', 'copy', 'broadcast', 'gather', 'ls', 'curl', 'quote', 'ShellException', 'CopyVerificationError', 'BroadcastError']
 
 
 def _wrap_command(x, no_venv=False, pyenv_version=None):
@@ -175,7 +183,21 @@ def _rsh(host, cmd, quiet=False, wd=None, wrap=True, maxbuflen=1000000000, conne
 
     return ret
 
-def copy(frm, to, quiet=False, connection_timeout=10, symlink_ok=True, into=True, exclude=[]) -> None:
+
+def _popen(host, cmd, stdin=None, stdout=None, bufsize=-1, connection_timeout=10, additional_ssh_config=""):
+    """
+    Start cmd on host without waiting for it to finish, so that data can be streamed through its stdin/stdout.
+    Unlike _rsh, no tty is allocated and nothing is printed, so binary data passes through unchanged.
+    """
+    if host is None or host == "localhost" or host == "127.0.0.1":
+        full_cmd = cmd
+    else:
+        full_cmd = f"ssh -q -oConnectTimeout={connection_timeout} -oBatchMode=yes -oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null {additional_ssh_config} {host} {shlex.quote(cmd)}"
+
+    return subprocess.Popen(full_cmd, shell=True, stdin=stdin, stdout=stdout, bufsize=bufsize, executable="/bin/bash")
+
+
+def copy(frm, to, quiet=False, connection_timeout=10, symlink_ok=True, into=True, exclude=[], connections=8, checksum=None, partial=False, verify=False) -> None:
     """
     Copies things from one place to another.
 
@@ -186,15 +208,24 @@ def copy(frm, to, quiet=False, connection_timeout=10, symlink_ok=True, into=True
         connection_timeout (int): How long in seconds to give up after
         symlink_ok (bool): If frm and to are on the same machine, symlinks will be created instead of actually copying. Set to false to force copying.
         into (bool): If frm is a file, this has no effect. If frm is a directory, then into=True for frm="src" and to="dst" means "src/a" will get copied to "dst/src/a", whereas into=False means "src/a" will get copied to "dst/a".
+        connections (int): If frm is a URL, the number of parallel range requests to download it with. See :func:`pyfra.downloader.download`.
+        checksum (str): If frm is a URL, the sha256 hexdigest that the downloaded file must match.
+        partial (bool): If frm is a directory that already exists at the destination, first compare hash trees of both sides (see :meth:`pyfra.remote.RemotePath.diff`) and only transfer the files and subdirectories that differ. This saves rsync from walking and comparing the whole directory when only a small part of a huge directory changed.
+        verify (bool): After copying, check that every file arrived intact by comparing sha256 hashes computed on the source and destination machines. Both sides hash concurrently, in parallel across files. Raises a :class:`CopyVerificationError` if anything doesn't match.
     """
 
     # copy from url
     if isinstance(frm, str) and (frm.startswith("http://") or frm.startswith("https://")):
+        if isinstance(to, pyfra.remote.RemotePath): to = to.rsyncstr()
+        if not quiet: print(f"{Style.BRIGHT}{Fore.RED}*{Style.RESET_ALL} Downloading {Style.BRIGHT}{frm} {Style.RESET_ALL}to {Style.BRIGHT}{to}{Style.RESET_ALL}")
+
         if ":" in to:
+            # run the downloader on the destination host so the data doesn't have to go through this machine
             to_host, to_path = to.split(":")
-            _rsh(to_host, f"curl {frm} --create-dirs -o {to_path}")
+            payload = inspect.getsource(pyfra.downloader) + f"\ndownload({frm!r}, {to_path!r}, connections={connections!r}, checksum={checksum!r})\n"
+            _rsh(to_host, f"python3 -c {payload | quote}", quiet=True, connection_timeout=connection_timeout)
         else:
-            wget(frm, to)
+            pyfra.downloader.download(frm, to, connections=connections, checksum=checksum)
         return
 
     # get rsync strs and make sure frm and to are RemotePaths
@@ -250,7 +281,24 @@ def copy(frm, to, quiet=False, connection_timeout=10, symlink_ok=True, into=True
 
         return frm_str
 
-    if ":" in frm_str and ":" in to_str:
+    rsync_prefix = ""
+    up_to_date = False
+    if partial and not (symlink_ok and frm.remote.ip == to.remote.ip):
+        dest = to.remote.path(os.path.join(to.fname, os.path.basename(frm.fname.rstrip("/")))) if into else to
+        changed = frm.diff(dest)
+
+        # very long lists of changes aren't worth passing along, since rsync will be walking most of the tree anyway
+        if changed == []:
+            up_to_date = True
+        elif changed is not None and len(changed) <= 10000:
+            frm_str = frm_str.rstrip("/") + "/"
+            to_str = dest.rsyncstr()
+            opts += " --files-from=-"
+            rsync_prefix = f"printf '%s\\n' {' '.join(quote(x) for x in changed)} | "
+
+    if up_to_date:
+        if not quiet: print(f"{Style.BRIGHT}{Fore.RED}*{Style.RESET_ALL} Already up to date: {Style.BRIGHT}{to_str}{Style.RESET_ALL}")
+    elif ":" in frm_str and ":" in to_str:
         frm_host, frm_path = frm_str.split(":")
         to_host, to_path = to_str.split(":")
 
@@ -263,9 +311,9 @@ def copy(frm, to, quiet=False, connection_timeout=10, symlink_ok=True, into=True
             else:
 
                 if par_target: _rsh(to_host, f"mkdir -p {par_target}", quiet=True)
-                _rsh(frm_host, f"rsync {opts} {frm_path} {to_path}", quiet=True)
+                _rsh(frm_host, f"{rsync_prefix}rsync {opts} {frm_path} {to_path}", quiet=True)
         else:
-            rsync_cmd = f"rsync {opts} {frm_path} {to_str}"
+            rsync_cmd = f"{rsync_prefix}rsync {opts} {frm_path} {to_str}"
                 
             # make parent dir in terget if not exists
             if par_target: _rsh(to_host, f"mkdir -p {par_target}", quiet=True)
@@ -281,14 +329,209 @@ def copy(frm, to, quiet=False, connection_timeout=10, symlink_ok=True, into=True
             sh(f"[ -d {frm_str} ] && mkdir -p {par_target}; ln -sf {symlink_frm(frm_str)} {to_str}", quiet=True)
         else:
             if ":" in to_str: _rsh(to_str.split(":")[0], f"mkdir -p {par_target}", quiet=True)
-            sh((f"mkdir -p {par_target}; " if par_target and ":" in frm_str else "") + f"rsync {opts} {frm_str} {to_str}", wrap=False, quiet=True)
+            sh((f"mkdir -p {par_target}; " if par_target and ":" in frm_str else "") + f"{rsync_prefix}rsync {opts} {frm_str} {to_str}", wrap=False, quiet=True)
     
+    if verify: _verify_copy(frm, to, into, exclude)
+
     # set value in key value store to flag as done
     if needs_set_kv:
         to.remote.set_kv(new_hash, None)
         to._set_cache("quick_hash", checksum) # set the checksum of the target file to avoid needing to calculate it again
 
 
+class CopyVerificationError(Exception):
+    def __init__(self, frm, to, mismatched):
+        super().__init__(f"Copy from {frm} to {to} could not be verified; sha256 mismatch for: {', '.join(mismatched[:10])}" + (f" and {len(mismatched) - 10} more" if len(mismatched) > 10 else ""))
+        self.mismatched = mismatched
+
+
+def _verify_copy(frm, to, into, exclude):
+    """ Check a finished copy by hashing both sides on their own machines at the same time """
+    name = os.path.basename(frm.fname.rstrip("/"))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        src_fut = executor.submit(lambda: frm.remote.sha256sum_many([frm])[0])
+        dst_fut = executor.submit(lambda: to.remote._helper("sha256_copy_dest", to=to.fname, name=name, into=into))
+        src, dst = src_fut.result(), dst_fut.result()
+
+    if src is None:
+        raise FileNotFoundError(f"{frm} does not exist")
+    if not isinstance(src, dict):
+        if src != dst: raise CopyVerificationError(frm.rsyncstr(), to.rsyncstr(), [name])
+        return
+
+    # files that only exist at the destination are fine, since copy never deletes anything
+    dst = dst if isinstance(dst, dict) else {}
+    excluded = lambda rel: any(fnmatch.fnmatch(rel, ex) or any(fnmatch.fnmatch(part, ex) for part in rel.split(os.sep)) for ex in exclude)
+    mismatched = sorted(rel for rel, h in src.items() if dst.get(rel) != h and not excluded(rel))
+    if mismatched: raise CopyVerificationError(frm.rsyncstr(), to.rsyncstr(), mismatched)
+
+
+class BroadcastError(Exception):
+    def __init__(self, failures):
+        super().__init__(f"Broadcast failed for {len(failures)} destination(s): " + "; ".join(f"{to}: {e}" for to, e in list(failures.items())[:10]) + (f" and {len(failures) - 10} more" if len(failures) > 10 else ""))
+        self.failures = failures
+
+
+def broadcast(frm, tos, quiet=False, into=True, exclude=[], max_parallel=32, max_tries=3) -> None:
+    """
+    Copies one thing to many destinations. Destinations that already have a copy are used as sources for
+    the remaining ones, using the same remote-to-remote rsync as :func:`copy`, so the number of copies
+    roughly doubles as each wave of transfers lands and the total time grows with log(len(tos)) rather than
+    len(tos). As soon as a transfer finishes, both its source and its destination start serving the next ones.
+
+    A failed transfer doesn't stop the others. The destination is tried again, from a source it hasn't been tried
+    from yet if one is free, up to max_tries times. Once everything else is done, a :class:`BroadcastError` is raised
+    for all destinations that still failed.
+
+    Example usage: ::
+
+        broadcast(local.path("dataset"), [rem.path("data") for rem in remotes])
+
+    Args:
+        frm (str or RemotePath): A local path or a :class:`pyfra.remote.RemotePath`. Unlike :func:`copy`, URLs are not supported.
+        tos (List[str or RemotePath]): The destinations, in the same form as for :func:`copy`. If frm is a file, these should be file paths rather than directories to copy into.
+        quiet (bool): Disables logging.
+        into (bool): Same as for :func:`copy`.
+        exclude (List[str]): Patterns to exclude, same as for :func:`copy`.
+        max_parallel (int): Max number of transfers running at once.
+        max_tries (int): How many times to try each destination before giving up on it.
+    """
+    if not isinstance(frm, pyfra.remote.RemotePath): frm = pyfra.remote.local.path(frm)
+    tos = [to if isinstance(to, pyfra.remote.RemotePath) else pyfra.remote.local.path(to) for to in tos]
+    frm_is_dir = frm.is_dir()
+
+    def _relay_source(to):
+        # where the data ended up at a destination, and how to copy it on from there to get the same result
+        if frm_is_dir and into:
+            return pyfra.remote.RemotePath(to.remote, os.path.join(to.fname, os.path.basename(frm.fname))), True
+        return to, into
+
+    def _pick_source(tried):
+        # sources that were most recently populated are picked first, so the original source isn't favoured.
+        # a retry goes to a source it wasn't tried from before, unless there's no such source free right now
+        for i in reversed(range(len(idle_sources))):
+            if idle_sources[i][0].rsyncstr() not in tried:
+                return idle_sources.pop(i)
+        return idle_sources.pop()
+
+    pending = list(range(len(tos)))
+    tried = defaultdict(list)
+    failures = {}
+    idle_sources = [(frm, into)]
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while pending or running:
+            while pending and idle_sources and len(running) < max_parallel:
+                i = pending.pop(0)
+                src, src_into = _pick_source(tried[i])
+                tried[i].append(src.rsyncstr())
+                running[executor.submit(copy, src, tos[i], quiet=quiet, symlink_ok=False, into=src_into, exclude=exclude)] = (src, src_into, i)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                src, src_into, i = running.pop(fut)
+                # the source goes back either way, since a failure might just as well be the destination's fault
+                idle_sources.append((src, src_into))
+                try:
+                    fut.result()
+                except Exception as e:
+                    if len(tried[i]) < max_tries:
+                        pending.append(i)
+                    else:
+                        failures[tos[i].rsyncstr()] = e
+                    continue
+                idle_sources.append(_relay_source(tos[i]))
+
+    if failures:
+        raise BroadcastError(failures)
+
+
+def gather(paths, local_dir, max_parallel=16, max_per_host=4, namespace=True, exclude=[], quiet=False) -> List[dict]:
+    """
+    Copies files or directories from many remotes to this machine concurrently. Files that are
+    already present locally with a matching :meth:`pyfra.remote.RemotePath.quick_hash` are skipped, unless
+    exclude is given: the hashes would include the excluded files, so excluded gathers always copy again (which
+    rsync still only does for files that changed). Failures don't stop the other transfers; they're recorded in
+    the returned manifest instead. Paths that would end up at the same dest raise a ValueError before anything is copied.
+
+    Example usage: ::
+
+        manifest = gather([rem.path("eval_results.json") for rem in remotes], "results")
+        # results/<host>/eval_results.json for each remote
+
+    Args:
+        paths (List[RemotePath]): The files or directories to fetch.
+        local_dir (str): The local directory to put them in.
+        max_parallel (int): Max number of transfers running at once.
+        max_per_host (int): Max number of transfers running at once from any single host, to stay under sshd's connection limits.
+        namespace (bool): If True, each path is put in a subdirectory of local_dir named after its host, so that identically named files from different hosts don't collide. If False, everything goes directly into local_dir. Either way, the paths from any one host need different basenames.
+        exclude (List[str]): Patterns to exclude, same as for :func:`copy`.
+        quiet (bool): Disables logging.
+    Returns:
+        A list with one dict per path, in the same order, with the keys "remote", "src", "dest", "hash" (None if exclude is given), "status" (one of "fetched", "skipped" or "failed") and "error".
+    """
+    local_dir = os.path.expanduser(local_dir)
+    paths = list(paths)
+    host_locks = {path.remote.ip: threading.Semaphore(max_per_host) for path in paths}
+
+    def _dest(path):
+        host = path.remote.ip if path.remote.ip is not None else "localhost"
+        return os.path.join(local_dir, host, os.path.basename(path.fname)) if namespace else os.path.join(local_dir, os.path.basename(path.fname))
+
+    # paths that would be copied to the same place would overwrite each other
+    dests = [_dest(path) for path in paths]
+    seen = {}
+    for path, dest in zip(paths, dests):
+        if dest in seen:
+            raise ValueError(f"{seen[dest]} and {path} would both be gathered to {dest}")
+        seen[dest] = path
+
+    # interleave hosts so that workers aren't all stuck waiting on the same host's limit
+    by_host = defaultdict(list)
+    for i, path in enumerate(paths): by_host[path.remote.ip].append(i)
+    order = [i for group in itertools.zip_longest(*by_host.values()) for i in group if i is not None]
+
+    # hash everything on each host in one round trip rather than one per path
+    def _hash_host(idxs):
+        try:
+            return dict(zip(idxs, paths[idxs[0]].remote.quick_hash_many([paths[i] for i in idxs])))
+        except Exception:
+            return {}
+
+    # hashes don't know about exclude, so with exclusions the local copy never matches and everything is copied again
+    remote_hashes = {}
+    if not exclude:
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            for hashes in executor.map(_hash_host, by_host.values()): remote_hashes.update(hashes)
+
+    def _gather_one(i):
+        path = paths[i]
+        host = path.remote.ip if path.remote.ip is not None else "localhost"
+        dest = dests[i]
+        entry = {"remote": host, "src": path.fname, "dest": dest, "hash": None, "status": "failed", "error": None}
+
+        try:
+            with host_locks[path.remote.ip]:
+                if not exclude:
+                    entry["hash"] = remote_hashes[i] if remote_hashes.get(i) is not None else path.quick_hash()
+                    if os.path.exists(dest) and quick_hash(dest) == entry["hash"]:
+                        entry["status"] = "skipped"
+                        return entry
+
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                copy(path, dest, quiet=quiet, symlink_ok=False, into=False, exclude=exclude)
+                entry["status"] = "fetched"
+        except Exception as e:
+            entry["error"] = str(e)
+        return entry
+
+    manifest = [None] * len(paths)
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        for i, entry in zip(order, executor.map(_gather_one, order)):
+            manifest[i] = entry
+    return manifest
+
+
 def ls(x='.'):
     return list(natsorted([x + '/' + fn for fn in os.listdir(x)]))
 
@@ -304,21 +547,11 @@ def rm(x, no_exists_ok=True):
         raise ValueError("file {} is not a file or dir.".format(x))
 
 def curl(url, max_tries=10, timeout=30): # TODO: add checksum option
-    cooldown = 1
-    for i in range(max_tries):
-        try:
-            response = urllib.request.urlopen(url, timeout=timeout)
-            data = response.read()
-        except urllib.error.URLError as e:
-            if e.code == 429:
-                time.sleep(cooldown)
-                cooldown *= 1.5
-                continue
-            else:
-                return None
-        except:
-            return None
-        return data
+    """
+    Fetch a url and return its contents as bytes, or None if it couldn't be fetched.
+    To fetch many urls, use :func:`pyfra.downloader.curl_many`, which does them concurrently.
+    """
+    return pyfra.downloader.curl_many([url], max_tries=max_tries, timeout=timeout)[0].data
 
 @deprecated(details="Use best_download directly, or wait for improved file-downloading support in pyfra")
 def wget(url, to=None, checksum=None):
@@ -331,18 +564,22 @@ def wget(url, to=None, checksum=None):
 
     download_file(url, to, checksum)
 
-def quick_hash(path):
-    params = {
-        "hexdigest": True,
-        "sample_size": 4 * 1024**2, # 4 MB
-        "sample_threshhold": 16 * 1024**2, # 16 MB
-    }
-    path = os.path.expanduser(path)
-    if pathlib.Path(path).is_dir():
-        files = list(sorted(pathlib.Path(path).glob('**/*')))
-        res = pyfra.remote._hash_obs(*[(str(f.relative_to(pathlib.Path(path))), imohash.hashfile(str(f.resolve()), **params)) for f in files if f.is_file()])[:32]
-        return res
-    return imohash.hashfile(path, **params)
+def quick_hash(path, max_workers=16):
+    """
+    Hash a file by sampling blocks at its beginning, middle and end, compatible with imohash. Directories are hashed
+    from the hashes of all the files inside them. Files in a directory are hashed in parallel, and the
+    per-file hashes are remembered in a manifest in ~/.pyfra_cache, so that only files whose size, mtime
+    or inode changed since the last call have to be hashed again.
+
+    The same code runs on remotes for :meth:`pyfra.remote.RemotePath.quick_hash`, so hashes of the same
+    contents always agree between machines.
+
+    Args:
+        path (str): The file or directory to hash.
+        max_workers (int): Max number of files to hash at once.
+    """
+    return pyfra._remote_helper.quick_hash(path, manifest_dir=pyfra.remote._local_cache_dir("quick_hash"), max_workers=max_workers)
+
 
 # convenience function for shlex.quote
 class _quote:
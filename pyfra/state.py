@@ -0,0 +1,803 @@
+"""
+Storage for the key-value state that Envs use to remember which steps have already run.
+"""
+
+import abc
+import atexit
+import base64
+import hashlib
+import lzma
+import mmap
+import os
+import pickle
+import shutil
+import sqlite3
+import struct
+import subprocess
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import pyfra._remote_helper
+import pyfra.remote
+import pyfra.shell
+
+__all__ = ["StateBackend", "JournalState", "SQLiteState", "WriteBehindState", "BlobStore", "encode_value", "decode_value", "collect_garbage"]
+
+# 0xff isn't a pickle opcode, so values in this format can't be mistaken for the plain pickles older versions stored
+_VALUE_MAGIC = b"\xffPF"
+_VALUE_VERSION = 1
+_VALUE_HEADER = struct.Struct("<3sBB")
+
+_codecs = {
+    "none": (0, None, None),
+    "zlib": (1, lambda b: zlib.compress(b, 1), zlib.decompress),
+    "lzma": (2, lzma.compress, lzma.decompress),
+}
+if zstandard is not None:
+    _codecs["zstd"] = (3, lambda b: zstandard.ZstdCompressor().compress(b), lambda b: zstandard.ZstdDecompressor().decompress(b))
+_codec_ids = {codec_id: name for name, (codec_id, _, _) in _codecs.items()}
+
+
+def encode_value(value: Any, compression: str = None, min_compress_size: int = 1024) -> bytes:
+    """
+    Serialize a value for storing in env state. Values are pickled with protocol 5, with large buffers (e.g. numpy
+    arrays) kept out of band so they're copied as they are instead of through the pickle stream. The result is
+    compressed if it's at least min_compress_size bytes and compressing makes it smaller.
+
+    Args:
+        value (Any): Anything picklable.
+        compression (str): One of "zlib", "lzma", "zstd" (needs the zstandard package) or "none". Defaults to the PYFRA_STATE_COMPRESSION env var, or "zlib".
+        min_compress_size (int): Values smaller than this many bytes are never compressed.
+    """
+    compression = compression or os.environ.get("PYFRA_STATE_COMPRESSION", "zlib")
+    if compression not in _codecs:
+        raise ValueError(f"Unknown state compression {compression}, must be one of {sorted(_codecs)}")
+
+    buffers = []
+    data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    # the number of out of band buffers and their sizes, the buffers, and then the pickle itself
+    buffers = [buf.raw() for buf in buffers]
+    body = b"".join([struct.pack(f"<I{len(buffers)}Q", len(buffers), *(buf.nbytes for buf in buffers))] + buffers + [data])
+
+    codec_id, compress, _ = _codecs[compression]
+    if compress is not None and len(body) >= min_compress_size:
+        compressed = compress(body)
+        if len(compressed) < len(body):
+            return _VALUE_HEADER.pack(_VALUE_MAGIC, _VALUE_VERSION, codec_id) + compressed
+    return _VALUE_HEADER.pack(_VALUE_MAGIC, _VALUE_VERSION, 0) + body
+
+
+def decode_value(data: bytes) -> Any:
+    """
+    Deserialize a value made by :func:`encode_value`. Plain pickles, as stored by older versions of pyfra, are read too.
+    """
+    if data[:len(_VALUE_MAGIC)] != _VALUE_MAGIC:
+        return pickle.loads(data)
+
+    _, version, codec_id = _VALUE_HEADER.unpack_from(data)
+    if version != _VALUE_VERSION:
+        raise ValueError(f"Env state value has format version {version}, which needs a newer version of pyfra")
+    if codec_id not in _codec_ids:
+        raise ValueError(f"Env state value is compressed with an unsupported codec ({codec_id}); is zstandard installed?")
+
+    body = memoryview(data)[_VALUE_HEADER.size:]
+    decompress = _codecs[_codec_ids[codec_id]][2]
+    if decompress is not None:
+        body = memoryview(decompress(body))
+
+    nbuffers, = struct.unpack_from("<I", body)
+    if not nbuffers:
+        return pickle.loads(body[4:])
+
+    # out of band buffers are handed to pickle as they are, so they need to be writable for e.g. numpy arrays to be
+    if body.readonly:
+        body = memoryview(bytearray(body))
+    sizes = struct.unpack_from(f"<{nbuffers}Q", body, 4)
+    pos = struct.calcsize(f"<I{nbuffers}Q")
+    buffers = []
+    for size in sizes:
+        buffers.append(body[pos:pos + size])
+        pos += size
+    return pickle.loads(body[pos:], buffers=buffers)
+
+
+_ENTRY_MAGIC = b"\xffPE"
+_ENTRY_HEADER = struct.Struct("<3sIB")
+
+# entries that are read are written again with a new timestamp at most this often, so that collect_garbage sees
+# them as used without every hit turning into a write
+_REFRESH_INTERVAL = 86400
+
+
+def pack_entry(data: bytes, parent: str = None) -> bytes:
+    """
+    Prefix an encoded value (or blob reference) with the time it's written and the env hash of the step before it,
+    which is what :func:`collect_garbage` goes by.
+    """
+    parent = (parent or "").encode()
+    if len(parent) > 255: parent = b""
+    return _ENTRY_HEADER.pack(_ENTRY_MAGIC, int(time.time()), len(parent)) + parent + data
+
+
+def unpack_entry(data: bytes) -> Tuple[memoryview, Optional[int], Optional[str]]:
+    """
+    Split a state entry into the value, the time it was written, and its parent hash. Entries written by older
+    versions of pyfra are just the value, and have neither.
+    """
+    if data[:len(_ENTRY_MAGIC)] != _ENTRY_MAGIC:
+        return memoryview(data), None, None
+    _, ts, parent_len = _ENTRY_HEADER.unpack_from(data)
+    start = _ENTRY_HEADER.size
+    parent = bytes(data[start:start + parent_len]).decode() or None
+    return memoryview(data)[start + parent_len:], ts, parent
+
+
+def needs_refresh(ts: Optional[int]) -> bool:
+    """
+    Whether an entry written at ts should be written again when it's used, so that :func:`collect_garbage` knows it's
+    still in use. Entries from before pyfra kept timestamps are never dropped anyway, so they're left as they are.
+    """
+    return ts is not None and time.time() - ts >= _REFRESH_INTERVAL
+
+
+class BlobStore:
+    """
+    Content-addressed files for state values too big to keep in the state itself, so that opening the state stays
+    fast no matter what got cached in it. Each blob is an encoded value in the env's .pyfra_blobs directory, named by
+    its sha256, and only a short reference to it is stored as the value. Blobs are written to a temp file and renamed
+    into place, so a half written blob is never mistaken for a whole one.
+
+    Blobs are only read when their value is asked for. Local blobs are memory-mapped copy-on-write, so arrays that
+    were stored uncompressed are backed by the file rather than read into memory up front. Remote blobs are downloaded
+    into pyfra's local cache once, and memory-mapped from there.
+
+    Args:
+        rem (Remote): The remote that the blobs are stored on; dirname is relative to its working directory.
+        dirname (str): The directory to store blobs in.
+    """
+    _REF_MAGIC = b"\xffPB"
+
+    def __init__(self, rem, dirname=".pyfra_blobs"):
+        self.rem = rem
+        self.dirname = dirname
+
+    @staticmethod
+    def threshold() -> int:
+        """ Encoded values at least this many bytes are stored as blobs. Can be set with the PYFRA_STATE_BLOB_THRESHOLD env var; defaults to 1 MiB. """
+        return int(os.environ.get("PYFRA_STATE_BLOB_THRESHOLD", 1 << 20))
+
+    @classmethod
+    def is_ref(cls, data: bytes) -> bool:
+        """ Whether a state value is a reference to a blob rather than a value """
+        return data[:len(cls._REF_MAGIC)] == cls._REF_MAGIC
+
+    @classmethod
+    def digest(cls, ref: bytes) -> str:
+        """ The sha256 of the blob that a reference points to """
+        return bytes(ref[len(cls._REF_MAGIC):]).hex()
+
+    def path(self, digest: str):
+        """ The :class:`pyfra.remote.RemotePath` of a blob """
+        return self.rem.path(f"{self.dirname}/{digest[:2]}/{digest}")
+
+    def put(self, data: bytes) -> bytes:
+        """ Store data as a blob (unless it's already there), and return the reference to keep in its place """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        tmpname = f"{path.fname}.tmp.{uuid.uuid4().hex}"
+
+        if self.rem.is_local():
+            fname = os.path.expanduser(path.fname)
+            if not os.path.exists(fname):
+                os.makedirs(os.path.dirname(fname), exist_ok=True)
+                with open(os.path.expanduser(tmpname), "wb") as fh:
+                    fh.write(data)
+                os.replace(os.path.expanduser(tmpname), fname)
+        else:
+            # one round trip, streaming the data through ssh instead of putting it on the command line
+            quote = pyfra.remote._quote_path
+            cmd = f"mkdir -p {quote(os.path.dirname(path.fname))} && cat > {quote(tmpname)} && mv {quote(tmpname)} {quote(path.fname)}"
+            proc = pyfra.shell._popen(self.rem.ip, cmd, stdin=subprocess.PIPE, additional_ssh_config=self.rem.additional_ssh_config)
+            proc.communicate(data)
+            if proc.returncode != 0:
+                raise pyfra.shell.ShellException(proc.returncode, rem=True)
+
+        return self._REF_MAGIC + bytes.fromhex(digest)
+
+    def get(self, ref: bytes) -> mmap.mmap:
+        """ The data of the blob that ref points to, memory-mapped copy-on-write """
+        digest = self.digest(ref)
+        if self.rem.is_local():
+            fname = os.path.expanduser(self.path(digest).fname)
+        else:
+            fname = os.path.join(pyfra.remote._local_cache_dir("blobs"), digest)
+            if not os.path.exists(fname):
+                tmpname = f"{fname}.tmp.{uuid.uuid4().hex}"
+                try:
+                    with self.path(digest).open("rb") as src, open(tmpname, "wb") as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+                    os.replace(tmpname, fname)
+                finally:
+                    pyfra.shell.rm(tmpname)
+
+        with open(fname, "rb") as fh:
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def delete(self, digests: List[str]) -> None:
+        """ Delete blobs, skipping ones that don't exist """
+        fnames = [self.path(digest).fname for digest in digests]
+        if not fnames:
+            return
+        if self.rem.is_local():
+            for fname in fnames:
+                pyfra.shell.rm(os.path.expanduser(fname))
+        else:
+            with self.rem.no_hash():
+                self.rem.sh("rm -f " + " ".join(pyfra.remote._quote_path(fname) for fname in fnames), no_venv=True, quiet=True)
+
+
+def _decode_legacy(ob: dict) -> Dict[str, bytes]:
+    """ Convert the contents of an old .pyfra_env_state.json to pickled values """
+    ret = {}
+    for key, value in ob.items():
+        if key.endswith("_format") and key[:-len("_format")] in ob:
+            continue
+        if ob.get(key + "_format") == "b64":
+            ret[key] = base64.b64decode(value.encode())
+        else:
+            ret[key] = value.encode()
+    return ret
+
+
+class StateBackend(abc.ABC):
+    """
+    Where an env keeps its state: a map from string keys to bytes. Backends are constructed with the
+    :class:`pyfra.remote.Remote` that the state lives on, and pick which files to use relative to its working directory.
+    Pass a subclass (or the name of a built in one) as the state_backend argument of Remote or Env to use it.
+    """
+    @abc.abstractmethod
+    def get(self, key: str) -> bytes:
+        """
+        Get the value for a key, raising KeyError if it isn't set.
+        """
+        pass
+
+    @abc.abstractmethod
+    def set(self, key: str, value: bytes) -> None:
+        """
+        Set the value for a key.
+        """
+        pass
+
+    @abc.abstractmethod
+    def keys(self) -> List[str]:
+        """
+        All keys that are set.
+        """
+        pass
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        """
+        Set the values for many keys. Backends can override this to do it more efficiently than one at a time.
+        """
+        for key, value in items.items():
+            self.set(key, value)
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        """
+        Get the values for many keys, leaving out keys that aren't set. Backends can override this to do it more efficiently than one at a time.
+        """
+        ret = {}
+        for key in keys:
+            try:
+                ret[key] = self.get(key)
+            except KeyError:
+                pass
+        return ret
+
+    def delete_many(self, keys: List[str]) -> None:
+        """
+        Delete many keys at once. Needed for :func:`collect_garbage`.
+        """
+        raise NotImplementedError(f"{type(self).__name__} doesn't support deleting keys")
+
+    def compact(self) -> None:
+        """
+        Give the space taken by overwritten or deleted values back, if the backend holds on to it.
+        """
+        pass
+
+    def flush(self) -> None:
+        """
+        Make sure everything that was set has been written out.
+        """
+        pass
+
+    def close(self) -> None:
+        """
+        Flush, and release anything the backend holds on to.
+        """
+        self.flush()
+
+
+class JournalState(StateBackend):
+    """
+    The state of an env, kept in an append-only journal file in the env. Each write appends records for just the
+    values that changed, so it costs the same no matter how much state has built up. Once the journal holds too many
+    records that were overwritten since, it's compacted by writing a fresh journal and renaming it over the old one.
+
+    Several processes can use the same env at once. Appends and compaction take a lock (flock on a .lock file next
+    to the journal, taken on the remote by pyfra's helper), and compaction works from what's in the file rather than
+    from this process's copy, so nobody's records get lost. Lookups of keys this process hasn't seen pick up what other
+    processes appended since, at most every refresh_interval seconds. Within a process, it can be used from several
+    threads at once, and lookups of keys it already has don't wait for appends that are in progress.
+
+    A record that was only partly written when a process died is skipped on reading. State in the old
+    .pyfra_env_state.json format is read as the starting point, and moved into the journal the first time anything is written.
+
+    Args:
+        rem (Remote): The remote that the state is stored on; file names are relative to its working directory.
+        fname (str): The journal file.
+        legacy_fname (str): The json state file used by older versions of pyfra.
+        refresh_interval (float): Min number of seconds between checks for records from other processes. Defaults to 0 for local state and 10 for remote state, since each check is an ssh round trip.
+    """
+    def __init__(self, rem, fname=".pyfra_env_state.journal", legacy_fname=".pyfra_env_state.json", refresh_interval=None):
+        self.rem = rem
+        self.path = rem.path(fname)
+        self.legacy_path = rem.path(legacy_fname)
+        self.refresh_interval = (0 if rem.is_local() else 10) if refresh_interval is None else refresh_interval
+
+        self._data = None
+        self._has_legacy = False
+        self._nrecords = 0
+        self._ino = None
+        self._offset = 0
+        self._last_refresh = 0
+
+        # guards the copy of the journal in memory and where it was read up to
+        self._lock = threading.RLock()
+        # held while appending, so that records go out in the same order as they were set
+        self._append_lock = threading.RLock()
+
+    def _load(self) -> Dict[str, bytes]:
+        with self._lock:
+            if self._data is None:
+                self._data = {}
+                # through the helper rather than RemotePath, whose methods run Remote.sh, which would add to the
+                # env's hash when this runs on a background thread, e.g. in a WriteBehindState flush
+                legacy = self.rem._helper("read_json", path=self.legacy_path.fname)
+                if legacy is not None:
+                    self._data.update(_decode_legacy(legacy))
+                    self._has_legacy = True
+                self._refresh()
+            return self._data
+
+    def _refresh(self) -> None:
+        """ Read whatever has been appended to the journal since the last read, by any process """
+        if self.rem.is_local():
+            ino, start, data = pyfra._remote_helper.journal_read(self.path.fname, self._offset, self._ino)
+        else:
+            ret = self.rem._helper("journal_read", path=self.path.fname, offset=self._offset, ino=self._ino)
+            ino, start, data = ret["ino"], ret["start"], base64.b64decode(ret["data"])
+
+        records, end = pyfra._remote_helper.decode_records(data)
+        if start == 0: self._nrecords = 0
+        self._data.update(records)
+        self._nrecords += len(records)
+        self._ino = ino
+        # a record that's being written right now is read again next time
+        self._offset = start + end
+        self._last_refresh = time.time()
+
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            data = self._load()
+            if key not in data and time.time() - self._last_refresh >= self.refresh_interval:
+                self._refresh()
+            return data[key]
+
+    def set(self, key: str, value: bytes) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        with self._append_lock:
+            with self._lock:
+                data = self._load()
+                data.update(items)
+                has_legacy = self._has_legacy
+                if has_legacy:
+                    items = dict(data)
+
+            # the lock isn't held while appending, so that lookups don't have to wait for it
+            records = b"".join(pyfra._remote_helper.encode_record(key, value) for key, value in items.items())
+            if self.rem.is_local():
+                pyfra._remote_helper.journal_append(self.path.fname, records)
+            else:
+                self.rem._helper("journal_append", path=self.path.fname, data=base64.b64encode(records).decode())
+
+            with self._lock:
+                self._nrecords += len(items)
+                if has_legacy:
+                    # its contents are in the journal now either way. if another process got there first, the file
+                    # is already gone, and this process's copy of it was just appended once more
+                    self._has_legacy = False
+                    self.rem._helper("remove_file", path=self.legacy_path.fname)
+                needs_compact = self._nrecords >= 2 * len(data) + 1000
+            if needs_compact:
+                self.compact()
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._load().keys())
+
+    def delete_many(self, keys: List[str]) -> None:
+        self.compact(drop=keys)
+
+    def compact(self, drop=()) -> None:
+        """ Rewrite the journal with only the latest record for each key, leaving out the keys in drop """
+        with self._append_lock, self._lock:
+            data = self._load()
+            if self._has_legacy:
+                # the legacy file is only removed once its contents are in the journal
+                self.set_many({})
+            drop = list(drop)
+            if self.rem.is_local():
+                pyfra._remote_helper.journal_compact(self.path.fname, drop)
+            else:
+                self.rem._helper("journal_compact", path=self.path.fname, drop=drop)
+            for key in drop:
+                data.pop(key, None)
+
+            # the journal was replaced, so it's read again from the start
+            self._ino = None
+            self._refresh()
+
+
+class SQLiteState(StateBackend):
+    """
+    The state of an env in an SQLite database in the env, in WAL mode with the keys as primary key and the values
+    as blobs, so lookups and inserts stay fast no matter how many steps have been cached. Local databases are used
+    directly. Remote databases are accessed on the remote through pyfra's helper, which only needs python 3 there;
+    all keys are fetched once up front so that looking up a step that hasn't run yet doesn't cost a round trip.
+    Missing keys are looked up again at most every refresh_interval seconds, to pick up what other processes wrote.
+
+    The first time a database is created, any existing state from the journal or the old json file is imported into it.
+
+    Args:
+        rem (Remote): The remote that the state is stored on; file names are relative to its working directory.
+        fname (str): The database file.
+        refresh_interval (float): Min number of seconds between lookups of missing keys in a remote database.
+    """
+    def __init__(self, rem, fname=".pyfra_env_state.sqlite", refresh_interval=10):
+        self.rem = rem
+        self.path = rem.path(fname)
+        self.refresh_interval = refresh_interval
+
+        self._local = threading.local()
+        self._keys = None
+        self._values = {}
+        self._last_refresh = time.time()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            is_new = not os.path.exists(os.path.expanduser(self.path.fname))
+            conn = self._local.conn = pyfra._remote_helper._sqlite_connect(self.path.fname)
+            if is_new: self._import_old_state()
+        return conn
+
+    def _remote_keys(self) -> set:
+        if self._keys is None:
+            keys = self.rem._helper("state_keys", db=self.path.fname)
+            if keys is None:
+                keys = self._import_old_state()
+            self._keys = set(keys)
+        return self._keys
+
+    def _import_old_state(self) -> List[str]:
+        old = JournalState(self.rem)
+        items = {key: old.get(key) for key in old.keys()}
+        if items or not self.rem.is_local():
+            self.set_many(items)
+        return list(items)
+
+    def get(self, key: str) -> bytes:
+        if self.rem.is_local():
+            row = self._conn().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            return row[0]
+
+        if key not in self._remote_keys() and time.time() - self._last_refresh >= self.refresh_interval:
+            # another process might have set it since the keys were fetched
+            self._last_refresh = time.time()
+            found = self.rem._helper("state_get", db=self.path.fname, keys=[key])
+            if key in found:
+                self._keys.add(key)
+                self._values[key] = base64.b64decode(found[key])
+        if key not in self._remote_keys():
+            raise KeyError(key)
+        if key not in self._values:
+            value = self.rem._helper("state_get", db=self.path.fname, keys=[key])[key]
+            self._values[key] = base64.b64decode(value)
+        return self._values[key]
+
+    def set(self, key: str, value: bytes) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        if self.rem.is_local():
+            with self._conn() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", list(items.items()))
+            return
+
+        self.rem._helper("state_set", db=self.path.fname, items={key: base64.b64encode(value).decode() for key, value in items.items()})
+        if self._keys is not None:
+            self._keys.update(items)
+        self._values.update(items)
+
+    def keys(self) -> List[str]:
+        if self.rem.is_local():
+            return [key for key, in self._conn().execute("SELECT key FROM kv")]
+        return list(self._remote_keys())
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        if self.rem.is_local():
+            return super().get_many(keys)
+
+        missing = [key for key in keys if key in self._remote_keys() and key not in self._values]
+        if missing:
+            found = self.rem._helper("state_get", db=self.path.fname, keys=missing)
+            self._values.update({key: base64.b64decode(value) for key, value in found.items()})
+        return {key: self._values[key] for key in keys if key in self._values}
+
+    def delete_many(self, keys: List[str]) -> None:
+        keys = list(keys)
+        if self.rem.is_local():
+            with self._conn() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("DELETE FROM kv WHERE key = ?", [(key,) for key in keys])
+            return
+
+        self.rem._helper("state_delete", db=self.path.fname, keys=keys)
+        for key in keys:
+            self._remote_keys().discard(key)
+            self._values.pop(key, None)
+
+    def compact(self) -> None:
+        if self.rem.is_local():
+            self._conn().execute("VACUUM")
+        else:
+            self.rem._helper("state_vacuum", db=self.path.fname)
+
+
+class WriteBehindState(StateBackend):
+    """
+    Wraps another backend so that set returns immediately, and a background thread writes the values out in
+    batches instead. A batch is written once max_pending values are waiting or the oldest one has waited interval
+    seconds, whichever comes first, so a remote env pays for one write per batch rather than one per step.
+
+    Lookups are answered from the values still waiting or being written, and otherwise from inner without waiting
+    for a batch that's being written, so inner has to allow a read while a write is in progress (the built in backends
+    do). Everything still waiting is written out by :meth:`flush` and :meth:`close`, when a step raises an exception,
+    and when the interpreter exits. If the process is killed outright, the steps since the last batch will run again
+    next time. Failed writes are retried with the next batch, and raised from the next flush or close.
+
+    Args:
+        inner (StateBackend): The backend to write to.
+        max_pending (int): Max number of values to hold before writing them out.
+        interval (float): Max number of seconds to hold a value before writing it out.
+    """
+    def __init__(self, inner, max_pending=32, interval=5.0):
+        self.inner = inner
+        self.max_pending = max_pending
+        self.interval = interval
+
+        self._pending = {}
+        self._flushing = {}
+        self._closed = False
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # held while writing to inner, so that batches go out in order
+        self._inner_lock = threading.Lock()
+        # held while reading from inner. reads don't take _inner_lock, so that they never wait for a batch being written
+        self._read_lock = threading.Lock()
+
+        self._thread = None
+        _live_write_behind.add(self)
+
+    def _run(self):
+        # only runs while something is waiting to be written, and gets started again by the next set
+        with self._cond:
+            while self._pending and not self._closed:
+                self._cond.wait_for(lambda: self._closed or len(self._pending) >= self.max_pending, timeout=self.interval)
+                if self._closed:
+                    break
+
+                self._cond.release()
+                try:
+                    self._write_pending()
+                except Exception:
+                    pass # the batch stays pending, so it's retried next time
+                finally:
+                    self._cond.acquire()
+            self._thread = None
+
+    def _write_pending(self) -> None:
+        with self._inner_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._flushing = batch
+            if not batch:
+                return
+
+            try:
+                self.inner.set_many(batch)
+            except Exception:
+                with self._lock:
+                    # put the batch back, without clobbering anything that was set since
+                    self._pending = {**batch, **self._pending}
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            if key in self._pending: return self._pending[key]
+            if key in self._flushing: return self._flushing[key]
+        with self._read_lock:
+            return self.inner.get(key)
+
+    def set(self, key: str, value: bytes) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        with self._cond:
+            self._pending.update(items)
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            elif len(self._pending) >= self.max_pending:
+                self._cond.notify()
+
+    def keys(self) -> List[str]:
+        # the buffers are looked at first, so that a batch that finishes being written in between isn't missed
+        with self._lock:
+            buffered = set(self._pending) | set(self._flushing)
+        with self._read_lock:
+            return list(set(self.inner.keys()) | buffered)
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        ret = {}
+        with self._lock:
+            for key in keys:
+                if key in self._pending: ret[key] = self._pending[key]
+                elif key in self._flushing: ret[key] = self._flushing[key]
+        with self._read_lock:
+            ret.update(self.inner.get_many([key for key in keys if key not in ret]))
+        return ret
+
+    def delete_many(self, keys: List[str]) -> None:
+        self.flush()
+        with self._inner_lock:
+            self.inner.delete_many(keys)
+
+    def compact(self) -> None:
+        self.flush()
+        with self._inner_lock:
+            self.inner.compact()
+
+    def flush(self) -> None:
+        self._write_pending()
+        self.inner.flush()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None: thread.join()
+        self.flush()
+        self.inner.close()
+        _live_write_behind.discard(self)
+
+
+_live_write_behind = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all_at_exit():
+    for state in list(_live_write_behind):
+        try:
+            state.flush()
+        except Exception as e:
+            print(f"WARNING: couldn't save pyfra env state: {e}")
+
+
+def collect_garbage(rem, heads=(), max_age=30 * 86400, max_entries=None, max_kv_age=None, dry_run=False) -> Dict[str, int]:
+    """
+    Drop state entries that nothing uses anymore, along with their blobs, and compact the state. Every run of a script
+    adds a chain of entries for the steps run in each env, each one pointing at the step before it; when a script is
+    edited, the entries after the edit are left behind on a chain that will never be reached again.
+
+    Envs record their hash as a head entry at the end of a run, and entries on the chain leading up to a head that was
+    recorded in the last max_age seconds, or to one of heads, are always kept. Other entries are kept if they or anything
+    further down their chain were last used in the last max_age seconds. Entries are written again when they're used
+    (at most once a day, see :func:`needs_refresh`), and so are heads, so chains that are still in use stay even if none
+    of their steps had to run again.
+
+    Entries that aren't part of any chain, like the results of :func:`pyfra.remote.stage`, values cached with
+    :func:`pyfra.idempotent.cache` and other :meth:`pyfra.remote.Remote.set_kv` calls, are only dropped if max_kv_age is
+    set. Entries from before pyfra kept track of any of this are always kept. See also
+    :meth:`pyfra.remote.Remote.gc_state`, and :code:`python -m pyfra gc`.
+
+    Args:
+        rem (Remote): The remote whose state to clean up.
+        heads (List[str]): Env hashes whose chains to keep no matter how old.
+        max_age (float): Max number of seconds since an entry's chain was last used, or its head was last recorded.
+        max_entries (int): If set, keep at most this many entries on chains that aren't kept because of a head, dropping the ones whose chains were used longest ago first.
+        max_kv_age (float): If set, also drop entries that aren't part of a chain once they haven't been used for this many seconds.
+        dry_run (bool): Only count what would be dropped.
+
+    Returns:
+        A dict with the number of "entries" there were, how many were "dropped", and how many "blobs" were deleted.
+    """
+    state = rem._state()
+    entries = {key: unpack_entry(data) for key, data in state.get_many(state.keys()).items()}
+    parent = lambda key: entries[key][2] if key in entries else None
+    now = time.time()
+
+    # entries without a parent aren't steps of an env, and heads always have one
+    unchained = {key for key, (_, ts, par) in entries.items() if ts is not None and par is None}
+    exempt = {key for key in unchained if max_kv_age is None or now - entries[key][1] <= max_kv_age}
+
+    recorded_heads = [key for key in entries if key.startswith("head:") and now - (entries[key][1] or 0) <= max_age]
+    pinned = set()
+    for key in list(heads) + recorded_heads + [key for key, (_, ts, _) in entries.items() if ts is None]:
+        while key is not None and key not in pinned:
+            pinned.add(key)
+            key = parent(key)
+
+    # the newest use anywhere down each entry's chain. going from newest to oldest, a chain only needs
+    # to be walked up to the first entry that a newer use already got to
+    last_used = {}
+    for key in sorted(entries.keys() - unchained, key=lambda key: entries[key][1] or 0, reverse=True):
+        ts = entries[key][1] or 0
+        while key is not None and key not in last_used:
+            last_used[key] = ts
+            key = parent(key)
+
+    chained = entries.keys() - unchained - pinned
+    keep = pinned | exempt | {key for key in chained if now - last_used[key] <= max_age}
+    if max_entries is not None:
+        kept = sorted(keep & chained, key=lambda key: last_used[key], reverse=True)
+        keep = pinned | exempt | set(kept[:max_entries])
+    drop = [key for key in entries if key not in keep]
+
+    blob_refs = lambda keys: {BlobStore.digest(entries[key][0]) for key in keys if key in entries and BlobStore.is_ref(entries[key][0])}
+    unused_blobs = blob_refs(drop) - blob_refs(keep)
+
+    if not dry_run:
+        if drop:
+            state.delete_many(drop)
+        BlobStore(rem).delete(sorted(unused_blobs))
+        state.compact()
+
+    return {"entries": len(entries), "dropped": len(drop), "blobs": len(unused_blobs)}
+
+
+state_backends = {
+    "journal": JournalState,
+    "sqlite": SQLiteState,
+}
@@ -0,0 +1,156 @@
+from pyfra import *
+import pyfra.downloader
+import hashlib
+import http.server
+import os
+import threading
+import pytest
+
+
+payload = os.urandom(3 * 1024**2 + 12345)
+requests_seen = []
+client_ports = set()
+fail_ranges = set()
+support_ranges = True
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """ A stand-in for a file server that supports range requests and keep-alive, like most CDNs do """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        rng = self.headers.get("Range")
+        requests_seen.append(rng)
+        client_ports.add(self.client_address[1])
+
+        if not self.path.startswith("/data.bin"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if rng is None or not support_ranges:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        start, end = rng.split("=")[1].split("-")
+        start, end = int(start), min(int(end), len(payload) - 1)
+        if start in fail_ranges:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(payload)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", '"goose"')
+        self.end_headers()
+        self.wfile.write(payload[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+def setup_module(module):
+    global server, url
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/data.bin"
+
+
+def teardown_module(module):
+    server.shutdown()
+
+
+def setup_function(function):
+    global support_ranges
+    requests_seen.clear()
+    client_ports.clear()
+    fail_ranges.clear()
+    support_ranges = True
+
+
+def test_parallel_download(tmp_path):
+    checksum = hashlib.sha256(payload).hexdigest()
+    copy(url, str(tmp_path / "data.bin"), connections=4, checksum=checksum, quiet=True)
+
+    assert (tmp_path / "data.bin").read_bytes() == payload
+    assert len([r for r in requests_seen if r != "bytes=0-0"]) == 4
+    assert not (tmp_path / "data.bin.pyfra_part").exists()
+
+
+def test_resume(tmp_path):
+    chunk_size = 1024**2
+
+    # fail one piece so the download is interrupted partway through
+    fail_ranges.add(2 * chunk_size)
+    with pytest.raises(Exception):
+        pyfra.downloader.download(url, str(tmp_path / "data.bin"), connections=2, chunk_size=chunk_size, max_tries=1)
+    assert (tmp_path / "data.bin.pyfra_part.json").exists()
+
+    # only the missing piece should get fetched again
+    fail_ranges.clear()
+    requests_seen.clear()
+    pyfra.downloader.download(url, str(tmp_path / "data.bin"), connections=2, chunk_size=chunk_size)
+
+    assert (tmp_path / "data.bin").read_bytes() == payload
+    assert requests_seen == ["bytes=0-0", f"bytes={2 * chunk_size}-{3 * chunk_size - 1}"]
+
+
+def test_checksum_mismatch(tmp_path):
+    with pytest.raises(pyfra.downloader.ChecksumError):
+        pyfra.downloader.download(url, str(tmp_path / "data.bin"), checksum="0" * 64)
+    assert not (tmp_path / "data.bin").exists()
+    assert not (tmp_path / "data.bin.pyfra_part").exists()
+
+
+def test_no_range_support(tmp_path):
+    global support_ranges
+    support_ranges = False
+
+    pyfra.downloader.download(url, str(tmp_path))
+    assert (tmp_path / "data.bin").read_bytes() == payload
+
+
+def test_curl_many(tmp_path):
+    urls = [url + f"?page={i}" for i in range(20)] + [url.replace("data.bin", "missing")]
+
+    results = curl_many(urls, dest=lambda u: str(tmp_path / u.split("/")[-1]), concurrency=4)
+
+    assert [r.url for r in results] == urls
+    # connections are reused rather than opened per url
+    assert len(client_ports) <= 4
+    for r in results[:-1]:
+        assert r.status == 200 and r.error is None
+        assert open(r.path, "rb").read() == payload
+    assert results[-1].status == 404 and results[-1].error is not None
+    assert not os.path.exists(results[-1].path)
+
+    assert curl(url) == payload
+
+
+def test_curl_many_name_collision(tmp_path):
+    with pytest.raises(ValueError):
+        curl_many([url + "?page=1", url + "?page=2"], dest=str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+    results = curl_many([url], dest=str(tmp_path))
+    assert open(tmp_path / "data.bin", "rb").read() == payload and results[0].error is None
+
+
+def test_local_errors_not_retried(tmp_path):
+    tries = []
+
+    def _f():
+        tries.append(1)
+        raise FileNotFoundError(2, "No such file or directory")
+    with pytest.raises(FileNotFoundError):
+        pyfra.downloader._with_retries(_f, max_tries=5)
+    assert len(tries) == 1
+
+    assert pyfra.downloader._retryable(ConnectionResetError())
+    assert not pyfra.downloader._retryable(PermissionError())
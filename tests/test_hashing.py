@@ -0,0 +1,266 @@
+from pyfra import *
+import pyfra._remote_helper
+import pyfra.shell
+import hashlib
+import inspect
+import json
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import imohash
+
+
+def make_tree(root):
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "x.txt").write_text("goose")
+    (root / "a" / "y.txt").write_text("duck")
+    (root / "a" / "b" / "z.bin").write_bytes(os.urandom(20 * 1024**2))
+    (root / "link.txt").symlink_to(root / "x.txt")
+
+
+def test_quick_hash_dir_incremental(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYFRA_CACHE_DIR", str(tmp_path / "cache"))
+    make_tree(tmp_path / "data")
+
+    first = pyfra.shell.quick_hash(str(tmp_path / "data"))
+    assert pyfra.shell.quick_hash(str(tmp_path / "data")) == first
+
+    # only the file that changed should get hashed again
+    hashed = []
+    original_hashfile = pyfra._remote_helper.quick_hash_file
+    monkeypatch.setattr(pyfra._remote_helper, "quick_hash_file", lambda fname: hashed.append(fname) or original_hashfile(fname))
+
+    (tmp_path / "data" / "a" / "y.txt").write_text("swan!")
+    changed = pyfra.shell.quick_hash(str(tmp_path / "data"))
+
+    assert changed != first
+    assert hashed == [str(tmp_path / "data" / "a" / "y.txt")]
+
+
+def test_metadata_cache_persists(tmp_path, monkeypatch):
+    import pyfra.remote as pyr
+
+    monkeypatch.setenv("PYFRA_CACHE_DIR", str(tmp_path / "cache"))
+    (tmp_path / "goose.txt").write_text("honk")
+    path = local.path(str(tmp_path / "goose.txt"))
+
+    hashed = []
+    original_quick_hash = pyfra.shell.quick_hash
+    monkeypatch.setattr(pyfra.shell, "quick_hash", lambda fname: hashed.append(fname) or original_quick_hash(fname))
+
+    monkeypatch.setattr(pyr, "_metadata_cache", pyr._MetadataCache())
+    first = path.quick_hash()
+    assert path.quick_hash() == first
+    assert len(hashed) == 1
+
+    # a fresh cache object, like in a new process, still hits
+    monkeypatch.setattr(pyr, "_metadata_cache", pyr._MetadataCache())
+    assert path.quick_hash() == first
+    assert len(hashed) == 1
+
+    # but not once the file changes
+    (tmp_path / "goose.txt").write_text("honk honk")
+    assert path.quick_hash() != first
+    assert len(hashed) == 2
+
+
+def test_remote_helper_matches_local(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYFRA_CACHE_DIR", str(tmp_path / "cache"))
+    make_tree(tmp_path / "data")
+    paths = [str(tmp_path / "data"), str(tmp_path / "data" / "x.txt"), str(tmp_path / "data" / "a" / "b" / "z.bin"), str(tmp_path / "missing")]
+
+    # run the payload the same way remotes do, but without mmh3 like on a bare machine
+    request = json.dumps({"op": "quick_hash_many", "paths": paths, "manifest_dir": str(tmp_path / "remote_cache")})
+    payload = "import sys; sys.modules['mmh3'] = None\n" + inspect.getsource(pyfra._remote_helper) + f"\nmain({request!r})\n"
+    out = subprocess.run([sys.executable, "-c", payload], check=True, stdout=subprocess.PIPE).stdout.decode()
+    remote_hashes = json.loads(out.strip().split("\n")[-1])
+
+    for path in paths[:-1]:
+        assert remote_hashes[path] == pyfra.shell.quick_hash(path)
+    for path in paths[1:3]:
+        assert remote_hashes[path] == imohash.hashfile(path, hexdigest=True, sample_size=4 * 1024**2, sample_threshhold=16 * 1024**2)
+    assert remote_hashes[paths[-1]] is None
+
+    assert local.quick_hash_many(paths) == [remote_hashes[path] for path in paths]
+
+
+def test_dir_hash_threads(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    (tmp_path / "data").mkdir()
+    for i in range(50):
+        (tmp_path / "data" / f"{i}.txt").write_text(str(i))
+
+    # threads hashing the same directory each write the manifest through a temp file of their own
+    with ThreadPoolExecutor(8) as executor:
+        hashes = list(executor.map(lambda _: pyfra._remote_helper.quick_hash(str(tmp_path / "data"), manifest_dir=str(tmp_path / "cache")), range(8)))
+    assert len(set(hashes)) == 1
+    assert not [f for f in os.listdir(tmp_path / "cache") if f.endswith(".tmp")]
+
+
+def test_merkle_tree(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYFRA_CACHE_DIR", str(tmp_path / "cache"))
+    make_tree(tmp_path / "data")
+    make_tree(tmp_path / "other")
+    src, dst = local.path(str(tmp_path / "data")), local.path(str(tmp_path / "other"))
+
+    tree = src.merkle_tree()
+    assert tree["hash"] == pyfra.shell.quick_hash(str(tmp_path / "data"))
+    assert tree["dirs"]["a"]["hash"] == pyfra.shell.quick_hash(str(tmp_path / "data" / "a"))
+    assert local.path(str(tmp_path / "data" / "x.txt")).merkle_tree() is None
+
+    # z.bin is random, so it differs; y.txt is the same on both sides
+    assert src.diff(dst) == ["a/b/z.bin"]
+
+    (tmp_path / "data" / "c").mkdir()
+    (tmp_path / "data" / "c" / "w.txt").write_text("swan")
+    (tmp_path / "other" / "extra.txt").write_text("only here")
+    assert src.diff(dst) == ["a/b/z.bin", "c"]
+    assert dst.diff(src) == ["extra.txt", "a/b/z.bin"]
+
+
+@pytest.mark.skipif(shutil.which("rsync") is None, reason="needs rsync")
+def test_partial_copy(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYFRA_CACHE_DIR", str(tmp_path / "cache"))
+    make_tree(tmp_path / "data")
+    src = local.path(str(tmp_path / "data"))
+
+    copy(src, str(tmp_path / "out"), symlink_ok=False, quiet=True)
+    dst = local.path(str(tmp_path / "out" / "data"))
+    assert src.diff(dst) == []
+
+    (tmp_path / "data" / "a" / "b" / "new.txt").write_text("goose")
+    (tmp_path / "data" / "c").mkdir()
+    (tmp_path / "data" / "c" / "w.txt").write_text("swan")
+    (tmp_path / "out" / "data" / "extra.txt").write_text("only here")
+    assert src.diff(dst) == ["a/b/new.txt", "c"]
+
+    copy(src, str(tmp_path / "out"), symlink_ok=False, quiet=True, partial=True)
+    assert src.diff(dst) == []
+    assert (tmp_path / "out" / "data" / "c" / "w.txt").read_text() == "swan"
+    assert (tmp_path / "out" / "data" / "extra.txt").exists()
+
+
+def test_sha256sum_many(tmp_path):
+    make_tree(tmp_path / "data")
+    fname = str(tmp_path / "data" / "a" / "b" / "z.bin")
+    expected = hashlib.sha256(open(fname, "rb").read()).hexdigest()
+
+    file_hash, dir_hashes, missing = local.sha256sum_many([fname, str(tmp_path / "data"), str(tmp_path / "missing")])
+    assert file_hash == expected
+    assert dir_hashes[os.path.join("a", "b", "z.bin")] == expected
+    assert dir_hashes["x.txt"] == dir_hashes["link.txt"] == hashlib.sha256(b"goose").hexdigest()
+    assert missing is None
+    assert local.path(fname).sha256sum() == expected
+
+
+def test_copy_verify(tmp_path):
+    make_tree(tmp_path / "data")
+    (tmp_path / "out").mkdir()
+    shutil.copytree(str(tmp_path / "data"), str(tmp_path / "out" / "data"))
+    src, dst = local.path(str(tmp_path / "data")), local.path(str(tmp_path / "out"))
+
+    pyfra.shell._verify_copy(src, dst, into=True, exclude=[])
+    pyfra.shell._verify_copy(local.path(str(tmp_path / "data" / "x.txt")), local.path(str(tmp_path / "out" / "data")), into=True, exclude=[])
+
+    # corrupt a byte in the middle of the big file, which quick_hash wouldn't notice
+    with open(tmp_path / "out" / "data" / "a" / "b" / "z.bin", "r+b") as fh:
+        fh.seek(10 * 1024**2 - 5 * 1024**2 // 2)
+        fh.write(b"!")
+    with pytest.raises(CopyVerificationError) as e:
+        pyfra.shell._verify_copy(src, dst, into=True, exclude=[])
+    assert e.value.mismatched == [os.path.join("a", "b", "z.bin")]
+
+    # excluded files are never expected at the destination
+    pyfra.shell._verify_copy(src, dst, into=True, exclude=["z.bin"])
+
+
+def test_cache_arg_hashing():
+    import dataclasses
+    import pyfra.idempotent as idem
+    np = pytest.importorskip("numpy")
+
+    h = lambda *args, **kwargs: idem._hash_args(args, kwargs)
+    assert h({"a": 1, "b": [2]}) == h({"b": [2], "a": 1})
+    assert h({1: "a", "b": 2}) == h({"b": 2, 1: "a"})
+    assert len({h(1), h(True), h(1.0), h("1"), h([1]), h((1,)), h({1}), h(None)}) == 8
+    assert h([1, 2], x=3) != h([12], x=3) != h([1, 2], y=3)
+
+    arr = np.arange(1000).reshape(10, 100)
+    assert h(arr) == h(arr.copy()) != h(arr.astype(np.float64)) != h(arr.T)
+    dates = np.array(["2020-01-01", "2021-06-01"], dtype="datetime64[ns]")
+    assert h(dates) == h(dates.copy()) != h(dates.astype("datetime64[s]")) != h(dates - np.timedelta64(1, "ns"))
+    assert h(np.array([1, 2], dtype="timedelta64[s]")) != h(np.array([1, 3], dtype="timedelta64[s]"))
+
+    @dataclasses.dataclass
+    class Point:
+        x: int
+        y: list
+    assert h(Point(1, [2])) == h(Point(1, [2])) != h(Point(1, [3]))
+
+    # registering a hashing function applies to subclasses too, even for types that were hashed before
+    class Goose(list): pass
+    before = h(Goose([1]))
+    idem.special_hashing[Goose] = lambda x: "honk"
+    try:
+        assert h(Goose([1])) != before
+        assert h(Goose([1])) == h(Goose([2]))
+    finally:
+        del idem.special_hashing[Goose]
+    assert h(Goose([1])) == before
+
+    # every way of changing special_hashing takes effect
+    idem.special_hashing.setdefault(Goose, lambda x: "honk")
+    assert h(Goose([1])) == h(Goose([2]))
+    idem.special_hashing.pop(Goose)
+    assert h(Goose([1])) == before
+    idem.special_hashing |= {Goose: lambda x: "honk"}
+    assert h(Goose([1])) == h(Goose([2]))
+    del idem.special_hashing[Goose]
+
+
+def test_cache_uses_arg_hash():
+    import pyfra.idempotent as idem
+
+    class DictKVStore(idem.KVStoreProvider):
+        def __init__(self): self.data = {}
+        def get(self, key): return self.data[key]
+        def set(self, key, value): self.data[key] = value
+
+    calls = []
+    kv = DictKVStore()
+
+    @cache("double_v0", kvstore=kv)
+    def double(xs, scale=2):
+        calls.append(xs)
+        return [x * scale for x in xs]
+
+    assert double([1, 2]) == double([1, 2]) == [2, 4]
+    assert double([1, 2], scale=3) == [3, 6]
+    assert len(calls) == 2
+
+
+def test_hash_array_datetime(tmp_path):
+    import pyfra.remote as pyr
+    np = pytest.importorskip("numpy")
+
+    arr = np.array(["2020-01-01", "2021-06-01"], dtype="datetime64[ns]")
+    arrhash = local.path(str(tmp_path / "dates.npy")).np_save(arr)
+    assert arrhash == pyr._hash_array(local.path(str(tmp_path / "dates.npy")).np_load())
+    assert arrhash != pyr._hash_array(arr.astype("datetime64[s]"))
+    assert pyr._hash_array(np.array([1, 2], dtype="timedelta64[s]")) != pyr._hash_array(np.array([1, 3], dtype="timedelta64[s]"))
+
+
+def test_trim_cache(tmp_path):
+    import pyfra.remote as pyr
+
+    for i in range(5):
+        (tmp_path / f"{i}.npy").write_bytes(b"x" * 100)
+        os.utime(tmp_path / f"{i}.npy", (1000 + i, 1000 + i))
+    # used again recently, so it's kept over newer files
+    os.utime(tmp_path / "0.npy")
+
+    pyr._trim_cache(str(tmp_path), 250, keep=[str(tmp_path / "1.npy")])
+    assert sorted(os.listdir(tmp_path)) == ["0.npy", "1.npy"]
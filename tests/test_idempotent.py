@@ -0,0 +1,209 @@
+from pyfra import *
+import pyfra.idempotent as idem
+import asyncio
+import multiprocessing
+import pytest
+import time
+
+
+class DictKVStore(idem.KVStoreProvider):
+    def __init__(self):
+        self.data = {}
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return self.data[key]
+
+    def set(self, key, value):
+        self.data[key] = value
+
+
+def test_memo():
+    inner = DictKVStore()
+    inner.set("a", [1, 2])
+    memo = idem.MemoKVStore(inner, max_entries=2)
+
+    assert memo.get("a") == [1, 2]
+    memo.get("a").append(3)
+    # the memo hands out copies, and only went to the inner store once
+    assert memo.get("a") == [1, 2] and inner.gets == 1
+    with pytest.raises(KeyError):
+        memo.get("missing")
+
+    memo.set("b", "goose")
+    memo.get("a")
+    memo.set("c", "duck")
+    # b was used least recently, so it's the one that got dropped
+    assert memo.get("a") == [1, 2] and memo.get("c") == "duck" and inner.gets == 2
+    assert memo.get("b") == "goose" and inner.gets == 3
+
+    by_ref = idem.MemoKVStore(inner, by_reference=True)
+    assert by_ref.get("a") is by_ref.get("a")
+
+
+def test_memo_max_bytes():
+    inner = DictKVStore()
+    memo = idem.MemoKVStore(inner, max_bytes=3000)
+    memo.set("a", b"x" * 1000)
+    memo.set("b", b"x" * 1000)
+    memo.set("c", b"x" * 1000)
+    memo.set("too_big", b"x" * 5000)
+    assert list(memo._memo) == ["b", "c"] and memo._nbytes <= 3000
+
+    # a value that's too big to keep doesn't leave the old one behind in the memo
+    memo.set("b", b"x" * 5000)
+    assert memo.get("b") == b"x" * 5000
+    assert list(memo._memo) == ["c"] and memo._nbytes == len(memo._memo["c"][0])
+
+    # a memoized cache still runs the function once per input
+    calls = []
+
+    @cache("square_v0", kvstore=memo)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert [square(i % 3) for i in range(30)] == [(i % 3) ** 2 for i in range(30)]
+    assert calls == [0, 1, 2]
+
+
+class SlowKVStore(DictKVStore):
+    thread_safe = True
+
+    def get(self, key):
+        time.sleep(0.2)
+        return super().get(key)
+
+
+class UnsafeKVStore(DictKVStore):
+    """ Fails if it's used from two threads at once """
+    def __init__(self):
+        super().__init__()
+        self.busy = False
+
+    def get(self, key):
+        assert not self.busy
+        self.busy = True
+        try:
+            time.sleep(0.01)
+            return super().get(key)
+        finally:
+            self.busy = False
+
+
+def test_kvstore_not_thread_safe():
+    kv = UnsafeKVStore()
+    kv.set_many({f"k{i}": i for i in range(8)})
+    assert kv.get_many([f"k{i}" for i in range(10)]) == {f"k{i}": i for i in range(8)}
+
+    async def main():
+        return await asyncio.gather(*[kv.aget(f"k{i}") for i in range(8)])
+    assert asyncio.run(main()) == list(range(8))
+
+    # wrappers go by the store they wrap
+    assert not idem.CompressedKVStore(kv).thread_safe and idem.MemoKVStore(SlowKVStore()).thread_safe
+
+
+def test_batched_and_async_kvstore():
+    kv = SlowKVStore()
+    kv.set_many({f"k{i}": i for i in range(8)})
+    start = time.time()
+    assert kv.get_many([f"k{i}" for i in range(10)]) == {f"k{i}": i for i in range(8)}
+    # the lookups ran concurrently
+    assert time.time() - start < 1
+
+    async def main():
+        # slow lookups don't hold up other tasks
+        ticks = []
+        async def tick():
+            for _ in range(5):
+                ticks.append(time.time())
+                await asyncio.sleep(0.02)
+        value, _ = await asyncio.gather(kv.aget("k1"), tick())
+        await kv.aset("k9", 9)
+        return value, ticks
+
+    value, ticks = asyncio.run(main())
+    assert value == 1 and kv.data["k9"] == 9 and ticks[-1] - ticks[0] < 0.15
+
+
+def test_cache_async_and_map():
+    kv = SlowKVStore()
+    calls = []
+
+    @cache("slow_square_v0", kvstore=kv)
+    async def slow_square(x):
+        calls.append(x)
+        return x * x
+
+    async def main():
+        return await asyncio.gather(*[slow_square(i) for i in range(5)])
+
+    start = time.time()
+    assert asyncio.run(main()) == [0, 1, 4, 9, 16]
+    assert asyncio.run(main()) == [0, 1, 4, 9, 16]
+    assert sorted(calls) == list(range(5)) and time.time() - start < 1
+
+    @cache("square_v0", kvstore=kv)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    calls.clear()
+    assert square.map([1, 2, 2, 3]) == [1, 4, 4, 9]
+    start = time.time()
+    assert square.map(range(5)) == [0, 1, 4, 9, 16]
+    assert calls == [1, 2, 3, 0, 4] and time.time() - start < 0.5
+    # the results are stored the same way as by a normal call
+    assert square(4) == 16 and calls == [1, 2, 3, 0, 4]
+
+
+def _hammer(root, worker):
+    kv = idem.DirectoryKVStore(root)
+    for i in range(200):
+        kv.set("shared", [worker] * 10000)
+        assert len(kv.get("shared")) == 10000
+
+
+def test_directory_kvstore(tmp_path):
+    kv = idem.DirectoryKVStore(str(tmp_path), fsync=True)
+    with pytest.raises(KeyError):
+        kv.get("a")
+    kv.set("a", {"goose": [1, 2]})
+    kv.set("a", {"goose": [3]})
+    assert kv.get("a") == {"goose": [3]}
+    assert kv.get_many(["a", "b"]) == {"a": {"goose": [3]}}
+
+    # one file per key, two levels of shards down, and no temp files left behind
+    files = [p for p in tmp_path.rglob("*") if p.is_file()]
+    assert len(files) == 1 and len(files[0].relative_to(tmp_path).parts) == 3
+
+    # concurrent writers never leave a partly written value for readers to find
+    procs = [multiprocessing.Process(target=_hammer, args=(str(tmp_path), worker)) for worker in range(4)]
+    for p in procs: p.start()
+    for p in procs: p.join()
+    assert all(p.exitcode == 0 for p in procs)
+    assert len(set(kv.get("shared"))) == 1
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_compressed_kvstore():
+    inner = DictKVStore()
+    inner.set("old", [1, 2, 3])
+    kv = idem.CompressedKVStore(inner, codec="lzma", min_size=100)
+
+    text = "the quick brown goose jumps over the lazy duck " * 1000
+    kv.set("big", text)
+    kv.set("small", "honk")
+    assert len(inner.data["big"]) < len(text) / 10
+    assert inner.data["small"][4] == 0 # stored uncompressed
+    assert kv.get("big") == text and kv.get("small") == "honk"
+
+    # the codec is in the header, so switching codecs doesn't break anything stored earlier
+    kv = idem.CompressedKVStore(inner, codec="zlib")
+    assert kv.get_many(["big", "small", "old", "missing"]) == {"big": text, "small": "honk", "old": [1, 2, 3]}
+    assert asyncio.run(kv.aget("big")) == text
+
+    with pytest.raises(ValueError):
+        idem.CompressedKVStore(inner, codec="nope")
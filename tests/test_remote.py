@@ -2,6 +2,7 @@ from pyfra import *
 import pyfra.remote as pyr
 import os
 import random
+import pytest
 
 
 def setup_remote(ind):
@@ -170,6 +171,133 @@ def test_fns():
     for rem in [local, rem1, rem2, env1, env2, locenv1, locenv2]: fns_test(rem)
 
 
+def test_csvread():
+    global rem1
+
+    for rem in [local, rem1]:
+        rem.path("testfile.tsv").write("a\tb\tc\n1\t2.5\tgoose\n2\t\tduck\n3\t4")
+
+        assert list(rem.path("testfile.tsv").csvread()) == [
+            {"a": "1", "b": "2.5", "c": "goose"},
+            {"a": "2", "b": "", "c": "duck"},
+            {"a": "3", "b": "4", "c": None},
+        ]
+        assert list(rem.path("testfile.tsv").csvread(usecols=["c"])) == [{"c": "goose"}, {"c": "duck"}, {"c": None}]
+        assert rem.path("testfile.tsv").csvread(usecols=["a", "b"], columns="list") == {"a": [1, 2, 3], "b": [2.5, None, 4.0]}
+
+        # stopping early shouldn't hang or raise
+        rows = rem.path("testfile.tsv").csvread()
+        assert next(rows)["c"] == "goose"
+        rows.close()
+
+        rem.rm("testfile.tsv")
+
+
+def test_csvwrite():
+    global rem1
+
+    for rem in [local, rem1]:
+        rem.rm("testfile.csv")
+        rem.path("testfile.csv").csvwrite({"a": i, "b": i * 2} for i in range(3))
+        rem.path("testfile.csv").csvwrite(({"a": i, "b": i * 2} for i in range(3, 5)), append=True)
+
+        assert rem.path("testfile.csv").csvread(columns="list") == {"a": [0, 1, 2, 3, 4], "b": [0, 2, 4, 6, 8]}
+
+        rem.rm("testfile.csv")
+
+
+def test_jsonlines():
+    global rem1
+
+    for rem in [local, rem1]:
+        for fname in ["testfile.jsonl", "testfile.jsonl.gz", "testfile.jsonl.xz"]:
+            rem.path(fname).jlwrite(({"honk": i} for i in range(1000)), batch_size=64)
+            rem.path(fname).jlwrite([{"honk": "goose"}], append=True)
+
+            assert list(rem.path(fname).jlread()) == [{"honk": i} for i in range(1000)] + [{"honk": "goose"}]
+
+            rem.rm(fname)
+
+
+def test_numpy():
+    global rem1
+    np = pytest.importorskip("numpy")
+
+    arr = np.arange(1000, dtype=np.float32).reshape(10, 100)
+    for rem in [local, rem1]:
+        arrhash = rem.path("testfile.npy").np_save(arr)
+        loaded = rem.path("testfile.npy").np_load()
+        assert isinstance(loaded, np.memmap)
+        assert (loaded == arr).all()
+        assert arrhash == pyr._hash_array(loaded)
+
+        rem.path("testfile.npz").np_save({"a": arr, "b": arr * 2})
+        assert (rem.path("testfile.npz").np_load()["b"] == arr * 2).all()
+
+        rem.rm("testfile.npy")
+        rem.rm("testfile.npz")
+
+
+def test_broadcast():
+    global rem1, rem2
+
+    sh("rm -rf broadcast_test_dir; mkdir broadcast_test_dir; echo honk > broadcast_test_dir/goose.txt")
+    tos = [rem1.path("broadcast_1"), rem2.path("broadcast_1"), rem1.path("broadcast_2"), rem2.path("broadcast_2"), local.path("broadcast_3")]
+    broadcast(local.path("broadcast_test_dir"), tos)
+
+    for to in tos:
+        assert to.remote.sh(f"cat {to.fname}/broadcast_test_dir/goose.txt") == "honk"
+
+    sh("rm -rf broadcast_test_dir broadcast_3")
+    for rem in [rem1, rem2]:
+        rem.sh("rm -rf broadcast_1 broadcast_2")
+
+
+def test_gather():
+    global rem1, rem2
+
+    for rem in [rem1, rem2]:
+        rem.sh(f"echo {rem.ip} > gather_test.txt")
+
+    manifest = gather([rem1.path("gather_test.txt"), rem2.path("gather_test.txt")], "gather_test_dir")
+    assert [entry["status"] for entry in manifest] == ["fetched", "fetched"]
+    for rem in [rem1, rem2]:
+        assert local.path(f"gather_test_dir/{rem.ip}/gather_test.txt").read().strip() == rem.ip
+
+    # already up to date, so nothing gets copied again
+    manifest = gather([rem1.path("gather_test.txt"), rem2.path("gather_test.txt")], "gather_test_dir")
+    assert [entry["status"] for entry in manifest] == ["skipped", "skipped"]
+
+    # excluded gathers can't be compared by hash, so they're always copied again
+    manifest = gather([rem1.path("gather_test.txt")], "gather_test_dir", exclude=["*.tmp"])
+    assert manifest[0]["status"] == "fetched" and manifest[0]["hash"] is None
+
+    # files with the same name from the same host would overwrite each other
+    with pytest.raises(ValueError):
+        gather([rem1.path("gather_test.txt"), rem1.path("other/gather_test.txt")], "gather_test_dir")
+
+    sh("rm -rf gather_test_dir")
+    for rem in [rem1, rem2]:
+        rem.rm("gather_test.txt")
+
+
+def test_quick_hash_matches_local():
+    global rem1, rem2
+
+    local.path("quick_hash_test.bin").write(os.urandom(20 * 1024**2).hex())
+    copy(local.path("quick_hash_test.bin"), rem1.path("quick_hash_test.bin"))
+
+    assert rem1.path("quick_hash_test.bin").quick_hash() == local.path("quick_hash_test.bin").quick_hash()
+    assert rem1.quick_hash_many(["quick_hash_test.bin", "does_not_exist"]) == [local.path("quick_hash_test.bin").quick_hash(), None]
+
+    copy(rem1.path("quick_hash_test.bin"), rem2.path("quick_hash_test.bin"), verify=True)
+    assert rem2.sha256sum_many(["quick_hash_test.bin"]) == [local.path("quick_hash_test.bin").sha256sum()]
+    rem2.rm("quick_hash_test.bin")
+
+    rem1.rm("quick_hash_test.bin")
+    local.rm("quick_hash_test.bin")
+
+
 def test_remotefile_implicit_copy():
     global rem1, rem2
 
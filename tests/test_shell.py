@@ -0,0 +1,26 @@
+from pyfra import *
+import pyfra.shell
+import pytest
+
+
+def test_broadcast_retries(tmp_path, monkeypatch):
+    (tmp_path / "src").write_text("honk")
+    tos = [str(tmp_path / f"dst{i}") for i in range(6)]
+    copies = []
+
+    def copy(src, to, **kwargs):
+        copies.append((src.fname, to.fname))
+        # dst1 fails the first time, dst5 always does
+        if to.fname.endswith("dst5") or (to.fname.endswith("dst1") and sum(t == to.fname for _, t in copies) == 1):
+            raise pyfra.shell.ShellException(255, rem=True)
+    monkeypatch.setattr(pyfra.shell, "copy", copy)
+
+    with pytest.raises(pyfra.shell.BroadcastError) as e:
+        broadcast(str(tmp_path / "src"), tos, max_parallel=2, max_tries=3)
+
+    # the failure didn't stop the rest, and only the destination that kept failing is reported
+    assert list(e.value.failures) == [tos[5]]
+    assert {to for _, to in copies} == set(tos)
+    dst1_sources = [src for src, to in copies if to == tos[1]]
+    assert len(dst1_sources) == 2 and dst1_sources[0] != dst1_sources[1]
+    assert len([to for _, to in copies if to == tos[5]]) == 3
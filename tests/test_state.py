@@ -0,0 +1,522 @@
+from pyfra import *
+import pyfra._remote_helper
+import pyfra.state
+import multiprocessing
+import base64
+import json
+import os
+import pickle
+import pytest
+import threading
+import time
+
+
+def test_journal_appends(tmp_path):
+    rem = Remote(wd=str(tmp_path), state_durability="step")
+    for i in range(100):
+        rem.set_kv(f"key{i}", {"step": i})
+
+    size = os.path.getsize(tmp_path / ".pyfra_env_state.journal")
+    rem.set_kv("key100", {"step": 100})
+    # each write only adds its own record
+    assert os.path.getsize(tmp_path / ".pyfra_env_state.journal") - size < 100
+
+    # closing drops the state, so it gets read back from the file like in a new process
+    rem.close()
+    rem = Remote(wd=str(tmp_path), state_durability="step")
+    assert [rem.get_kv(f"key{i}") for i in range(101)] == [{"step": i} for i in range(101)]
+    with pytest.raises(KeyError):
+        rem.get_kv("missing")
+    rem.close()
+
+
+def test_journal_torn_tail(tmp_path):
+    rem = Remote(wd=str(tmp_path))
+    rem.set_kv("a", 1)
+    rem.set_kv("b", 2)
+    rem.close()
+
+    # simulate a process dying halfway through writing a record
+    record = pyfra._remote_helper.encode_record("c", pickle.dumps(3))
+    with open(tmp_path / ".pyfra_env_state.journal", "ab") as fh:
+        fh.write(record[:len(record) // 2])
+
+    rem = Remote(wd=str(tmp_path))
+    assert rem.get_kv("b") == 2
+    with pytest.raises(KeyError):
+        rem.get_kv("c")
+
+    # the torn record is skipped, so records appended after it can still be read back
+    rem.set_kv("d", 4)
+    rem.close()
+    rem = Remote(wd=str(tmp_path))
+    assert (rem.get_kv("a"), rem.get_kv("b"), rem.get_kv("d")) == (1, 2, 4)
+    rem.close()
+
+
+def test_journal_compaction(tmp_path):
+    rem = Remote(wd=str(tmp_path), state_durability="step")
+    for i in range(2000):
+        rem.set_kv("same_key", i)
+
+    state = pyfra.state.JournalState(rem)
+    data = state.get("same_key")
+    assert pyfra.state.decode_value(pyfra.state.unpack_entry(data)[0]) == 1999
+    # it got compacted at least once on the way, rather than holding a record for every write
+    assert os.path.getsize(tmp_path / ".pyfra_env_state.journal") <= 1001 * len(pyfra._remote_helper.encode_record("same_key", data))
+    rem.close()
+
+
+def test_journal_corrupt_record_skipped(tmp_path):
+    journal = str(tmp_path / "journal")
+    good = [pyfra._remote_helper.encode_record(k, pickle.dumps(v)) for k, v in [("a", 1), ("b", 2), ("c", 3)]]
+    # flip a byte in the value of the middle record
+    bad = bytearray(good[1])
+    bad[-1] ^= 0xff
+    with open(journal, "wb") as fh:
+        fh.write(good[0] + bytes(bad) + good[2])
+
+    _, _, data = pyfra._remote_helper.journal_read(journal)
+    records, end = pyfra._remote_helper.decode_records(data)
+    assert [k for k, _ in records] == ["a", "c"]
+    assert end == len(data)
+
+
+def test_journal_two_processes(tmp_path):
+    # two backends on the same env stand in for two processes, each with its own copy of the state
+    rem = Remote(wd=str(tmp_path))
+    first = pyfra.state.JournalState(rem)
+    second = pyfra.state.JournalState(rem)
+
+    first.set("a", b"1")
+    second.set("b", b"2")
+    # each one sees what the other appended
+    assert (first.get("b"), second.get("a")) == (b"2", b"1")
+
+    # compacting in one doesn't drop what the other wrote, even what it hasn't read yet
+    second.set("c", b"3")
+    first.compact()
+    second.set("d", b"4")
+    assert sorted(pyfra.state.JournalState(rem).keys()) == ["a", "b", "c", "d"]
+    assert (first.get("c"), first.get("d")) == (b"3", b"4")
+    rem.close()
+
+
+def _write_keys(wd, worker):
+    rem = Remote(wd=wd, state_durability="step")
+    for i in range(200):
+        rem.set_kv(f"{worker}_{i}", i)
+        if i % 50 == 0:
+            rem._state().compact()
+    rem.close()
+
+
+def test_journal_concurrent_writers(tmp_path):
+    procs = [multiprocessing.Process(target=_write_keys, args=(str(tmp_path), worker)) for worker in range(4)]
+    for p in procs: p.start()
+    for p in procs: p.join()
+    assert all(p.exitcode == 0 for p in procs)
+
+    rem = Remote(wd=str(tmp_path))
+    assert sorted(pyfra.state.JournalState(rem).keys()) == sorted(f"{w}_{i}" for w in range(4) for i in range(200))
+    rem.close()
+
+
+def test_legacy_state_migrated(tmp_path):
+    with open(tmp_path / ".pyfra_env_state.json", "w") as fh:
+        json.dump({
+            "old": pickle.dumps("goose", protocol=0).decode(),
+            "new": base64.b64encode(pickle.dumps("duck")).decode(),
+            "new_format": "b64",
+        }, fh)
+
+    rem = Remote(wd=str(tmp_path))
+    assert (rem.get_kv("old"), rem.get_kv("new")) == ("goose", "duck")
+
+    rem.set_kv("newer", "swan")
+    rem.close()
+    assert not (tmp_path / ".pyfra_env_state.json").exists()
+    rem = Remote(wd=str(tmp_path))
+    assert (rem.get_kv("old"), rem.get_kv("new"), rem.get_kv("newer")) == ("goose", "duck", "swan")
+    rem.close()
+
+
+def _as_remote(rem, monkeypatch):
+    """ Make a local Remote take the code paths of a remote one, with the helper run in this process """
+    monkeypatch.setattr(rem, "is_local", lambda: False)
+    monkeypatch.setattr(rem, "_helper", lambda op, **kwargs: json.loads(json.dumps(pyfra._remote_helper.run(op, **json.loads(json.dumps(kwargs))))))
+    return rem
+
+
+def test_legacy_migration_keeps_env_hash(tmp_path, monkeypatch):
+    with open(tmp_path / ".pyfra_env_state.json", "w") as fh:
+        json.dump({"old": pickle.dumps("goose", protocol=0).decode()}, fh)
+
+    rem = _as_remote(Remote(wd=str(tmp_path), resumable=True), monkeypatch)
+    rem.set_kv("newer", "swan")
+    env_hash = rem.hash
+    # the legacy file is read and removed by the background flush, which isn't a step of the env
+    rem.close()
+    assert rem.hash == env_hash
+    assert not (tmp_path / ".pyfra_env_state.json").exists()
+    assert Remote(wd=str(tmp_path)).get_kv("old") == "goose"
+
+
+def test_legacy_migration_two_instances(tmp_path):
+    with open(tmp_path / ".pyfra_env_state.json", "w") as fh:
+        json.dump({"old": pickle.dumps("goose", protocol=0).decode()}, fh)
+
+    # like two processes that both read the legacy state before either of them wrote anything
+    rem = Remote(wd=str(tmp_path))
+    first, second = pyfra.state.JournalState(rem), pyfra.state.JournalState(rem)
+    assert first.keys() == second.keys() == ["old"]
+    first.set("a", b"1")
+    second.set("b", b"2")
+    assert not (tmp_path / ".pyfra_env_state.json").exists()
+
+    # the migration is done, so later writes only append their own records
+    size = os.path.getsize(tmp_path / ".pyfra_env_state.journal")
+    second.set("c", b"3")
+    assert os.path.getsize(tmp_path / ".pyfra_env_state.journal") - size < 50
+    assert sorted(pyfra.state.JournalState(rem).keys()) == ["a", "b", "c", "old"]
+
+
+def test_sqlite_backend(tmp_path):
+    rem = Remote(wd=str(tmp_path), state_backend="sqlite")
+    rem.set_kv("a", {"goose": 1})
+    rem.set_kv("a", {"goose": 2})
+    pyfra.state.SQLiteState(rem).set_many({f"key{i}": pickle.dumps(i) for i in range(20000)})
+    rem.close()
+
+    rem = Remote(wd=str(tmp_path), state_backend="sqlite")
+    assert rem.get_kv("a") == {"goose": 2}
+    assert rem.get_kv("key12345") == 12345
+    with pytest.raises(KeyError):
+        rem.get_kv("missing")
+    assert len(rem._state().keys()) == 20001
+    assert not (tmp_path / ".pyfra_env_state.journal").exists()
+    rem.close()
+
+
+def test_sqlite_imports_journal(tmp_path, monkeypatch):
+    rem = Remote(wd=str(tmp_path))
+    rem.set_kv("a", "goose")
+    rem.close()
+
+    monkeypatch.setenv("PYFRA_STATE_BACKEND", "sqlite")
+    rem = Remote(wd=str(tmp_path))
+    assert isinstance(rem._state().inner, pyfra.state.SQLiteState)
+    assert rem.get_kv("a") == "goose"
+    rem.set_kv("b", "duck")
+    rem.close()
+    assert Remote(wd=str(tmp_path)).get_kv("b") == "duck"
+    rem.close()
+
+
+class SlowState(pyfra.state.StateBackend):
+    """ Records every write, to see how they get batched """
+    def __init__(self, rem):
+        self.data = {}
+        self.writes = []
+
+    def get(self, key):
+        return self.data[key]
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        time.sleep(0.01)
+        self.data.update(items)
+        self.writes.append(sorted(items))
+
+    def keys(self):
+        return list(self.data)
+
+
+def test_write_behind(tmp_path):
+    rem = Remote(wd=str(tmp_path), state_backend=SlowState)
+    state = rem._state()
+    assert isinstance(state, pyfra.state.WriteBehindState)
+
+    for i in range(100):
+        rem.set_kv(f"key{i}", i)
+        # values that haven't been written out yet are still visible
+        assert rem.get_kv(f"key{i}") == i
+    assert Remote(wd=str(tmp_path), state_backend=SlowState).get_kv("key50") == 50
+
+    rem.close()
+    # written in batches rather than one at a time, and nothing is lost
+    assert len(state.inner.writes) < 50
+    assert {key: pyfra.state.decode_value(pyfra.state.unpack_entry(value)[0]) for key, value in state.inner.data.items()} == {f"key{i}": i for i in range(100)}
+
+
+class BlockingState(SlowState):
+    """ Holds every write until it's let through """
+    def __init__(self, rem):
+        super().__init__(rem)
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def set_many(self, items):
+        self.writing.set()
+        self.release.wait()
+        super().set_many(items)
+
+
+def test_write_behind_reads_during_write(tmp_path):
+    state = pyfra.state.WriteBehindState(BlockingState(None), max_pending=1)
+    state.inner.data["old"] = b"goose"
+    state.set("new", b"honk")
+    assert state.inner.writing.wait(5)
+
+    # the batch is stuck being written, but reads don't wait for it
+    start = time.time()
+    assert state.get("old") == b"goose" and state.get("new") == b"honk"
+    assert state.get_many(["old", "new", "missing"]) == {"old": b"goose", "new": b"honk"}
+    assert sorted(state.keys()) == ["new", "old"]
+    assert time.time() - start < 1
+
+    state.inner.release.set()
+    state.close()
+    assert state.inner.data == {"old": b"goose", "new": b"honk"}
+
+
+def test_journal_threads(tmp_path):
+    rem = Remote(wd=str(tmp_path), state_durability="step")
+    state = rem._state()
+
+    def work(i):
+        for j in range(50):
+            state.set(f"{i}_{j}", b"x" * j)
+            assert state.get(f"{i}_{j}") == b"x" * j
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    rem.close()
+    rem = Remote(wd=str(tmp_path))
+    state = rem._state()
+    assert len(state.keys()) == 400 and state.get("7_49") == b"x" * 49
+    rem.close()
+
+
+def test_write_behind_flushes_on_exception(tmp_path):
+    rem = Remote(wd=str(tmp_path), state_backend=SlowState, resumable=True)
+    state = rem._state()
+    rem.sh("true")
+    assert state.inner.writes == []
+
+    with pytest.raises(Exception):
+        rem.sh("exit 1")
+    assert len(state.inner.data) == 1
+    rem.close()
+
+
+def test_value_encoding(tmp_path):
+    np = pytest.importorskip("numpy")
+
+    arr = np.arange(100000, dtype=np.float64).reshape(100, 1000)
+    value = {"arr": arr, "text": "goose" * 1000}
+    for compression in ["none", "zlib", "lzma"]:
+        data = pyfra.state.encode_value(value, compression=compression)
+        ret = pyfra.state.decode_value(data)
+        assert ret["text"] == value["text"] and (ret["arr"] == arr).all()
+        # arrays come back writable, like they would from a plain pickle
+        ret["arr"][0, 0] = -1
+    assert len(pyfra.state.encode_value("goose" * 1000, compression="zlib")) < 1000
+
+    # plain pickles from older versions still load
+    assert pyfra.state.decode_value(pickle.dumps([1, 2])) == [1, 2]
+    assert pyfra.state.decode_value(pickle.dumps("duck", protocol=0)) == "duck"
+
+    with pytest.raises(ValueError):
+        pyfra.state.encode_value(1, compression="nope")
+
+    rem = Remote(wd=str(tmp_path))
+    rem.set_kv("value", value)
+    rem.close()
+    rem = Remote(wd=str(tmp_path))
+    assert (rem.get_kv("value")["arr"] == arr).all()
+    rem.close()
+
+
+def test_blobs(tmp_path, monkeypatch):
+    np = pytest.importorskip("numpy")
+    monkeypatch.setenv("PYFRA_STATE_COMPRESSION", "none")
+
+    arr = np.arange(1 << 20, dtype=np.float32)
+    rem = Remote(wd=str(tmp_path), state_durability="step")
+    rem.set_kv("big", {"arr": arr})
+    rem.set_kv("big_again", {"arr": arr})
+    rem.set_kv("small", "goose")
+
+    # the big value is stored once, and only a reference to it goes in the state
+    blobs = [p for p in (tmp_path / ".pyfra_blobs").rglob("*") if p.is_file()]
+    assert len(blobs) == 1 and blobs[0].stat().st_size > arr.nbytes
+    assert os.path.getsize(tmp_path / ".pyfra_env_state.journal") < 1000
+    rem.close()
+
+    rem = Remote(wd=str(tmp_path))
+    ret = rem.get_kv("big")["arr"]
+    assert (ret == arr).all()
+    # changing the loaded array doesn't change the blob
+    ret[0] = -1
+    assert rem.get_kv("big_again")["arr"][0] == 0
+    assert rem.get_kv("small") == "goose"
+    rem.close()
+
+
+def _run_steps(rem, steps):
+    rem.hash = rem._hash(None)
+    for step in steps:
+        rem.update_hash(step)
+        rem.set_kv(rem.hash, step * 1000)
+    return rem.hash
+
+
+def test_gc(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYFRA_STATE_BLOB_THRESHOLD", "1000")
+    monkeypatch.setenv("PYFRA_STATE_COMPRESSION", "none")
+    rem = Remote(wd=str(tmp_path), state_durability="step")
+
+    # a run from a while ago, and then one after editing the second step
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now - 40 * 86400)
+    old_head = _run_steps(rem, ["a", "b", "c"])
+    old_keys = set(rem._state().keys())
+    monkeypatch.setattr(time, "time", lambda: now)
+    new_head = _run_steps(rem, ["a", "b2", "c2"])
+    # state from before entries had timestamps
+    rem._state().set("legacy", pickle.dumps("goose"))
+
+    assert rem.gc_state(dry_run=True) == {"entries": 6, "dropped": 2, "blobs": 2}
+    assert len(rem._state().keys()) == 6
+    # the old chain is kept if it leads up to a head
+    assert pyfra.state.collect_garbage(rem, heads=[old_head], dry_run=True)["dropped"] == 0
+    assert pyfra.state.collect_garbage(rem, max_entries=2, dry_run=True)["dropped"] == 3
+
+    assert rem.gc_state() == {"entries": 6, "dropped": 2, "blobs": 2}
+    rem.close()
+    rem = Remote(wd=str(tmp_path))
+    assert not set(rem._state().keys()) & (old_keys - {rem._hash(rem._hash(None), "a")})
+    assert rem.get_kv(new_head) == "c2" * 1000 and rem.get_kv("legacy") == "goose"
+    assert len([p for p in (tmp_path / ".pyfra_blobs").rglob("*") if p.is_file()]) == 3
+    rem.close()
+
+
+def test_gc_heads_and_hits(tmp_path, monkeypatch):
+    rem = Remote(wd=str(tmp_path), state_durability="step")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now - 40 * 86400)
+    used_head = _run_steps(rem, ["a", "b"])
+    stale_head = _run_steps(rem, ["c", "d"])
+    rem._record_head()
+    hit_head = _run_steps(rem, ["e", "f"])
+    # e.g. a stage or an idempotent.cache entry, which aren't part of a chain
+    rem.set_kv("stage_key", "goose")
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    # a recent head keeps its whole chain, however old the steps are
+    rem.hash = used_head
+    rem._record_head()
+    # a step that's hit is written again with a new timestamp, but only once a day
+    rem.get_kv(hit_head)
+    size = os.path.getsize(tmp_path / ".pyfra_env_state.journal")
+    rem.get_kv(hit_head)
+    rem._record_head()
+    assert os.path.getsize(tmp_path / ".pyfra_env_state.journal") == size
+
+    assert pyfra.state.collect_garbage(rem, dry_run=True) == {"entries": 9, "dropped": 3, "blobs": 0}
+    assert pyfra.state.collect_garbage(rem, max_kv_age=86400, dry_run=True)["dropped"] == 4
+
+    rem.gc_state(max_age=30 * 86400)
+    keys = set(rem._state().keys())
+    assert {used_head, hit_head, "head:" + used_head, "stage_key"} <= keys
+    assert stale_head not in keys and "head:" + stale_head not in keys
+    rem.close()
+
+
+def test_gc_command(tmp_path, capsys):
+    import pyfra.__main__
+
+    rem = Remote(wd=str(tmp_path))
+    rem.set_kv("a", 1)
+    rem.close()
+    pyfra.__main__.main(["gc", str(tmp_path), "--max-age", "0s", "--dry-run"])
+    # set_kv entries aren't steps of an env, so they're kept unless asked otherwise
+    assert "Would drop 0 of 1 entries" in capsys.readouterr().out
+    pyfra.__main__.main(["gc", str(tmp_path), "--max-kv-age", "0s", "--dry-run"])
+    assert "Would drop 1 of 1 entries" in capsys.readouterr().out
+    pyfra.__main__.main(["gc", str(tmp_path), "--max-kv-age", "0s"])
+    with pytest.raises(KeyError):
+        Remote(wd=str(tmp_path)).get_kv("a")
+
+
+def test_streamed_writes_resume(tmp_path):
+    def run(rows, append=False):
+        rem = Remote(wd=str(tmp_path), resumable=True, state_durability="step")
+        rem.path("data.csv").csvwrite(rows, append=append)
+        ret = rem.hash
+        rem.close()
+        return ret
+
+    rows = [{"a": i, "b": i * 2} for i in range(3)]
+    first = run(rows)
+    assert first != Remote._hash(None)
+    assert (tmp_path / "data.csv").read_text().splitlines() == ["a,b", "0,0", "1,2", "2,4"]
+
+    # rerunning the same write ends up at the same hash and skips it, so the file isn't touched
+    (tmp_path / "data.csv").write_text("a,b\n")
+    assert run(rows) == first
+    assert (tmp_path / "data.csv").read_text() == "a,b\n"
+
+    # resuming an append doesn't append the rows twice
+    run(rows)
+    run(rows[:1], append=True)
+    run(rows[:1], append=True)
+    assert (tmp_path / "data.csv").read_text().splitlines() == ["a,b", "0,0"]
+    assert not [f for f in os.listdir(tmp_path) if ".pyfra_part." in f]
+
+    with pytest.raises(AssertionError):
+        local.path(str(tmp_path / "other.csv")).csvwrite([{"a": 1, "b": 2}, {"a": 1}])
+
+
+def test_streamed_jlwrite_resume(tmp_path):
+    def run(records):
+        rem = Remote(wd=str(tmp_path), resumable=True, state_durability="step")
+        rem.path("data.jsonl.gz").jlwrite(records)
+        ret = rem.hash
+        rem.close()
+        return ret
+
+    records = [{"goose": i} for i in range(10)]
+    first = run(iter(records))
+    assert list(local.path(str(tmp_path / "data.jsonl.gz")).jlread()) == records
+
+    # the hash is of the records rather than of the compressed file, so it doesn't depend on e.g. the gzip timestamp
+    os.remove(tmp_path / "data.jsonl.gz")
+    assert run(iter(records)) == first
+    assert not os.path.exists(tmp_path / "data.jsonl.gz")
+
+
+def test_np_save_resume(tmp_path):
+    np = pytest.importorskip("numpy")
+
+    def run(arr):
+        rem = Remote(wd=str(tmp_path), resumable=True, state_durability="step")
+        rem.path("arr.npy").np_save(arr)
+        ret = rem.hash
+        rem.close()
+        return ret
+
+    arr = np.arange(1000)
+    first = run(arr)
+    assert (np.load(tmp_path / "arr.npy") == arr).all()
+
+    os.remove(tmp_path / "arr.npy")
+    assert run(arr) == first
+    assert not os.path.exists(tmp_path / "arr.npy")
+
+    assert run(arr + 1) != first
+    assert (np.load(tmp_path / "arr.npy") == arr + 1).all()